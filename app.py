@@ -1,9 +1,10 @@
 import os
+import logging
 import psycopg2
+from psycopg2.extras import execute_values
 from dotenv import load_dotenv
-from flask import Flask, jsonify, request, make_response
+from flask import Flask, Response, jsonify, request, make_response, g
 import re
-import bcrypt
 import random
 import string
 from datetime import datetime, timedelta
@@ -11,13 +12,26 @@ import uuid
 from werkzeug.security import generate_password_hash, check_password_hash
 import jwt
 from functools import wraps
-import json
-import requests
-import threading
-import time
+from contextlib import ExitStack, contextmanager
+import heapq
+import click
+from db import ConnectionPool
+from cache import TTLCache
+from order_book import MatchingEngine, Order, StaleBook, Unsettled, BUY, SELL, EPSILON
+from migrations import apply_migrations
+from scheduler import PeriodicJob
+from seeding import seed_bulk
+from serialization import install_json_provider, map_row, row_mapper, stamp_rows
+from statements import PreparingConnection, registry as statement_registry
+from response_cache import create_response_cache
+from resource_registry import ResourceRegistry
+from events import EVENT_TYPES, SSE_RETRY, EventBus, format_events, parse_filters
+from ownership import BUY_OFFERS, COMPANIES, COMPANY_RESOURCES, SELL_OFFERS, Forbidden, NotFound, delete_owned, update_owned
 
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
 CREATE_COMPANIES_TABLE = ("""
         create table if not exists companies (
             company_id serial primary key,
@@ -105,12 +119,12 @@ INSERT_INTO_TRANSACTIONS = ("""
 
 INSERT_INTO_BUY_OFFERS = ("""
         insert into buy_offers (buyer_id, resource_id, quantity, price_per_ton, offer_start_date, offer_end_date, min_amount)
-        values (%s, %s, %s, %s, %s, %s, %s) returning buy_offer_id;
+        values (%s, %s, %s, %s, %s, %s, %s) returning *;
     """)
 
 INSERT_INTO_SELL_OFFERS = ("""
         insert into sell_offers (seller_id, resource_id, quantity, price_per_ton, offer_start_date, offer_end_date, min_amount)
-        values (%s, %s, %s, %s, %s, %s, %s) returning sell_offer_id;
+        values (%s, %s, %s, %s, %s, %s, %s) returning *;
     """)
 
 INSERT_INTO_RESOURCES = ("""
@@ -126,6 +140,141 @@ INSERT_INTO_STATISTICS = ( """
         insert into price_statistics (resource_id, price) values (%s, %s) returning data_id;
     """)
 
+# one price tick per resource: midpoint of best bid and best ask, or whichever
+# side exists. The ticks are rolled into the 1m/1h/1d candles in the same statement
+GATHER_PRICE_DATA = ("""
+        with ticks as (
+            insert into price_statistics (resource_id, price)
+            select resource_id, (coalesce(buy_max_price, sell_min_price) + coalesce(sell_min_price, buy_max_price)) / 2
+            from market_summary
+            where sell_min_price is not null or buy_max_price is not null
+            returning resource_id, timestamp, price
+        ), candles as (
+            insert into price_candles (resource_id, resolution, bucket_start, open, high, low, close)
+            select t.resource_id, r.resolution, date_trunc(r.unit, t.timestamp), t.price, t.price, t.price, t.price
+            from ticks t
+            cross join (values ('1m', 'minute'), ('1h', 'hour'), ('1d', 'day')) as r(resolution, unit)
+            on conflict (resource_id, resolution, bucket_start) do update set
+                open = coalesce(price_candles.open, excluded.open),
+                high = greatest(price_candles.high, excluded.high),
+                low = least(price_candles.low, excluded.low),
+                close = excluded.close
+        )
+        select resource_id, timestamp, price from ticks;
+    """)
+
+SELECT_CANDLES = ("""
+        select bucket_start, open, high, low, close, volume from price_candles
+        where resource_id = %s and resolution = %s and bucket_start >= %s and bucket_start < %s
+        order by bucket_start limit %s;
+    """)
+
+INSERT_INTO_BUY_OFFERS_BATCH = ("""
+        insert into buy_offers (buyer_id, resource_id, quantity, price_per_ton, offer_start_date, offer_end_date, min_amount)
+        values %s returning *;
+    """)
+
+INSERT_INTO_SELL_OFFERS_BATCH = ("""
+        insert into sell_offers (seller_id, resource_id, quantity, price_per_ton, offer_start_date, offer_end_date, min_amount)
+        values %s returning *;
+    """)
+
+SELECT_COMPANY_IDS = ("select public_id, company_id from companies where public_id = any(%s);")
+
+SELECT_MARKET_SNAPSHOT = ("""
+        select r.resource_id, r.resource_name, m.buy_max_price as best_bid, m.sell_min_price as best_ask,
+               m.buy_price_sum / nullif(m.buy_count, 0) as avg_buy_price,
+               m.sell_price_sum / nullif(m.sell_count, 0) as avg_sell_price,
+               m.trade_price_sum / nullif(m.trade_count, 0) as avg_transaction_price,
+               coalesce(m.trade_quantity_sum, 0) as traded_volume,
+               coalesce(m.buy_count, 0) as buy_count, coalesce(m.sell_count, 0) as sell_count,
+               coalesce(m.trade_count, 0) as trade_count,
+               rank() over (order by coalesce(m.buy_count, 0) desc) as buy_rank,
+               rank() over (order by coalesce(m.sell_count, 0) desc) as sell_rank,
+               rank() over (order by coalesce(m.trade_count, 0) desc) as trade_rank
+        from resources r left join market_summary m on m.resource_id = r.resource_id
+        order by r.resource_id;
+    """)
+
+# expired offers are moved to the archive tables (migration 6) in batches, oldest
+# first. The delete fires the market_summary triggers, so the live aggregates drop them too
+ARCHIVE_EXPIRED_SELL_OFFERS = ("""
+        with expired as (
+            delete from sell_offers where sell_offer_id in (
+                select sell_offer_id from sell_offers
+                where offer_end_date is not null and offer_end_date <= now()
+                order by offer_end_date limit %s
+                for update skip locked
+            ) returning *
+        ), archived as (
+            insert into sell_offers_archive select expired.*, now() from expired returning 1
+        )
+        select count(*) from archived;
+    """)
+
+ARCHIVE_EXPIRED_BUY_OFFERS = ("""
+        with expired as (
+            delete from buy_offers where buy_offer_id in (
+                select buy_offer_id from buy_offers
+                where offer_end_date is not null and offer_end_date <= now()
+                order by offer_end_date limit %s
+                for update skip locked
+            ) returning *
+        ), archived as (
+            insert into buy_offers_archive select expired.*, now() from expired returning 1
+        )
+        select count(*) from archived;
+    """)
+
+# partition upkeep for transactions and price_statistics (migration 5)
+ENSURE_PARTITIONS = ("""
+        select count(*) filter (where ensure_monthly_partition(p.parent, p.key_column, (date_trunc('month', now()) + m * interval '1 month')::date))
+        from (values ('transactions', 'transaction_time'), ('price_statistics', 'timestamp')) as p(parent, key_column),
+             generate_series(0, %s) as m;
+    """)
+
+COMPACT_PRICE_STATISTICS = ("""
+        insert into price_candles (resource_id, resolution, bucket_start, open, high, low, close)
+        select p.resource_id, r.resolution, date_trunc(r.unit, p.timestamp),
+               (array_agg(p.price order by p.timestamp, p.data_id))[1], max(p.price), min(p.price),
+               (array_agg(p.price order by p.timestamp desc, p.data_id desc))[1]
+        from price_statistics p
+        cross join (values ('1h', 'hour'), ('1d', 'day')) as r(resolution, unit)
+        where p.timestamp < %s and p.resource_id is not null
+        group by 1, 2, 3
+        on conflict (resource_id, resolution, bucket_start) do nothing;
+    """)
+
+DELETE_MINUTE_CANDLES_BEFORE = ("delete from price_candles where resolution = '1m' and bucket_start < %s;")
+
+DELETE_RESOURCE_ACTIVITY_BEFORE = ("delete from resource_activity where bucket_start < %s;")
+
+DROP_PARTITIONS_BEFORE = ("select drop_monthly_partitions_before(%s, %s);")
+
+# months that ended up in the default partitions are not dropped with the
+# monthly ones, their old rows are deleted instead
+DELETE_DEFAULT_PRICE_STATISTICS_BEFORE = ("delete from price_statistics_default where timestamp < %s;")
+
+# the delete trigger takes the trades out of market_summary, which keeps the
+# totals of dropped partitions; restored adds them back before it runs at the
+# end of the statement
+DELETE_DEFAULT_TRANSACTIONS_BEFORE = ("""
+        with purged as (
+            delete from transactions_default where transaction_time < %s
+            returning resource_id, price_per_ton, quantity
+        ), restored as (
+            update market_summary m set
+                trade_count = m.trade_count + p.trades,
+                trade_price_sum = m.trade_price_sum + p.price_sum,
+                trade_quantity_sum = m.trade_quantity_sum + p.quantity_sum
+            from (select resource_id, count(*) as trades, sum(price_per_ton) as price_sum, sum(quantity) as quantity_sum
+                  from purged group by resource_id) p
+            where m.resource_id = p.resource_id
+            returning 1
+        )
+        select count(*) from purged;
+    """)
+
 SELECT_COMPANY_BY_NAME = ("select * from companies where company_name = (%s)")
 
 SELECT_ALL_COMPANIES = ("select * from companies;") 
@@ -134,22 +283,14 @@ SELECT_ONE_COMPANY = ("select * from companies where public_id=(%s);")
 
 PROMOTE_COMPANY = ("update companies set is_admin = True where public_id = %s;")
 
-SELECT_ALL_RESOURCES = ("select * from resources;")
-
-SELECT_ONE_RESOURCE = ("select * from resources where resource_id=(%s);")
-
 SELECT_ALL_BUY_OFFERS = ("select * from buy_offers;")
 
 SELECT_ONE_BUY_OFFER = ("select * from buy_offers where buy_offer_id=(%s);")
 
-DELETE_BUY_OFFER = ("delete from buy_offers where buy_offer_id = %s;")
-
 SELECT_ALL_SELL_OFFERS = ("select * from sell_offers;")
 
 SELECT_ONE_SELL_OFFER = ("select * from sell_offers where sell_offer_id=(%s);")
 
-DELETE_SELL_OFFER = ("delete from sell_offers where sell_offer_id = %s;")
-
 SELECT_ALL_TRANSACTIONS = ("select * from transactions;")
 
 SELECT_ONE_TRANSACTION = ("select * from transactions where transaction_id =(%s);")
@@ -160,74 +301,354 @@ SELECT_ALL_COMPANY_RESOURCES = ("select * from company_resources;")
 
 SELECT_ONE_COMPANY_RESOURCE = ("select * from company_resources where company_resource_id=(%s);")
 
-SELECT_ALL_STATISTICS = ("select r.resource_name, p.timestamp, p.price from price_statistics p, resources r where r.resource_id = p.resource_id;")
+# keyset pages, {columns} is filled from the *_FIELDS whitelists below
+SELECT_COMPANIES_PAGE = ("select company_id, {columns} from companies where company_id > %s order by company_id limit %s;")
 
-SELECT_1_DAY_STATISTICS = ("select * from price_statistics WHERE timestamp > now()::timestamp - (interval '1d');")
+SELECT_BUY_OFFERS_PAGE = ("select buy_offer_id, {columns} from buy_offers where buy_offer_id > %s order by buy_offer_id limit %s;")
 
-SELECT_STATISTICS_OF_RESOURCE = ("select * from price_statistics where resource_id = %s;")
+SELECT_SELL_OFFERS_PAGE = ("select sell_offer_id, {columns} from sell_offers where sell_offer_id > %s order by sell_offer_id limit %s;")
+
+SELECT_TRANSACTIONS_PAGE = ("select transaction_id, {columns} from transactions where transaction_id > %s order by transaction_id limit %s;")
+
+SELECT_COMPANY_RESOURCES_PAGE = ("select company_resource_id, {columns} from company_resources where company_resource_id > %s order by company_resource_id limit %s;")
 
-DELETE_COMPANY_RESOURCE = ("delete from company_resources where company_resource_id = %s;")
+# resource names are filled in from resource_registry, not joined
+SELECT_STATISTICS_PAGE = ("select p.data_id, {columns} from price_statistics p where p.resource_id is not null and p.data_id > %s order by p.data_id limit %s;")
 
-CHANGE_STOCK_AMOUNT = ("update company_resources set stock_amount = (%s) where company_resource_id = (%s)")
+# full exports, read through a server-side cursor
+SELECT_TRANSACTIONS_EXPORT = ("select {columns} from transactions where transaction_id > %s order by transaction_id;")
 
-CHANGE_COMPANY_NAME = ("update companies set company_name = (%s) where public_id = (%s)")
+SELECT_STATISTICS_EXPORT = ("select {columns} from price_statistics p where p.resource_id is not null and p.data_id > %s order by p.data_id;")
 
-CHANGE_COMPANY_MAIL = ("update companies set company_mail = (%s) where public_id = (%s)")
+SELECT_1_DAY_STATISTICS = ("select * from price_statistics WHERE timestamp > now()::timestamp - (interval '1d');")
+
+SELECT_STATISTICS_OF_RESOURCE = ("select * from price_statistics where resource_id = %s;")
+
+# per-resource aggregates are read from market_summary, kept up to date by triggers (migration 2)
+GET_AVG_TRANSACTION_RESOURCE_PRICE_PER_TON = ("select trade_price_sum / nullif(trade_count, 0) from market_summary where resource_id=(%s);")
 
-CHANGE_SELL_OFFER_QUANTITY = ("update sell_offers set quantity = (%s) where sell_offer_id = (%s)")
+GET_AVG_TRANSACTION_RESOURCE_QUANTITY = ("select trade_quantity_sum / nullif(trade_count, 0) from market_summary where resource_id=(%s);")
 
-CHANGE_SELL_OFFER_PRICE_PER_TON = ("update sell_offers set price_per_ton = (%s) where sell_offer_id = (%s)")
+GET_SUM_QUANTITY_OF_RESOURCE_TRANSACTION = ("select case when trade_count > 0 then trade_quantity_sum end from market_summary where resource_id=(%s);")
 
-CHANGE_SELL_OFFER_END_DATE = ("update sell_offers set offer_end_date = (%s) where sell_offer_id = (%s)")
+GET_AVG_SELL_OFFER_RESOURCE_PRICE_PER_TON = ("select sell_price_sum / nullif(sell_count, 0) from market_summary where resource_id=(%s);")
 
-CHANGE_SELL_OFFER_MIN_AMOUNT = ("update sell_offers set min_amount = (%s) where sell_offer_id = (%s)")
+GET_MIN_SELL_OFFER_RESOURCE_PRICE_PER_TON = ("select sell_min_price from market_summary where resource_id=(%s);")
 
-CHANGE_BUY_OFFER_QUANTITY = ("update buy_offers set quantity = (%s) where buy_offer_id = (%s)")
+GET_AVG_BUY_OFFER_RESOURCE_PRICE_PER_TON = ("select buy_price_sum / nullif(buy_count, 0) from market_summary where resource_id=(%s);")
 
-CHANGE_BUY_OFFER_PRICE_PER_TON = ("update buy_offers set price_per_ton = (%s) where buy_offer_id = (%s)")
+GET_MAX_BUY_OFFER_RESOURCE_PRICE_PER_TON = ("select buy_max_price from market_summary where resource_id=(%s);")
 
-CHANGE_BUY_OFFER_END_DATE = ("update buy_offers set offer_end_date = (%s) where buy_offer_id = (%s)")
+# popularity counters: live row counts from market_summary, or rows created
+# within a window from the hourly resource_activity buckets (migration 3)
+GET_SELL_OFFER_COUNTS = ("select resource_id, sell_count from market_summary where sell_count > 0;")
 
-CHANGE_BUY_OFFER_MIN_AMOUNT = ("update buy_offers set min_amount = (%s) where buy_offer_id = (%s)")
+GET_BUY_OFFER_COUNTS = ("select resource_id, buy_count from market_summary where buy_count > 0;")
 
-GET_AVG_TRANSACTION_RESOURCE_PRICE_PER_TON = ("select avg(price_per_ton) from transactions where resource_id=(%s);")
+GET_TRANSACTION_COUNTS = ("select resource_id, trade_count from market_summary where trade_count > 0;")
 
-GET_AVG_TRANSACTION_RESOURCE_QUANTITY = ("select avg(quantity) from transactions where resource_id=(%s);")
+GET_ACTIVITY_COUNTS = ("select resource_id, sum(count) from resource_activity where kind = %s and bucket_start >= date_trunc('hour', %s::timestamp) group by resource_id;")
 
-GET_SUM_QUANTITY_OF_RESOURCE_TRANSACTION = ("select sum(quantity) from transactions where resource_id=(%s);")
+SELECT_IS_ADMIN_FROM_COMPANIES = ("select is_admin from companies where public_id=(%s);")
 
-GET_AVG_SELL_OFFER_RESOURCE_PRICE_PER_TON = ("select avg(price_per_ton) from sell_offers where resource_id=(%s);")
+SELECT_COMPANY_ID = ("select company_id from companies where public_id=(%s);")
 
-GET_MIN_SELL_OFFER_RESOURCE_PRICE_PER_TON = ("select min(price_per_ton) from sell_offers where resource_id=(%s);")
+SELECT_SELL_OFFERS_OF_RESOURCE = ("select * from sell_offers where resource_id = %s and (offer_end_date is null or offer_end_date > now());")
 
-GET_AVG_BUY_OFFER_RESOURCE_PRICE_PER_TON = ("select avg(price_per_ton) from buy_offers where resource_id=(%s);")
+SELECT_BUY_OFFERS_OF_RESOURCE = ("select * from buy_offers where resource_id = %s and (offer_end_date is null or offer_end_date > now());")
 
-GET_MAX_BUY_OFFER_RESOURCE_PRICE_PER_TON = ("select max(price_per_ton) from buy_offers where resource_id=(%s);")
+# fills only apply while the row still holds the quantity, no row comes back
+# when it was changed behind the order book
+FILL_SELL_OFFER = ("update sell_offers set quantity = quantity - %s where sell_offer_id = %s and quantity >= %s - 1e-6 returning quantity;")
 
-GET_3_MOST_POPULAR_SELL_OFFER_PRODUCTS = ("select resource_id from sell_offers group by resource_id order by count(*) desc limit 3;")
+FILL_BUY_OFFER = ("update buy_offers set quantity = quantity - %s where buy_offer_id = %s and quantity >= %s - 1e-6 returning quantity;")
 
-GET_3_MOST_POPULAR_BUY_OFFER_PRODUCTS = ("select resource_id from buy_offers group by resource_id order by count(*) desc limit 3;")
+# /buy: the offer row stays locked until the purchase commits
+SELECT_SELL_OFFER_FOR_UPDATE = ("select * from sell_offers where sell_offer_id = %s for update;")
 
-GET_3_MOST_POPULAR_TRANSACTION_PRODUCTS = ("select resource_id from transactions group by resource_id order by count(*) desc limit 3;")
+# the cast keeps a prepared $3 from being typed integer after the literal 0,
+# which would round a debit of -0.4 to 0 and let it through
+ADD_ACCOUNT_BALANCE = ("update companies set account_balance = account_balance + %s where company_id = %s and (%s::float8 >= 0 or account_balance + %s >= 0) returning public_id;")
 
-SELECT_IS_ADMIN_FROM_COMPANIES = ("select is_admin from companies where public_id=(%s);")
+DELETE_FILLED_SELL_OFFERS = ("delete from sell_offers where sell_offer_id = any(%s) and quantity <= 0.000001;")
 
-SELECT_COMPANY_ID = ("select company_id from companies where public_id=(%s);")
+DELETE_FILLED_BUY_OFFERS = ("delete from buy_offers where buy_offer_id = any(%s) and quantity <= 0.000001;")
 
-GET_SELLER_ID_OF_OFFER = ("select seller_id from sell_offers where sell_offer_id=(%s);")
+ADD_COMPANY_RESOURCE_STOCK = ("""
+        update company_resources set stock_amount = stock_amount + %s
+        where company_resource_id = (
+            select min(company_resource_id) from company_resources where company_id = %s and resource_id = %s
+        ) returning company_resource_id;
+    """)
 
-GET_BUYER_ID_OF_OFFER = ("select buyer_id from buy_offers where buy_offer_id=(%s);")
+# only takes stock the company holds, no row comes back otherwise
+TAKE_COMPANY_RESOURCE_STOCK = ("""
+        update company_resources set stock_amount = stock_amount - %s
+        where company_resource_id = (
+            select min(company_resource_id) from company_resources where company_id = %s and resource_id = %s
+        ) and stock_amount >= %s - 1e-6 returning company_resource_id;
+    """)
 
-GET_COMPANY_ID_OF_COMPANY_RESOURCE = ("select company_id from company_resources where company_resource_id=(%s);")
+# a fill that cannot be settled is rolled back on its own, the rest of the match goes on
+SAVEPOINT_FILL = ("savepoint fill;")
+
+ROLLBACK_TO_FILL = ("rollback to savepoint fill;")
+
+RELEASE_FILL = ("release savepoint fill;")
+
+# a match that finds its book stale is rolled back to here, the book is
+# reloaded and the offer matched again, up to MATCH_ATTEMPTS times
+SAVEPOINT_MATCH = ("savepoint match;")
+
+ROLLBACK_TO_MATCH = ("rollback to savepoint match;")
+
+RELEASE_MATCH = ("release savepoint match;")
+
+MATCH_ATTEMPTS = 3
+
+# response key -> column of the list endpoints, in response order
+COMPANY_FIELDS = {
+    'public_id' : 'public_id',
+    'company_name' : 'company_name',
+    'company_mail' : 'company_mail',
+    'account_balance' : 'account_balance',
+    'hassword_hash' : 'password_hash',
+    'is_admin' : 'is_admin',
+}
+
+BUY_OFFER_FIELDS = {
+    'buy_offer_id' : 'buy_offer_id',
+    'buyer_id' : 'buyer_id',
+    'resource_id' : 'resource_id',
+    'quantity' : 'quantity',
+    'price_per_ton' : 'price_per_ton',
+    'offer_start_date' : 'offer_start_date',
+    'offer_end_date' : 'offer_end_date',
+    'min_amount' : 'min_amount',
+}
+
+SELL_OFFER_FIELDS = {
+    'sell_offer_id' : 'sell_offer_id',
+    'seller_id' : 'seller_id',
+    'resource_id' : 'resource_id',
+    'quantity' : 'quantity',
+    'price_per_ton' : 'price_per_ton',
+    'offer_start_date' : 'offer_start_date',
+    'offer_end_date' : 'offer_end_date',
+    'min_amount' : 'min_amount',
+}
+
+TRANSACTION_FIELDS = {
+    'transaction_id' : 'transaction_id',
+    'buyer_id' : 'buyer_id',
+    'seller_id' : 'seller_id',
+    'resource_id' : 'resource_id',
+    'quantity' : 'quantity',
+    'price_per_ton' : 'price_per_ton',
+    'transaction_date' : 'transaction_time',
+}
+
+TRANSACTION_DETAIL_FIELDS = {
+    'transaction_id' : 'transaction_id',
+    'buyer_id' : 'buyer_id',
+    'seller_id' : 'seller_id',
+    'resource_id' : 'resource_id',
+    'quantity' : 'quantity',
+    'price_per_ton' : 'price_per_ton',
+    'transaction_time' : 'transaction_time',
+}
+
+COMPANY_RESOURCE_FIELDS = {
+    'company_resource_id' : 'company_resource_id',
+    'company_id' : 'company_id',
+    'resource_id' : 'resource_id',
+    'stock_amount' : 'stock_amount',
+}
+
+MARKET_SNAPSHOT_FIELDS = {
+    'resource_id' : 'resource_id',
+    'resource_name' : 'resource_name',
+    'best_bid' : 'best_bid',
+    'best_ask' : 'best_ask',
+    'avg_buy_price' : 'avg_buy_price',
+    'avg_sell_price' : 'avg_sell_price',
+    'avg_transaction_price' : 'avg_transaction_price',
+    'traded_volume' : 'traded_volume',
+    'buy_offers' : 'buy_count',
+    'sell_offers' : 'sell_count',
+    'transactions' : 'trade_count',
+}
+
+# ranks nested under 'popularity' in the snapshot
+MARKET_POPULARITY_FIELDS = {
+    'buy_offers' : 'buy_rank',
+    'sell_offers' : 'sell_rank',
+    'transactions' : 'trade_rank',
+}
+
+CANDLE_FIELDS = {
+    'time' : 'bucket_start',
+    'open' : 'open',
+    'high' : 'high',
+    'low' : 'low',
+    'close' : 'close',
+    'volume' : 'volume',
+}
+
+STATISTICS_FIELDS = {
+    'resource' : 'p.resource_id',
+    'time' : 'p.timestamp',
+    'price' : 'p.price',
+}
+
+POPULARITY_COUNTS = {
+    'sell_offers' : GET_SELL_OFFER_COUNTS,
+    'buy_offers' : GET_BUY_OFFER_COUNTS,
+    'transactions' : GET_TRANSACTION_COUNTS,
+}
+
+WINDOW_UNITS = {'m' : 'minutes', 'h' : 'hours', 'd' : 'days'}
+
+CANDLE_INTERVALS = {'1m' : timedelta(minutes=1), '1h' : timedelta(hours=1), '1d' : timedelta(days=1)}
+DEFAULT_CANDLES = 500
+MAX_CANDLES = 5000
+MAX_POPULAR_RESOURCES = 100
+
+DEFAULT_PAGE_SIZE = int(os.getenv("DEFAULT_PAGE_SIZE", 100))
+MAX_PAGE_SIZE = int(os.getenv("MAX_PAGE_SIZE", 1000))
+STREAM_BATCH_SIZE = int(os.getenv("STREAM_BATCH_SIZE", 2000))
+
+OFFER_BATCH_FIELDS = ('resource_id', 'quantity', 'price_per_ton', 'offer_start_date', 'offer_end_date', 'min_amount')
+MAX_OFFER_BATCH = int(os.getenv("MAX_OFFER_BATCH", 1000))
+
+OFFER_PATCH_FIELDS = ('quantity', 'price_per_ton', 'offer_end_date', 'min_amount')
+COMPANY_PATCH_FIELDS = ('company_name', 'company_mail')
+
+# background price snapshots, an interval of 0 leaves it to POST /gather_price_data
+PRICE_SNAPSHOT_INTERVAL = float(os.getenv("PRICE_SNAPSHOT_INTERVAL", 60))
+PRICE_SNAPSHOT_JITTER = float(os.getenv("PRICE_SNAPSHOT_JITTER", 5))
+PRICE_SNAPSHOT_LOCK_KEY = 7301002
+
+# monthly partitions are created PARTITION_MONTHS_AHEAD in advance; raw price
+# ticks older than PRICE_STATISTICS_RETENTION_DAYS are kept only as 1h/1d
+# candles, transactions are dropped after TRANSACTIONS_RETENTION_DAYS (0 keeps them)
+PARTITION_MAINTENANCE_INTERVAL = float(os.getenv("PARTITION_MAINTENANCE_INTERVAL", 3600))
+PARTITION_MONTHS_AHEAD = int(os.getenv("PARTITION_MONTHS_AHEAD", 3))
+PRICE_STATISTICS_RETENTION_DAYS = int(os.getenv("PRICE_STATISTICS_RETENTION_DAYS", 365))
+TRANSACTIONS_RETENTION_DAYS = int(os.getenv("TRANSACTIONS_RETENTION_DAYS", 0))
+ACTIVITY_RETENTION_DAYS = 90
+PARTITION_MAINTENANCE_LOCK_KEY = 7301003
+
+# expired offers are archived every OFFER_EXPIRY_INTERVAL seconds (0 turns the
+# sweeper off), at most OFFER_EXPIRY_BATCH per side and transaction
+OFFER_EXPIRY_INTERVAL = float(os.getenv("OFFER_EXPIRY_INTERVAL", 60))
+OFFER_EXPIRY_BATCH = int(os.getenv("OFFER_EXPIRY_BATCH", 5000))
+OFFER_EXPIRY_MAX_BATCHES = 20
+OFFER_EXPIRY_LOCK_KEY = 7301004
+
+# cached responses of the public read-only routes, RESPONSE_CACHE_SIZE=0 turns
+# the cache off and RESPONSE_CACHE_URL=redis://... shares it between workers
+RESPONSE_CACHE_SIZE = int(os.getenv("RESPONSE_CACHE_SIZE", 1024))
+RESPONSE_CACHE_TTL = float(os.getenv("RESPONSE_CACHE_TTL", 30))
+RESPONSE_CACHE_URL = os.getenv("RESPONSE_CACHE_URL")
+
+# pushed feed of committed offer, transaction and price events on GET /events;
+# EVENT_FEED=0 turns it off together with the NOTIFY sent by every write
+EVENT_FEED = os.getenv("EVENT_FEED", "1") != "0"
+EVENT_QUEUE_SIZE = int(os.getenv("EVENT_QUEUE_SIZE", 256))
+MAX_EVENT_SUBSCRIBERS = int(os.getenv("MAX_EVENT_SUBSCRIBERS", 1000))
+EVENT_KEEPALIVE = float(os.getenv("EVENT_KEEPALIVE", 15))
+
+# pending migrations are applied when a worker starts, under the same advisory
+# lock as `flask migrate`; DB_MIGRATE_ON_START=0 leaves them to the deploy
+MIGRATE_ON_START = os.getenv("DB_MIGRATE_ON_START", "1") != "0"
+
+# The password hashing processes of `flask seed` are spawned and import the
+# main module again, which is this file when the server runs as `python app.py`.
+# They only need its functions: no pooled connections, no background jobs.
+HELPER_PROCESS = __name__ == '__mp_main__'
 
 app = Flask(__name__)
+install_json_provider(app)
 url = os.getenv("DATABASE_URL")
-connection = psycopg2.connect(url)
+
+response_cache = create_response_cache(RESPONSE_CACHE_SIZE, RESPONSE_CACHE_TTL, RESPONSE_CACHE_URL)
+response_cache.init_app(app)
+
+event_bus = EventBus(url, EVENT_QUEUE_SIZE, MAX_EVENT_SUBSCRIBERS, EVENT_FEED)
+
+# point lookups and single-row writes are prepared once per
+# pooled connection. Turn it off with DB_PREPARED_STATEMENTS=0 when running
+# behind a transaction-mode pooler that does not keep sessions together.
+PREPARED_STATEMENTS = os.getenv("DB_PREPARED_STATEMENTS", "1") != "0"
+
+statement_registry.register(
+    SELECT_ONE_COMPANY, SELECT_ONE_BUY_OFFER, SELECT_ONE_SELL_OFFER,
+    SELECT_ONE_TRANSACTION, SELECT_ONE_COMPANY_RESOURCE,
+    DELETE_TRANSACTION,
+    SELECT_SELL_OFFER_FOR_UPDATE, ADD_ACCOUNT_BALANCE,
+    INSERT_INTO_BUY_OFFERS, INSERT_INTO_SELL_OFFERS, INSERT_INTO_TRANSACTIONS, INSERT_INTO_COMPANY_RESOURCES,
+    SELECT_SELL_OFFERS_OF_RESOURCE, SELECT_BUY_OFFERS_OF_RESOURCE, FILL_SELL_OFFER, FILL_BUY_OFFER,
+    ADD_COMPANY_RESOURCE_STOCK, TAKE_COMPANY_RESOURCE_STOCK,
+    GET_AVG_TRANSACTION_RESOURCE_PRICE_PER_TON, GET_AVG_TRANSACTION_RESOURCE_QUANTITY,
+    GET_SUM_QUANTITY_OF_RESOURCE_TRANSACTION, GET_AVG_SELL_OFFER_RESOURCE_PRICE_PER_TON,
+    GET_MIN_SELL_OFFER_RESOURCE_PRICE_PER_TON, GET_AVG_BUY_OFFER_RESOURCE_PRICE_PER_TON,
+    GET_MAX_BUY_OFFER_RESOURCE_PRICE_PER_TON,
+)
+
+pool = ConnectionPool(url,
+                      minconn=0 if HELPER_PROCESS else int(os.getenv("DB_POOL_MIN", 1)),
+                      maxconn=int(os.getenv("DB_POOL_MAX", 10)),
+                      timeout=float(os.getenv("DB_POOL_TIMEOUT", 30)),
+                      connection_factory=PreparingConnection if PREPARED_STATEMENTS else None)
+
+
+# The aggregate routes, the market snapshot and the background jobs read
+# tables created by the migrations. A database that was never initialized has
+# nothing to migrate yet, /initialize creates the tables and migrates it.
+def migrate_on_start():
+    try:
+        with pool.connection() as connection:
+            with connection:
+                with connection.cursor() as cursor:
+                    versions = apply_migrations(cursor)
+    except psycopg2.Error:
+        logger.warning("migrations were not applied, run `flask migrate` once the database is initialized", exc_info=True)
+        return
+
+    if versions:
+        logger.info("applied migrations %s", ", ".join(str(version) for version in versions))
+
+
+if MIGRATE_ON_START and not HELPER_PROCESS:
+    migrate_on_start()
+
+resource_registry = ResourceRegistry(pool)
+if not HELPER_PROCESS:
+    resource_registry.preload()
 
 app.config['SECRET_KEY'] = 'key'
 
-if __name__ == '__main__':
-    app.run(debug=True)
+# backend pids of the sessions this worker has checked out, the order books
+# skip the feed events published through them
+own_backends = set()
+
+
+# checks a pooled connection out for the current request, it is given back in release_db
+def get_db():
+    if 'db' not in g:
+        g.db = pool.getconn()
+        own_backends.add(g.db.get_backend_pid())
+    return g.db
+
+
+@app.teardown_appcontext
+def release_db(exception):
+    connection = g.pop('db', None)
+    if connection is not None:
+        broken = isinstance(exception, (psycopg2.OperationalError, psycopg2.InterfaceError))
+        pool.putconn(connection, close=broken)
+
 
 def token_required(f):
     @wraps(f)
@@ -241,35 +662,452 @@ def token_required(f):
 
         try:
             data = jwt.decode(token, app.config['SECRET_KEY'], algorithms=["HS256"])
-            with connection:
-                with connection.cursor() as cursor:
-                    cursor.execute(SELECT_ONE_COMPANY, (data['public_id'], ))
-                    current_company = cursor.fetchall()[0]
+            current_company = load_company(data['public_id'])
         except:
             return jsonify({'message' : 'Token is invalid'}), 401
         return f(current_company, *args, **kwargs)            
     return decorated
 
 
+# company rows of authenticated callers, keyed by public_id. The row carries
+# the internal company_id (index 0) and the admin flag (index 6), so the
+# common authenticated request does not touch the database at all.
+company_cache = TTLCache(maxsize=int(os.getenv("COMPANY_CACHE_SIZE", 10000)),
+                         ttl=float(os.getenv("COMPANY_CACHE_TTL", 60)))
+
+
+def load_company(public_id):
+    company = company_cache.get(public_id)
+    if company is None:
+        with get_db() as connection:
+            with connection.cursor() as cursor:
+                cursor.execute(SELECT_ONE_COMPANY, (public_id, ))
+                company = cursor.fetchall()[0]
+        company_cache.set(public_id, company)
+    return company
+
+
 def is_admin(public_id):
-    with connection:
-        with connection.cursor() as cursor:
-            cursor.execute(SELECT_IS_ADMIN_FROM_COMPANIES, (public_id, ))
-            is_admin = cursor.fetchall()[0][0]
-            
-            if bool(is_admin) != True:
-                return False
-            else:
-                return True    
+    return bool(load_company(public_id)[6])
+
 
 def get_company_id(public_id):
-    with connection:
-        with connection.cursor() as cursor:
-            cursor.execute(SELECT_COMPANY_ID, (public_id, ))
-            cid = cursor.fetchall()[0][0]
+    return load_company(public_id)[0]
+
+
+matching_engine = MatchingEngine()
+
+
+# Books follow the writes of other workers through the event feed: an offer
+# event, or a transaction that filled offers, published by a session of some
+# other worker marks the book of its resource stale. An event only arrives
+# after its commit, so a match can still run first; its fills are checked
+# against the rows and the book is reloaded when they disagree. /initialize
+# and seeding publish a reset for all books. Expired offers already drop out
+# of the books on their own.
+def follow_market_event(pid, event):
+    if pid in own_backends or event.get('action') == 'expired':
+        return
+    if event['type'] in (SELL + '_offer', BUY + '_offer') or event.get('sell_offer_id') or event.get('buy_offer_id'):
+        matching_engine.invalidate(event.get('resource_id'))
+
+
+# without the feed, or while its listener is reconnecting, nothing tells a
+# book about other workers' writes and every match reloads it
+books_follow_feed = not HELPER_PROCESS and event_bus.watch(follow_market_event, matching_engine.invalidate)
+
+
+def book_is_current(book):
+    return not book.stale and books_follow_feed and event_bus.listening()
+
+
+# tells the books of every worker that the offer tables were rewritten
+def publish_book_reset(cursor):
+    event_bus.publish(cursor, *[{'type' : side + '_offer', 'action' : 'reset', 'resource_id' : None} for side in (SELL, BUY)])
+
+
+def adjust_stock(cursor, company_id, resource_id, amount):
+    cursor.execute(ADD_COMPANY_RESOURCE_STOCK, (amount, company_id, resource_id))
+    if cursor.fetchone() is None:
+        cursor.execute(INSERT_INTO_COMPANY_RESOURCES, (company_id, resource_id, amount))
+
+
+# False when the company holds less than amount, nothing is taken then
+def take_stock(cursor, company_id, resource_id, amount):
+    cursor.execute(TAKE_COMPANY_RESOURCE_STOCK, (amount, company_id, resource_id, amount))
+    return cursor.fetchone() is not None
+
+
+OFFER_EVENT_FIELDS = {SELL : tuple(SELL_OFFER_FIELDS), BUY : tuple(BUY_OFFER_FIELDS)}
+
+
+def offer_event(side, action, offer):
+    return {'type' : side + '_offer', 'action' : action, 'resource_id' : offer[2], 'offer' : dict(zip(OFFER_EVENT_FIELDS[side], offer))}
+
+
+# the companies are left out, /events is public and /transactions is not
+def transaction_event(transaction_id, resource_id, quantity, price_per_ton, transaction_time, sell_offer_id=None, buy_offer_id=None):
+    return {'type' : 'transaction', 'action' : 'created', 'resource_id' : resource_id, 'transaction_id' : transaction_id,
+            'quantity' : quantity, 'price_per_ton' : price_per_ton, 'transaction_time' : transaction_time,
+            'sell_offer_id' : sell_offer_id, 'buy_offer_id' : buy_offer_id}
+
+
+# Writes one fill: the buyer pays the seller, the stock moves and the offers
+# shrink. Balances are changed in company_id order like in settle_purchase.
+# Raises Unsettled when the buyer cannot pay or the seller does not hold the
+# stock, the caller rolls the fill back then. The public_ids of the companies
+# whose balance changed are appended to public_ids
+def settle_fill(cursor, fill, transaction_time, public_ids):
+    cost = fill.quantity * fill.price_per_ton
+    for company_id, delta in sorted(((fill.buyer_id, -cost), (fill.seller_id, cost))):
+        cursor.execute(ADD_ACCOUNT_BALANCE, (delta, company_id, delta, delta))
+        company = cursor.fetchone()
+        if company is None:
+            raise Unsettled(BUY if company_id == fill.buyer_id else SELL, "company %s cannot settle %s" % (company_id, cost))
+        public_ids.append(company[0])
+
+    if not take_stock(cursor, fill.seller_id, fill.resource_id, fill.quantity):
+        raise Unsettled(SELL, "company %s holds less than %s tons" % (fill.seller_id, fill.quantity))
+    adjust_stock(cursor, fill.buyer_id, fill.resource_id, fill.quantity)
+
+    cursor.execute(INSERT_INTO_TRANSACTIONS, (fill.buyer_id, fill.seller_id, fill.resource_id, fill.quantity, fill.price_per_ton, transaction_time))
+    transaction_id = cursor.fetchone()[0]
+
+    for query, offer_id in ((FILL_SELL_OFFER, fill.sell_offer_id), (FILL_BUY_OFFER, fill.buy_offer_id)):
+        cursor.execute(query, (fill.quantity, offer_id, fill.quantity))
+        if cursor.fetchone() is None:
+            raise StaleBook("offer %s no longer holds %s tons" % (offer_id, fill.quantity))
+
+    return transaction_id
+
+
+# settle callback for the order books, every fill gets its own savepoint so
+# an unsettled one is undone without the fills before it. The transaction
+# ids of the settled fills are appended to transaction_ids in fill order
+def fill_settler(cursor, transaction_time, transaction_ids, public_ids):
+    def settle(fill):
+        cursor.execute(SAVEPOINT_FILL)
+        try:
+            transaction_id = settle_fill(cursor, fill, transaction_time, public_ids)
+        except Unsettled:
+            cursor.execute(ROLLBACK_TO_FILL)
+            raise
+        cursor.execute(RELEASE_FILL)
+        transaction_ids.append(transaction_id)
+    return settle
+
+
+# Buys amount tons straight from a sell offer in one transaction: the offer row
+# is locked, checked, and the balances, stock, offer and transaction are written
+# together. The book of the resource is held like in match_offer, so the
+# matcher never sees the offer with its old quantity. Balances are changed in
+# company_id order to keep concurrent purchases from deadlocking each other.
+# Raises LookupError for a missing offer and ValueError for a rejected purchase
+def settle_purchase(connection, sell_offer_id, buyer_id, amount):
+    with connection.cursor() as cursor:
+        cursor.execute(SELECT_ONE_SELL_OFFER, (sell_offer_id, ))
+        offer = cursor.fetchone()
+    if offer is None:
+        raise LookupError("No sell_offer with given ID")
+
+    book = matching_engine.book(offer[2])
+    public_ids = []
+
+    with book.lock:
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute(SELECT_SELL_OFFER_FOR_UPDATE, (sell_offer_id, ))
+                offer = cursor.fetchone()
+                if offer is None:
+                    raise LookupError("No sell_offer with given ID")
+
+                order = Order.from_row(SELL, offer)
+                now = datetime.now()
+                if order.company_id == buyer_id:
+                    raise ValueError("Cannot buy from your own sell offer")
+                if order.is_expired(now) or (order.offer_start_date is not None and order.offer_start_date > now):
+                    raise ValueError("Sell offer is not active")
+                if amount > order.quantity + EPSILON:
+                    raise ValueError("Only %s tons left in this sell offer" % order.quantity)
+                if amount < order.min_fill():
+                    raise ValueError("Minimum amount for this sell offer is %s" % order.min_fill())
+
+                amount = min(amount, order.quantity)
+                cost = amount * order.price_per_ton
+
+                for company_id, delta in sorted(((buyer_id, -cost), (order.company_id, cost))):
+                    cursor.execute(ADD_ACCOUNT_BALANCE, (delta, company_id, delta, delta))
+                    company = cursor.fetchone()
+                    if company is None:
+                        raise ValueError("Insufficient account balance")
+                    public_ids.append(company[0])
+
+                cursor.execute(INSERT_INTO_TRANSACTIONS, (buyer_id, order.company_id, order.resource_id, amount, order.price_per_ton, now))
+                transaction_id = cursor.fetchone()[0]
+
+                cursor.execute(FILL_SELL_OFFER, (amount, sell_offer_id, amount))
+                cursor.execute(DELETE_FILLED_SELL_OFFERS, ([sell_offer_id], ))
+                if not take_stock(cursor, order.company_id, order.resource_id, amount):
+                    raise ValueError("The seller no longer holds %s tons of this resource" % amount)
+                adjust_stock(cursor, buyer_id, order.resource_id, amount)
+                event_bus.publish(cursor, transaction_event(transaction_id, order.resource_id, amount, order.price_per_ton, now,
+                                                            sell_offer_id=sell_offer_id))
+            connection.commit()
+        except Exception:
+            connection.rollback()
+            raise
+
+        matching_engine.fill(book, SELL, sell_offer_id, amount)
+
+    response_cache.mark_changed('sell_offers', 'transactions')
+    for public_id in public_ids:
+        company_cache.invalidate(public_id)
+
+    return transaction_id, amount, order.price_per_ton
+
+
+# Locks the books of the given resources in resource order, so two writers
+# never wait on each other. Offer rows are only written under the lock of their
+# book: the offer triggers row-lock market_summary, and a writer holding that
+# row while it waits for the book deadlocks with a match that holds the book
+# and settles into the same row. The locks are re-entrant, a create path takes
+# them before its INSERT and match_offers takes them again.
+@contextmanager
+def book_locks(resource_ids):
+    books = [matching_engine.book(resource_id) for resource_id in sorted(set(int(resource_id) for resource_id in resource_ids))]
+    with ExitStack() as stack:
+        for book in books:
+            stack.enter_context(book.lock)
+        yield books
+
+
+# reloads a book from the tables, leaving out the offers of side that are
+# about to be submitted; returns the fills of the crossed offers it matched
+def reload_book(cursor, book, side, pending, now, settle):
+    book.stale = False
+    cursor.execute(SELECT_SELL_OFFERS_OF_RESOURCE, (book.resource_id, ))
+    sell_offers = [row for row in cursor.fetchall() if side != SELL or row[0] not in pending]
+    cursor.execute(SELECT_BUY_OFFERS_OF_RESOURCE, (book.resource_id, ))
+    buy_offers = [row for row in cursor.fetchall() if side != BUY or row[0] not in pending]
+    return matching_engine.load(book, sell_offers, buy_offers, now, settle)
+
+
+# matches freshly written offer rows against the order books of their
+# resources. The books stay locked until the fills are committed together with
+# the offers, in one transaction. An offer whose fills find the rows changed
+# behind its book is rolled back on its own and matched again against the
+# reloaded book. If anything else fails all of it is rolled back and the
+# books are marked stale and reloaded from the tables on next use.
+# Each offer is published as written, followed by the transactions of its fills
+def match_offers(connection, side, offers, action='created'):
+    transaction_ids = []
+    public_ids = []
+    traded = False
+    pending = set(offer[0] for offer in offers)
+
+    with book_locks(offer[2] for offer in offers) as books:
+        try:
+            with connection.cursor() as cursor:
+                for offer in offers:
+                    book = matching_engine.book(offer[2])
+                    dt = datetime.now()
+
+                    for attempt in range(MATCH_ATTEMPTS):
+                        offer_transaction_ids = []
+                        settle = fill_settler(cursor, dt, offer_transaction_ids, public_ids)
+                        cursor.execute(SAVEPOINT_MATCH)
+                        try:
+                            fills = [] if book_is_current(book) else reload_book(cursor, book, side, pending, dt, settle)
+                            fills += matching_engine.submit(book, Order.from_row(side, offer), dt, settle)
+                        except StaleBook:
+                            if attempt + 1 == MATCH_ATTEMPTS:
+                                raise
+                            cursor.execute(ROLLBACK_TO_MATCH)
+                            book.stale = True
+                            continue
+                        cursor.execute(RELEASE_MATCH)
+                        break
+                    pending.discard(offer[0])
+
+                    if fills:
+                        cursor.execute(DELETE_FILLED_SELL_OFFERS, ([fill.sell_offer_id for fill in fills], ))
+                        cursor.execute(DELETE_FILLED_BUY_OFFERS, ([fill.buy_offer_id for fill in fills], ))
+                        traded = True
+
+                    event_bus.publish(cursor, offer_event(side, action, offer), *[
+                        transaction_event(transaction_id, fill.resource_id, fill.quantity, fill.price_per_ton, dt,
+                                          sell_offer_id=fill.sell_offer_id, buy_offer_id=fill.buy_offer_id)
+                        for fill, transaction_id in zip(fills, offer_transaction_ids)])
+                    transaction_ids.extend(offer_transaction_ids)
+            connection.commit()
+        except Exception:
+            connection.rollback()
+            for book in books:
+                book.stale = True
+            raise
+
+    response_cache.mark_changed(side + '_offers')
+    if traded:
+        response_cache.mark_changed('buy_offers', 'sell_offers', 'transactions')
+    for public_id in set(public_ids):
+        company_cache.invalidate(public_id)
+    return transaction_ids
+
+
+def match_offer(connection, side, offer, action='created'):
+    return match_offers(connection, side, [offer], action)
+
+
+@app.cli.command('migrate')
+def migrate_command():
+    with pool.connection() as connection:
+        with connection:
+            with connection.cursor() as cursor:
+                versions = apply_migrations(cursor)
+
+    if versions:
+        print("Applied migrations: " + ", ".join(str(version) for version in versions))
+    else:
+        print("Database schema is up to date")
+
+
+@app.cli.command('seed')
+@click.option('--scale', default=1, help='Size of the data set, 1 means 1000 companies and 10000 offers per side.')
+@click.option('--workers', default=None, type=int, help='Password hashing processes, defaults to the number of CPUs.')
+def seed_command(scale, workers):
+    with pool.connection() as connection:
+        with connection:
+            with connection.cursor() as cursor:
+                counts = seed_bulk(cursor, scale, workers=workers)
+                publish_book_reset(cursor)
+
+    for table, count in counts.items():
+        print("%s: %s rows" % (table, count))
+
+
+# parses ?n=<count>&window=<number><m|h|d>, raises ValueError on bad input
+def read_popularity_args():
+    n = int(request.args.get('n', 3))
+    if n < 1 or n > MAX_POPULAR_RESOURCES:
+        raise ValueError("n has to be between 1 and %s" % MAX_POPULAR_RESOURCES)
+
+    window = request.args.get('window')
+    if window is None:
+        return n, None
+
+    match = re.fullmatch(r'(\d+)([mhd])', window)
+    if not match:
+        raise ValueError("window has to look like 30m, 24h or 7d")
+    return n, timedelta(**{WINDOW_UNITS[match.group(2)] : int(match.group(1))})
+
+
+# top n resources by number of rows of kind, answered from counters instead of
+# a group by over the table; windows are rounded to whole hours
+def most_popular(cursor, kind, n, window):
+    if window is None:
+        cursor.execute(POPULARITY_COUNTS[kind])
+    else:
+        cursor.execute(GET_ACTIVITY_COUNTS, (kind, datetime.now() - window))
+
+    top = heapq.nlargest(n, cursor.fetchall(), key=lambda row: (row[1], -row[0]))
+
+    resource_data = {}
+    for rank, row in enumerate(top, 1):
+        resource_data[str(rank)] = (row[0], )
+    return resource_data
+
+
+def popularity_response(kind, key_out):
+    try:
+        n, window = read_popularity_args()
+    except ValueError:
+        return jsonify( {'error' : "Use n=1..%s and window=<number><m|h|d>" % MAX_POPULAR_RESOURCES}), 400
+
+    with get_db() as connection:
+        with connection.cursor() as cursor: 
+            try:    
+                resource_data = most_popular(cursor, kind, n, window)
+            except (Exception, psycopg2.Error):
+                return jsonify( {'error' : "error while fetching date from a database"}) 
+
+    return jsonify( {key_out : resource_data} )
+
+
+# reads ?after=<id>&limit=<n>&fields=a,b from the query string, raises ValueError on bad input
+def read_page_args(fields):
+    after = int(request.args.get('after', 0))
+    limit = int(request.args.get('limit', DEFAULT_PAGE_SIZE))
+    if limit < 1 or limit > MAX_PAGE_SIZE:
+        raise ValueError("limit has to be between 1 and %s" % MAX_PAGE_SIZE)
+
+    keys = list(fields)
+    if request.args.get('fields'):
+        keys = request.args['fields'].split(',')
+        if any(key not in fields for key in keys):
+            raise ValueError("unknown field")
+
+    return after, limit, keys
+
+
+# returns one page of rows as dicts and the id to pass as ?after= for the next one
+def fetch_page(cursor, query, fields, keys, after, limit, resolve=None):
+    columns = ', '.join(fields[key] for key in keys)
+    cursor.execute(query.format(columns=columns), (after, limit))
+    rows = cursor.fetchall()
+
+    mapper = row_mapper(cursor, dict((key, fields[key]) for key in keys))
+    output = [mapper(row) for row in rows]
+    if resolve is not None:
+        output = [resolve(data) for data in output]
+    next_after = rows[-1][0] if len(rows) == limit else None
+
+    return output, next_after
+
+
+# Streams every row of query as NDJSON (stream=ndjson) or as one chunked JSON
+# document (stream=json). Rows come from a named server-side cursor in batches
+# of STREAM_BATCH_SIZE, so memory use does not grow with the table. The
+# generator checks out its own pooled connection because it outlives the view.
+def stream_rows(query, fields, keys, after, mode, key_out, resolve=None):
+    columns = ', '.join(fields[key] for key in keys)
+
+    def generate():
+        with pool.connection() as connection:
+            with connection:
+                with connection.cursor(name='export_' + uuid.uuid4().hex) as cursor:
+                    cursor.itersize = STREAM_BATCH_SIZE
+                    cursor.execute(query.format(columns=columns), (after, ))
+
+                    if mode == 'json':
+                        yield '{"%s": [' % key_out
+                    separator = ''
+
+                    while True:
+                        rows = cursor.fetchmany(STREAM_BATCH_SIZE)
+                        if not rows:
+                            break
+
+                        mapper = row_mapper(cursor, dict((key, fields[key]) for key in keys))
+                        output = [mapper(row) for row in rows]
+                        if resolve is not None:
+                            output = [resolve(data) for data in output]
+                        chunk = [app.json.dumps(data) for data in output]
+                        if mode == 'ndjson':
+                            yield '\n'.join(chunk) + '\n'
+                        else:
+                            yield separator + ','.join(chunk)
+                            separator = ','
+
+                    if mode == 'json':
+                        yield ']}'
+
+    mimetype = 'application/x-ndjson' if mode == 'ndjson' else 'application/json'
+    return Response(generate(), mimetype=mimetype)
+
+
+def invalid_page_args():
+    return jsonify( {'error' : "Invalid pagination parameters, use after=<id>, limit=1..%s and fields=<comma separated names>" % MAX_PAGE_SIZE}), 400
 
-            return cid
-            
 
 @app.route('/login')
 def login():
@@ -278,7 +1116,7 @@ def login():
     if not auth or not auth.username or not auth.password:
         return make_response('Could not verify', 401, {'WWW-Authenticate' : 'basic realm="Login required"'})
 
-    with connection:
+    with get_db() as connection:
         with connection.cursor() as cursor:
             cursor.execute(SELECT_COMPANY_BY_NAME, (auth.username, ))
             company = cursor.fetchall()[0]
@@ -304,7 +1142,11 @@ def initialize_db(current_company):
     if not is_admin(public_id):
         return jsonify({'message' : 'Cannot perform that function, you have to be an admin'}) 
 
-    with connection:
+    # ?scale=<n> loads a synthetic load-test data set instead of the sample one
+    scale = request.args.get('scale', 0, type=int)
+    response_cache.mark_changed('resources', 'buy_offers', 'sell_offers', 'transactions', 'statistics')
+
+    with get_db() as connection:
         with connection.cursor() as cursor:
             cursor.execute(CREATE_COMPANIES_TABLE)
             cursor.execute(CREATE_RESOURCES_TABLE)
@@ -313,6 +1155,15 @@ def initialize_db(current_company):
             cursor.execute(CREATE_BUY_OFFERS_TABLE)
             cursor.execute(CREATE_TRANSACTIONS_TABLE)
             cursor.execute(CREATE_STATISTICS_TABLE)
+            apply_migrations(cursor)
+
+            if scale > 0:
+                counts = seed_bulk(cursor, scale)
+                publish_book_reset(cursor)
+                connection.commit()
+                matching_engine.invalidate()
+                resource_registry.invalidate()
+                return {"message" : "bulk initialization successful", "rows" : counts}, 201
 
             with open("./text_documents/companies.txt", "r") as companies_f:
                 companies = companies_f.read().split('\n')
@@ -402,7 +1253,10 @@ def initialize_db(current_company):
                 cursor.execute(INSERT_INTO_COMPANY_RESOURCES, (company_id, resource_id, stock_amount))
 
             cursor.execute(INSERT_INTO_STATISTICS, (2, 222))    
+            publish_book_reset(cursor)
 
+    matching_engine.invalidate()
+    resource_registry.invalidate()
     return {"message" : "initialization successful"}, 201 
 
 
@@ -414,32 +1268,21 @@ def get_all_companies(current_company):
     if not is_admin(public_id):
         return jsonify({'message' : 'Cannot perform that function, you have to be an admin'})  
 
-    with connection:
+    try:
+        after, limit, keys = read_page_args(COMPANY_FIELDS)
+    except ValueError:
+        return invalid_page_args()
+
+    with get_db() as connection:
         with connection.cursor() as cursor:
             try:
-                cursor.execute(SELECT_ALL_COMPANIES)
-
-                output = []
-                companies = cursor.fetchall()
-                for company in companies:
-                    dt = datetime.now()
-                    ts = datetime.timestamp(dt)
-
-                    company_data = {}
-                    company_data['public_id'] = company[1]
-                    company_data['company_name'] = company[2]
-                    company_data['company_mail'] = company[3]
-                    company_data['account_balance'] = company[4]
-                    company_data['hassword_hash'] = company[5]
-                    company_data['is_admin'] = company[6]
-                    company_data['date'] = dt
-                    company_data['timestamp'] = ts
-                    output.append(company_data)
+                output, next_after = fetch_page(cursor, SELECT_COMPANIES_PAGE, COMPANY_FIELDS, keys, after, limit)
+                stamp_rows(output)
 
             except (Exception, psycopg2.Error):
                 return jsonify( {'error' : "Error occured while fetching data from database"})        
 
-    return jsonify( {'users' : output} )
+    return jsonify( {'users' : output, 'next_after' : next_after} )
 
 
 @app.get('/companies/<public_id>')
@@ -450,27 +1293,15 @@ def get_one_company(current_company, public_id):
     if actual_pubic_id != public_id and not is_admin(actual_pubic_id):
         return jsonify({'message' : 'Cannot perform that function, you can get only your own company data'}), 401    
 
-    with connection:
+    with get_db() as connection:
         with connection.cursor() as cursor:
             try:    
                 cursor.execute(SELECT_ONE_COMPANY, (public_id, ))
 
                 company = cursor.fetchall()[0]
 
-                dt = datetime.now()
-                ts = datetime.timestamp(dt)
-
-                output = []
-                company_data = {}
-                company_data['public_id'] = company[1]
-                company_data['company_name'] = company[2]
-                company_data['company_mail'] = company[3]
-                company_data['account_balance'] = company[4]
-                company_data['hassword_hash'] = company[5]
-                company_data['is_admin'] = company[6]
-                company_data['date'] = dt
-                company_data['timestamp'] = ts
-                output.append(company_data)
+                company_data = map_row(cursor, COMPANY_FIELDS, company)
+                output = [company_data]
 
                 return jsonify( {'company' : output} )
             except (Exception, psycopg2.Error):
@@ -486,7 +1317,7 @@ def create_company():
         hashed_password = generate_password_hash(data['password'], method='sha256')
         public_id = str(uuid.uuid4())
 
-        with connection:
+        with get_db() as connection:
             with connection.cursor() as cursor: 
                 cursor.execute(INSERT_INTO_COMPANIES, (public_id, company_name, 0, data['company_mail'], hashed_password, False))
     except (Exception, psycopg2.Error):   
@@ -498,115 +1329,127 @@ def create_company():
 @app.put('/company/promote/<public_id>')
 @token_required 
 def promote_company(current_company, public_id): 
-    public_id = current_company[1]
+    actual_public_id = current_company[1]
 
-    if not is_admin(public_id):
+    if not is_admin(actual_public_id):
         return jsonify({'message' : 'Cannot perform that function, you have to be an admin'}), 401  
 
-    with connection:
+    with get_db() as connection:
             with connection.cursor() as cursor:
                 try:
                     cursor.execute(SELECT_ONE_COMPANY, (public_id,))
                     cursor.execute(PROMOTE_COMPANY, (public_id, ))
-
-                    return jsonify( {'message' : "Update Successful"} )
                 except:
                     return jsonify( {'error' : "Error while updating record"})  
 
+    company_cache.invalidate(public_id)
+    return jsonify( {'message' : "Update Successful"} )
 
-@app.put('/change_company_name/<public_id>')
-@token_required 
-def change_company_name(current_company, public_id): 
 
-    actual_pubic_id = current_company[1]
-    if actual_pubic_id != public_id and not is_admin(actual_pubic_id):
-        return jsonify({'message' : 'Cannot perform that function, you can get only your own company data'}), 401
+# connection pool, prepared statement and event feed counters of this worker
+@app.get('/admin/db_stats')
+@token_required
+def db_stats(current_company):
+    if not is_admin(current_company[1]):
+        return jsonify({'message' : 'Cannot perform that function, you have to be an admin'}), 401
 
-    with connection:
-            with connection.cursor() as cursor:
-                try:
-                    data = request.get_json()
-                    company_name = data['company_name']
+    return jsonify({'pool' : pool.stats(), 'prepared_statements' : statement_registry.stats(), 'events' : event_bus.stats()})
 
-                    cursor.execute(SELECT_ONE_COMPANY, (public_id, ))
-                    cursor.execute(CHANGE_COMPANY_NAME, (company_name, public_id))
 
-                    return jsonify( {'message' : "Update Successful"} )
+# Reads the JSON body of a PATCH request, returns the (column, value) pairs to
+# set or None when the body is not an object of known fields
+def read_patch(allowed):
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict) or not data or any(key not in allowed for key in data):
+        return None
+    return [(key, data[key]) for key in allowed if key in data]
+
+
+# Applies (column, value) changes to a company with one UPDATE that checks
+# the caller is that company or an admin
+def update_company(current_company, public_id, changes):
+    actual_public_id = current_company[1]
+
+    with get_db() as connection:
+            with connection.cursor() as cursor:
+                try:
+                    update_owned(cursor, COMPANIES, changes, public_id, actual_public_id, is_admin(actual_public_id))
+                except NotFound:
+                    return jsonify( {'error' : "No company with given id"}), 404
+                except Forbidden:
+                    return jsonify({'message' : 'Cannot perform that function, you can change only your own company data'}), 401
                 except:
                     return jsonify( {'error' : "Error while updating record"})  
 
+    company_cache.invalidate(public_id)
+    return jsonify( {'message' : "Update Successful"} )
 
-@app.put('/change_company_mail/<public_id>')
-@token_required 
-def change_company_mail(current_company, public_id): 
 
-    actual_pubic_id = current_company[1]
-    if actual_pubic_id != public_id and not is_admin(actual_pubic_id):
-        return jsonify({'message' : 'Cannot perform that function, you can change only your own company data'}), 401
+def change_company_field(current_company, public_id, column):
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict) or column not in data:
+        return jsonify( {'error' : "Error while updating record"})
 
-    with connection:
-            with connection.cursor() as cursor:
-                try:
-                    data = request.get_json()
-                    company_mail = data['company_mail']
+    return update_company(current_company, public_id, [(column, data[column])])
 
-                    cursor.execute(SELECT_ONE_COMPANY, (public_id, ))
-                    cursor.execute(CHANGE_COMPANY_MAIL, (company_mail, public_id))
 
-                    return jsonify( {'message' : "Update Successful"} )
-                except:
-                    return jsonify( {'error' : "Error while updating record"})  
+@app.patch('/companies/<public_id>')
+@token_required
+def patch_company(current_company, public_id):
+    changes = read_patch(COMPANY_PATCH_FIELDS)
+    if changes is None:
+        return jsonify( {'error' : "Expected a JSON object with any of: " + ", ".join(COMPANY_PATCH_FIELDS)}), 400
 
+    return update_company(current_company, public_id, changes)
 
-@app.get('/resources')
-def get_all_resources():
-    with connection:
-        with connection.cursor() as cursor:
-            try:
-                cursor.execute(SELECT_ALL_RESOURCES)
 
-                output = []
-                resources = cursor.fetchall()
-                for resource in resources:
-                    dt = datetime.now()
-                    ts = datetime.timestamp(dt)
+@app.put('/change_company_name/<public_id>')
+@token_required 
+def change_company_name(current_company, public_id): 
+    return change_company_field(current_company, public_id, 'company_name')
 
-                    resource_data = {}
-                    resource_data['resource_id'] = resource[0]
-                    resource_data['resource_name'] = resource[1]
-                    resource_data['date'] = dt
-                    resource_data['timestamp'] = ts
-                    output.append(resource_data)
 
-            except (Exception, psycopg2.Error):
-                return jsonify( {'error' : "Error occured while fetching data from database"})        
+@app.put('/change_company_mail/<public_id>')
+@token_required 
+def change_company_mail(current_company, public_id): 
+    return change_company_field(current_company, public_id, 'company_mail')
+
+
+@app.get('/resources')
+@response_cache.cached('resources')
+def get_all_resources():
+    try:
+        output = [{'resource_id' : resource_id, 'resource_name' : resource_name} for resource_id, resource_name in resource_registry.all()]
+    except (Exception, psycopg2.Error):
+        return jsonify( {'error' : "Error occured while fetching data from database"})        
 
-    return jsonify( {'resources' : output} )
+    return jsonify( {'resources' : stamp_rows(output)} )
 
 
 @app.get('/resources/<resource_id>')
+@response_cache.cached('resources')
 def get_one_resource(resource_id): 
-    with connection:
-        with connection.cursor() as cursor: 
-            try:    
-                cursor.execute(SELECT_ONE_RESOURCE, (resource_id, ))
+    try:
+        resource_name = resource_registry.name(resource_id)
+    except (Exception, psycopg2.Error):
+        return jsonify( {'error' : "Error occured while fetching data from database"})
 
-                resource = cursor.fetchall()[0]
+    if resource_name is None:
+        return jsonify( {'error' : "No resource with given ID"})
 
-                dt = datetime.now()
-                ts = datetime.timestamp(dt)
+    output = stamp_rows([{'resource_id' : int(resource_id), 'resource_name' : resource_name}])
+    return jsonify( {'company' : output} )
 
-                output = []
-                resource_data = {}
-                resource_data['resource_id'] = resource[0]
-                resource_data['resource_name'] = resource[1]
-                resource_data['date'] = dt
-                resource_data['timestamp'] = ts
-                output.append(resource_data)
 
-                return jsonify( {'company' : output} )
-            except (Exception, psycopg2.Error):
-                return jsonify( {'error' : "No resource with given ID"})
+# answer for a resource_id that is not in the registry
+def unknown_resource(status=400):
+    return jsonify( {'error' : "No resource with given ID"}), status
+
+
+def resolve_resource_name(data):
+    if 'resource' in data:
+        data['resource'] = resource_registry.name(data['resource'])
+    return data
 
 
 @app.post('/resource')
@@ -621,106 +1464,76 @@ def create_resource(current_company):
         data = request.get_json()
         resource_name = data['resource_name']
 
-        with connection:
+        with get_db() as connection:
             with connection.cursor() as cursor: 
                 cursor.execute(INSERT_INTO_RESOURCES, (resource_name, ))
                 resource_id = cursor.fetchone()[0]
+                response_cache.mark_changed('resources')
     except (Exception, psycopg2.Error):   
         return jsonify( {'error' : "Error inserting data into PostgreSQL table"})
+
+    resource_registry.add(resource_id, resource_name)
     
     return jsonify({'message' : 'New resource created', 'id' : resource_id, 'name' : resource_name}), 201   
 
 
 @app.get('/buy_offers')
+@response_cache.cached('buy_offers')
 def get_all_buy_offers():
-    with connection:
+    try:
+        after, limit, keys = read_page_args(BUY_OFFER_FIELDS)
+    except ValueError:
+        return invalid_page_args()
+
+    with get_db() as connection:
         with connection.cursor() as cursor:
             try:
-                cursor.execute(SELECT_ALL_BUY_OFFERS)
-
-                output = []
-                offers = cursor.fetchall()
-                for offer in offers:
-                    dt = datetime.now()
-                    ts = datetime.timestamp(dt)
-
-                    offer_data = {}
-                    offer_data['buy_offer_id'] = offer[0]
-                    offer_data['buyer_id'] = offer[1]
-                    offer_data['resource_id'] = offer[2]
-                    offer_data['quantity'] = offer[3]
-                    offer_data['price_per_ton'] = offer[4]
-                    offer_data['offer_start_date'] = offer[5]
-                    offer_data['offer_end_date'] = offer[6]
-                    offer_data['min_amount'] = offer[7]
-                    offer_data['date'] = dt
-                    offer_data['timestamp'] = ts
-                    output.append(offer_data)
+                output, next_after = fetch_page(cursor, SELECT_BUY_OFFERS_PAGE, BUY_OFFER_FIELDS, keys, after, limit)
+                stamp_rows(output)
 
             except (Exception, psycopg2.Error):
                 return jsonify( {'error' : "Error occured while fetching data from database"})        
 
-    return jsonify( {'buy_offers' : output} )                 
+    return jsonify( {'buy_offers' : output, 'next_after' : next_after} )                 
 
 
 @app.get('/buy_offers/<buy_offer_id>')
+@response_cache.cached('buy_offers')
 def get_one_buy_offer(buy_offer_id):
-    with connection:
+    with get_db() as connection:
         with connection.cursor() as cursor: 
             try:    
                 cursor.execute(SELECT_ONE_BUY_OFFER, (buy_offer_id, ))
 
                 offer = cursor.fetchall()[0]
 
-                dt = datetime.now()
-                ts = datetime.timestamp(dt)
-
-                offer_data = {}
-                offer_data['buy_offer_id'] = offer[0]
-                offer_data['buyer_id'] = offer[1]
-                offer_data['resource_id'] = offer[2]
-                offer_data['quantity'] = offer[3]
-                offer_data['price_per_ton'] = offer[4]
-                offer_data['offer_start_date'] = offer[5]
-                offer_data['offer_end_date'] = offer[6]
-                offer_data['min_amount'] = offer[7]
-                offer_data['date'] = dt
-                offer_data['timestamp'] = ts
+                offer_data = map_row(cursor, BUY_OFFER_FIELDS, offer)
 
                 return jsonify( {'buy_offer' : offer_data} )
             except (Exception, psycopg2.Error):
                 return jsonify( {'error' : "No buy_offer with given ID"}) 
 
 
-# returns 3 resources with most buy_offers
+# returns the n (default 3) resources with most buy_offers, optionally created within ?window=
 @app.get('/buy_offers/most_popular_resources')
+@response_cache.cached('buy_offers')
 def most_popular_buy_offer_resources():
-    with connection:
-        with connection.cursor() as cursor: 
-            try:    
-                cursor.execute(GET_3_MOST_POPULAR_BUY_OFFER_PRODUCTS)
-
-                resource_ids = cursor.fetchall()
-                
-                resource_data = {}
-                resource_data['1'] = resource_ids[0]
-                resource_data['2'] = resource_ids[1]
-                resource_data['3'] = resource_ids[2]
-
-                return jsonify( {'most popular buy offer resources' : resource_data} )
-            except (Exception, psycopg2.Error):
-                return jsonify( {'error' : "error while fetching date from a database"}) 
+    return popularity_response('buy_offers', 'most popular buy offer resources')
 
 
 # returns max buy offer price per ton for a specific resource
 @app.get('/buy_offers/max_buy_price/<resource_id>')
+@response_cache.cached('buy_offers')
 def buy_max_resource_price(resource_id):
-    with connection:
+    if not resource_registry.exists(resource_id):
+        return unknown_resource(404)
+
+    with get_db() as connection:
         with connection.cursor() as cursor: 
             try:    
-                cursor.execute(GET_MAX_BUY_OFFER_RESOURCE_PRICE_PER_TON, (resource_id))
+                cursor.execute(GET_MAX_BUY_OFFER_RESOURCE_PRICE_PER_TON, (resource_id, ))
 
-                max_price = cursor.fetchall()[0]
+                max_price = cursor.fetchone() or (None, )
 
                 return jsonify( {'max_price' : max_price} )
             except (Exception, psycopg2.Error):
@@ -729,13 +1542,17 @@ def buy_max_resource_price(resource_id):
 
 # returns avg buy offer price per ton of a specified resource
 @app.get('/buy_offers/avg_price/<resource_id>')
+@response_cache.cached('buy_offers')
 def buy_avg_resource_price(resource_id):
-    with connection:
+    if not resource_registry.exists(resource_id):
+        return unknown_resource(404)
+
+    with get_db() as connection:
         with connection.cursor() as cursor: 
             try:    
-                cursor.execute(GET_AVG_BUY_OFFER_RESOURCE_PRICE_PER_TON, (resource_id))
+                cursor.execute(GET_AVG_BUY_OFFER_RESOURCE_PRICE_PER_TON, (resource_id, ))
 
-                avg_price = cursor.fetchall()[0]
+                avg_price = cursor.fetchone() or (None, )
 
                 return jsonify( {'avg_price' : avg_price} )
             except (Exception, psycopg2.Error):
@@ -751,6 +1568,8 @@ def create_buy_offer(current_company):
 
         buyer_public_id = data['buyer_id']
         resource_id = data['resource_id']
+        if not resource_registry.exists(resource_id):
+            return unknown_resource()
         quantity = data['quantity']
         price_per_ton = data['price_per_ton']
         offer_start_date = data['offer_start_date']
@@ -763,202 +1582,214 @@ def create_buy_offer(current_company):
 
         internal_company_id = get_company_id(actual_public_id)   
 
-        with connection:
-            with connection.cursor() as cursor: 
-                cursor.execute(INSERT_INTO_BUY_OFFERS, (internal_company_id, resource_id, quantity, price_per_ton, "'"+offer_start_date+"'", "'"+offer_end_date+"'", min_amount))
-                buy_offer_id = cursor.fetchone()[0]
-                
-                return jsonify({'message' : 'New buy offer created', 'id' : buy_offer_id}), 201
+        with get_db() as connection:
+            with book_locks([resource_id]):
+                with connection.cursor() as cursor: 
+                    cursor.execute(INSERT_INTO_BUY_OFFERS, (internal_company_id, resource_id, quantity, price_per_ton, "'"+offer_start_date+"'", "'"+offer_end_date+"'", min_amount))
+                    offer = cursor.fetchone()
+
+                transaction_ids = match_offer(connection, BUY, offer)
+            return jsonify({'message' : 'New buy offer created', 'id' : offer[0], 'transactions' : transaction_ids}), 201
     except (Exception, psycopg2.Error):   
         return jsonify( {'error' : "Error inserting data into PostgreSQL table"})
 
 
-@app.delete('/buy_offer/<buy_offer_id>')
-@token_required
-def delete_buy_offer(current_company, buy_offer_id):
-    with connection:
-        with connection.cursor() as cursor:       
-            try:
-                cursor.execute(GET_BUYER_ID_OF_OFFER, (buy_offer_id, ))
-                buyer_id = cursor.fetchone()[0]
-            except (Exception, psycopg2.Error):  
-                return jsonify( {'error' : "no buy offer with given id"})    
+# Inserts a JSON array of offers with one multi-row statement. The array is
+# validated and authorised once: every offer has to belong to the caller
+# unless the caller is an admin, whose offers may name any company.
+def create_offer_batch(current_company, side, owner_key, insert_query):
+    data = request.get_json(silent=True)
+    if not isinstance(data, list) or not data or len(data) > MAX_OFFER_BATCH:
+        return jsonify( {'error' : "Expected a JSON array of 1 to %s offers" % MAX_OFFER_BATCH}), 400
+
+    for index, offer in enumerate(data):
+        if not isinstance(offer, dict) or any(key not in offer for key in (owner_key, ) + OFFER_BATCH_FIELDS):
+            return jsonify( {'error' : "Offer %s is missing fields" % index}), 400
+        if not resource_registry.exists(offer['resource_id']):
+            return jsonify( {'error' : "Offer %s names an unknown resource" % index}), 400
 
-    company_id = current_company[0]        
+    actual_company_id = current_company[0]
     actual_public_id = current_company[1]
 
-    if company_id != buyer_id and not is_admin(actual_public_id):
-        return jsonify({'message' : 'Cannot perform that function, you can only delete your own buy offer'}), 401
+    owners = set(offer[owner_key] for offer in data)
+    if owners != {actual_public_id} and not is_admin(actual_public_id):
+        return jsonify({'message' : 'Cannot perform that function, you can only insert your own offers'}), 401
 
-    with connection:
-        with connection.cursor() as cursor: 
-            try:          
-                cursor.execute(DELETE_BUY_OFFER, (buy_offer_id,))
-                return jsonify( {'message' : "Delete Successful"} )
+    try:
+        with get_db() as connection:
+            with connection.cursor() as cursor:
+                company_ids = {actual_public_id : actual_company_id}
+                if owners - set(company_ids):
+                    cursor.execute(SELECT_COMPANY_IDS, (list(owners), ))
+                    company_ids.update(cursor.fetchall())
 
-            except (Exception, psycopg2.Error):   
-                return jsonify( {'error' : "Error while deleting record"})
+                unknown = owners - set(company_ids)
+                if unknown:
+                    return jsonify( {'error' : "Unknown company: " + ", ".join(sorted(unknown))}), 400
 
+                records = [(company_ids[offer[owner_key]], offer['resource_id'], offer['quantity'], offer['price_per_ton'],
+                            offer['offer_start_date'], offer['offer_end_date'], offer['min_amount']) for offer in data]
 
-@app.put('/change_buy_offer_quantity/<buy_offer_id>')
-@token_required
-def change_buy_offer_quantity(current_company, buy_offer_id): 
-    with connection:
-        with connection.cursor() as cursor:       
-            try:
-                cursor.execute(GET_SELLER_ID_OF_OFFER, (buy_offer_id, ))
-                buyer_id = cursor.fetchone()[0]
-            except (Exception, psycopg2.Error):  
-                return jsonify( {'error' : "no buy offer with given id"})    
+            with book_locks(record[1] for record in records):
+                with connection.cursor() as cursor:
+                    offers = execute_values(cursor, insert_query, records, page_size=MAX_OFFER_BATCH, fetch=True)
 
-    company_id = current_company[0]        
-    actual_public_id = current_company[1]
+                transaction_ids = match_offers(connection, side, offers)
+    except (Exception, psycopg2.Error):   
+        return jsonify( {'error' : "Error inserting data into PostgreSQL table"})
 
-    if company_id != buyer_id and not is_admin(actual_public_id):
-        return jsonify({'message' : 'Cannot perform that function, you can only change your buy offer'}), 401
-        
-    with connection:
-            with connection.cursor() as cursor:
-                try:
-                    data = request.get_json()
-                    quantity = data['quantity']
+    return jsonify({'message' : 'Offers created', 'ids' : [offer[0] for offer in offers], 'transactions' : transaction_ids}), 201
 
-                    cursor.execute(SELECT_ONE_BUY_OFFER, (buy_offer_id, ))
-                    cursor.execute(CHANGE_BUY_OFFER_QUANTITY, (quantity, buy_offer_id))
 
-                    return jsonify( {'message' : "Update Successful"} )
-                except:
-                    return jsonify( {'error' : "Error while updating record"}) 
+OFFER_TABLES = {SELL : SELL_OFFERS, BUY : BUY_OFFERS}
+SELECT_ONE_OFFER = {SELL : SELECT_ONE_SELL_OFFER, BUY : SELECT_ONE_BUY_OFFER}
 
 
-@app.put('/change_buy_offer_price_per_ton/<buy_offer_id>')
-@token_required
-def change_buy_offer_price_per_ton(current_company, buy_offer_id): 
-    with connection:
-        with connection.cursor() as cursor:       
-            try:
-                cursor.execute(GET_SELLER_ID_OF_OFFER, (buy_offer_id, ))
-                buyer_id = cursor.fetchone()[0]
-            except (Exception, psycopg2.Error):  
-                return jsonify( {'error' : "no buy offer with given id"})    
+# book of the resource an offer trades in. Writers take its lock before they
+# touch the offer row, in the same order as match_offer does, otherwise a
+# match holding the book and waiting for the row deadlocks with them. Offers
+# never change resource, so a booked offer is resolved from the engine; only
+# offers this process has not booked (another worker's, or a book not loaded
+# yet) cost the extra SELECT.
+def offer_book(cursor, side, offer_id):
+    resource_id = matching_engine.locate(side, offer_id)
+    if resource_id is None:
+        cursor.execute(SELECT_ONE_OFFER[side], (offer_id, ))
+        offer = cursor.fetchone()
+        if offer is None:
+            raise NotFound("no %s offer with id %s" % (side, offer_id))
+        resource_id = offer[2]
+    return matching_engine.book(resource_id)
 
-    company_id = current_company[0]        
-    actual_public_id = current_company[1]
 
-    if company_id != buyer_id and not is_admin(actual_public_id):
-        return jsonify({'message' : 'Cannot perform that function, you can only change your buy offer'}), 401
+# Applies (column, value) changes to an offer with one UPDATE that only
+# matches offers of the caller (or any offer for admins), then re-matches it
+def update_offer(current_company, side, offer_id, changes):
+    actual_company_id = current_company[0]
+    actual_public_id = current_company[1]
 
-    with connection:
+    with get_db() as connection:
             with connection.cursor() as cursor:
                 try:
-                    data = request.get_json()
-                    price_per_ton = data['price_per_ton']
-
-                    cursor.execute(SELECT_ONE_BUY_OFFER, (buy_offer_id, ))
-                    cursor.execute(CHANGE_BUY_OFFER_PRICE_PER_TON, (price_per_ton, buy_offer_id))
+                    with offer_book(cursor, side, offer_id).lock:
+                        offer = update_owned(cursor, OFFER_TABLES[side], changes, offer_id, actual_company_id, is_admin(actual_public_id))
+                        matching_engine.remove(side, offer_id)
+                        match_offer(connection, side, offer, 'updated')
 
                     return jsonify( {'message' : "Update Successful"} )
+                except NotFound:
+                    return jsonify( {'error' : "no %s offer with given id" % side}), 404
+                except Forbidden:
+                    return jsonify({'message' : 'Cannot perform that function, you can only change your %s offer' % side}), 401
                 except:
-                    return jsonify( {'error' : "Error while updating record"}) 
+                    return jsonify( {'error' : "Error while updating record"})
 
 
-@app.put('/change_buy_offer_end_date/<buy_offer_id>')
-@token_required
-def change_buy_offer_end_date(current_company, buy_offer_id): 
-    with connection:
-        with connection.cursor() as cursor:       
-            try:
-                cursor.execute(GET_SELLER_ID_OF_OFFER, (buy_offer_id, ))
-                buyer_id = cursor.fetchone()[0]
-            except (Exception, psycopg2.Error):  
-                return jsonify( {'error' : "no buy offer with given id"})    
+def change_offer_field(current_company, side, offer_id, column):
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict) or column not in data:
+        return jsonify( {'error' : "Error while updating record"})
+
+    return update_offer(current_company, side, offer_id, [(column, data[column])])
+
 
-    company_id = current_company[0]        
+def patch_offer(current_company, side, offer_id):
+    changes = read_patch(OFFER_PATCH_FIELDS)
+    if changes is None:
+        return jsonify( {'error' : "Expected a JSON object with any of: " + ", ".join(OFFER_PATCH_FIELDS)}), 400
+
+    return update_offer(current_company, side, offer_id, changes)
+
+
+# Deletes an offer of the caller (any offer for admins) in one statement
+def delete_offer(current_company, side, offer_id):
+    actual_company_id = current_company[0]
     actual_public_id = current_company[1]
 
-    if company_id != buyer_id and not is_admin(actual_public_id):
-        return jsonify({'message' : 'Cannot perform that function, you can only change your buy offer'}), 401
+    with get_db() as connection:
+        with connection.cursor() as cursor: 
+            try:          
+                with offer_book(cursor, side, offer_id).lock:
+                    offer = delete_owned(cursor, OFFER_TABLES[side], offer_id, actual_company_id, is_admin(actual_public_id))
+                    event_bus.publish(cursor, offer_event(side, 'deleted', offer))
+                    connection.commit()
+                    matching_engine.remove(side, offer_id)
+                response_cache.mark_changed(side + '_offers')
+                return jsonify( {'message' : "Delete Successful"} )
+            except NotFound:
+                return jsonify( {'error' : "no %s offer with given id" % side}), 404
+            except Forbidden:
+                return jsonify({'message' : 'Cannot perform that function, you can only delete your own %s offer' % side}), 401
+            except (Exception, psycopg2.Error):   
+                return jsonify( {'error' : "Error while deleting record"})
 
-    with connection:
-            with connection.cursor() as cursor:
-                try:
-                    data = request.get_json()
-                    end_date = data['offer_end_date']
 
-                    cursor.execute(SELECT_ONE_BUY_OFFER, (buy_offer_id, ))
-                    cursor.execute(CHANGE_BUY_OFFER_END_DATE, ("'"+end_date+"'", buy_offer_id))
+@app.post('/buy_offers/batch')
+@token_required
+def create_buy_offer_batch(current_company):
+    return create_offer_batch(current_company, BUY, 'buyer_id', INSERT_INTO_BUY_OFFERS_BATCH)
 
-                    return jsonify( {'message' : "Update Successful"} )
-                except:
-                    return jsonify( {'error' : "Error while updating record"}) 
 
+@app.delete('/buy_offer/<buy_offer_id>')
+@token_required
+def delete_buy_offer(current_company, buy_offer_id):
+    return delete_offer(current_company, BUY, buy_offer_id)
 
-@app.put('/change_buy_min_amount/<buy_offer_id>')
+
+@app.patch('/buy_offers/<buy_offer_id>')
 @token_required
-def change_buy_min_amount(current_company, buy_offer_id): 
-    with connection:
-        with connection.cursor() as cursor:       
-            try:
-                cursor.execute(GET_SELLER_ID_OF_OFFER, (buy_offer_id, ))
-                buyer_id = cursor.fetchone()[0]
-            except (Exception, psycopg2.Error):  
-                return jsonify( {'error' : "no buy offer with given id"})    
+def patch_buy_offer(current_company, buy_offer_id):
+    return patch_offer(current_company, BUY, buy_offer_id)
 
-    company_id = current_company[0]        
-    actual_public_id = current_company[1]
 
-    if company_id != buyer_id and not is_admin(actual_public_id):
-        return jsonify({'message' : 'Cannot perform that function, you can only change your buy offer'}), 401
+@app.put('/change_buy_offer_quantity/<buy_offer_id>')
+@token_required
+def change_buy_offer_quantity(current_company, buy_offer_id): 
+    return change_offer_field(current_company, BUY, buy_offer_id, 'quantity')
 
-    with connection:
-            with connection.cursor() as cursor:
-                try:
-                    data = request.get_json()
-                    min_amount = data['min_amount']
 
-                    cursor.execute(SELECT_ONE_BUY_OFFER, (buy_offer_id, ))
-                    cursor.execute(CHANGE_BUY_OFFER_MIN_AMOUNT, (min_amount, buy_offer_id))
+@app.put('/change_buy_offer_price_per_ton/<buy_offer_id>')
+@token_required
+def change_buy_offer_price_per_ton(current_company, buy_offer_id): 
+    return change_offer_field(current_company, BUY, buy_offer_id, 'price_per_ton')
 
-                    return jsonify( {'message' : "Update Successful"} )
-                except:
-                    return jsonify( {'error' : "Error while updating record"})                    
+
+@app.put('/change_buy_offer_end_date/<buy_offer_id>')
+@token_required
+def change_buy_offer_end_date(current_company, buy_offer_id): 
+    return change_offer_field(current_company, BUY, buy_offer_id, 'offer_end_date')
+
+
+@app.put('/change_buy_min_amount/<buy_offer_id>')
+@token_required
+def change_buy_min_amount(current_company, buy_offer_id): 
+    return change_offer_field(current_company, BUY, buy_offer_id, 'min_amount')
 
 
 @app.get('/sell_offers')
+@response_cache.cached('sell_offers')
 def get_all_sell_offers():  
-    with connection:
+    try:
+        after, limit, keys = read_page_args(SELL_OFFER_FIELDS)
+    except ValueError:
+        return invalid_page_args()
+
+    with get_db() as connection:
         with connection.cursor() as cursor:
             try:
-                cursor.execute(SELECT_ALL_SELL_OFFERS)
-
-                output = []
-                offers = cursor.fetchall()
-                for offer in offers:
-                    dt = datetime.now()
-                    ts = datetime.timestamp(dt)
-
-                    offer_data = {}
-                    offer_data['sell_offer_id'] = offer[0]
-                    offer_data['seller_id'] = offer[1]
-                    offer_data['resource_id'] = offer[2]
-                    offer_data['quantity'] = offer[3]
-                    offer_data['price_per_ton'] = offer[4]
-                    offer_data['offer_start_date'] = offer[5]
-                    offer_data['offer_end_date'] = offer[6]
-                    offer_data['min_amount'] = offer[7]
-                    offer_data['date'] = dt
-                    offer_data['timestamp'] = ts
-                    output.append(offer_data)
+                output, next_after = fetch_page(cursor, SELECT_SELL_OFFERS_PAGE, SELL_OFFER_FIELDS, keys, after, limit)
+                stamp_rows(output)
 
             except (Exception, psycopg2.Error):
                 return jsonify( {'error' : "Error occured while fetching data from database"})        
 
-    return jsonify( {'sell_offers' : output} )                 
+    return jsonify( {'sell_offers' : output, 'next_after' : next_after} )                 
 
 
 @app.get('/sell_offers/<sell_offer_id>')
+@response_cache.cached('sell_offers')
 def get_one_sell_offer(sell_offer_id):
-    with connection:
+    with get_db() as connection:
         with connection.cursor() as cursor: 
             try:    
                 
@@ -966,55 +1797,33 @@ def get_one_sell_offer(sell_offer_id):
                 
                 offer = cursor.fetchall()[0]
                 
-                dt = datetime.now()
-                ts = datetime.timestamp(dt)
-                
-                offer_data = {}
-                offer_data['sell_offer_id'] = offer[0]
-                offer_data['seller_id'] = offer[1]
-                offer_data['resource_id'] = offer[2]
-                offer_data['quantity'] = offer[3]
-                offer_data['price_per_ton'] = offer[4]
-                offer_data['offer_start_date'] = offer[5]
-                offer_data['offer_end_date'] = offer[6]
-                offer_data['min_amount'] = offer[7]
-                offer_data['date'] = dt
-                offer_data['timestamp'] = ts
+                offer_data = map_row(cursor, SELL_OFFER_FIELDS, offer)
 
                 return jsonify( {'sell_offer' : offer_data} )
             except (Exception, psycopg2.Error):
                 return jsonify( {'error' : "No sell_offer with given ID"}) 
 
 
-# returns 3 resources with most sell_offers
+# returns the n (default 3) resources with most sell_offers, optionally created within ?window=
 @app.get('/sell_offers/most_popular_resources')
+@response_cache.cached('sell_offers')
 def most_popular_sell_offer_resources():
-    with connection:
-        with connection.cursor() as cursor: 
-            try:    
-                cursor.execute(GET_3_MOST_POPULAR_SELL_OFFER_PRODUCTS)
-
-                resource_ids = cursor.fetchall()
-                
-                resource_data = {}
-                resource_data['1'] = resource_ids[0]
-                resource_data['2'] = resource_ids[1]
-                resource_data['3'] = resource_ids[2]
-
-                return jsonify( {'most popular sell offer resources' : resource_data} )
-            except (Exception, psycopg2.Error):
-                return jsonify( {'error' : "error while fetching date from a database"})
+    return popularity_response('sell_offers', 'most popular sell offer resources')
 
 
 # returns min sell offer price per ton for a specific resource
 @app.get('/sell_offers/min_sell_price/<resource_id>')
+@response_cache.cached('sell_offers')
 def sell_offer_min_sell_price(resource_id):
-    with connection:
+    if not resource_registry.exists(resource_id):
+        return unknown_resource(404)
+
+    with get_db() as connection:
         with connection.cursor() as cursor: 
             try:    
-                cursor.execute(GET_MIN_SELL_OFFER_RESOURCE_PRICE_PER_TON, (resource_id))
+                cursor.execute(GET_MIN_SELL_OFFER_RESOURCE_PRICE_PER_TON, (resource_id, ))
 
-                min_price = cursor.fetchall()[0]
+                min_price = cursor.fetchone() or (None, )
 
                 return jsonify( {'min_price' : min_price} )
             except (Exception, psycopg2.Error):
@@ -1023,13 +1832,17 @@ def sell_offer_min_sell_price(resource_id):
 
 # returns avg sell offer price per ton of a specified resource
 @app.get('/sell_offers/avg_price/<resource_id>')
+@response_cache.cached('sell_offers')
 def sell_avg_resource_price(resource_id):
-    with connection:
+    if not resource_registry.exists(resource_id):
+        return unknown_resource(404)
+
+    with get_db() as connection:
         with connection.cursor() as cursor: 
             try:    
-                cursor.execute(GET_AVG_SELL_OFFER_RESOURCE_PRICE_PER_TON, (resource_id))
+                cursor.execute(GET_AVG_SELL_OFFER_RESOURCE_PRICE_PER_TON, (resource_id, ))
 
-                avg_price = cursor.fetchall()[0]
+                avg_price = cursor.fetchone() or (None, )
 
                 return jsonify( {'avg_price' : avg_price} )
             except (Exception, psycopg2.Error):
@@ -1044,6 +1857,8 @@ def create_sell_offer(current_company):
 
         seller_public_id = data['seller_id']
         resource_id = data['resource_id']
+        if not resource_registry.exists(resource_id):
+            return unknown_resource()
         quantity = data['quantity']
         price_per_ton = data['price_per_ton']
         offer_start_date = data['offer_start_date']
@@ -1056,165 +1871,58 @@ def create_sell_offer(current_company):
 
         internal_company_id = get_company_id(actual_public_id) 
 
-        with connection:
-            with connection.cursor() as cursor: 
-                cursor.execute(INSERT_INTO_SELL_OFFERS, (internal_company_id, resource_id, quantity, price_per_ton, "'"+offer_start_date+"'", "'"+offer_end_date+"'", min_amount))
-                sell_offer_id = cursor.fetchone()[0]
-                
-                return jsonify({'message' : 'Sell offer created', 'id' : sell_offer_id}), 201
+        with get_db() as connection:
+            with book_locks([resource_id]):
+                with connection.cursor() as cursor: 
+                    cursor.execute(INSERT_INTO_SELL_OFFERS, (internal_company_id, resource_id, quantity, price_per_ton, "'"+offer_start_date+"'", "'"+offer_end_date+"'", min_amount))
+                    offer = cursor.fetchone()
+
+                transaction_ids = match_offer(connection, SELL, offer)
+            return jsonify({'message' : 'Sell offer created', 'id' : offer[0], 'transactions' : transaction_ids}), 201
     except (Exception, psycopg2.Error):   
         return jsonify( {'error' : "Error inserting data into PostgreSQL table" })
 
 
+@app.post('/sell_offers/batch')
+@token_required
+def create_sell_offer_batch(current_company):
+    return create_offer_batch(current_company, SELL, 'seller_id', INSERT_INTO_SELL_OFFERS_BATCH)
+
+
 @app.delete('/sell_offer/<sell_offer_id>')
 @token_required
 def delete_sell_offer(current_company, sell_offer_id):
-    with connection:
-        with connection.cursor() as cursor:       
-            try:
-                cursor.execute(GET_SELLER_ID_OF_OFFER, (sell_offer_id, ))
-                seller_id = cursor.fetchone()[0]
-            except (Exception, psycopg2.Error):  
-                return jsonify( {'error' : "no sell offer with given id"})    
-
-    company_id = current_company[0]        
-    actual_public_id = current_company[1]
+    return delete_offer(current_company, SELL, sell_offer_id)
 
-    if company_id != seller_id and not is_admin(actual_public_id):
-        return jsonify({'message' : 'Cannot perform that function, you can only delete your sell offer'}), 401        
 
-    with connection:
-        with connection.cursor() as cursor: 
-            try:               
-                cursor.execute(DELETE_SELL_OFFER, (sell_offer_id,))
-                return jsonify( {'message' : "Delete Successful"} )
-                
-            except (Exception, psycopg2.Error):  
-                return jsonify( {'error' : "Error while deleting record"})
+@app.patch('/sell_offers/<sell_offer_id>')
+@token_required
+def patch_sell_offer(current_company, sell_offer_id):
+    return patch_offer(current_company, SELL, sell_offer_id)
 
 
 @app.put('/change_sell_offer_quantity/<sell_offer_id>')
 @token_required
 def change_sell_offer_quantity(current_company, sell_offer_id): 
-    with connection:
-        with connection.cursor() as cursor:       
-            try:
-                cursor.execute(GET_SELLER_ID_OF_OFFER, (sell_offer_id, ))
-                seller_id = cursor.fetchone()[0]
-            except (Exception, psycopg2.Error):  
-                return jsonify( {'error' : "no sell offer with given id"})    
-
-    company_id = current_company[0]        
-    actual_public_id = current_company[1]
-
-    if company_id != seller_id and not is_admin(actual_public_id):
-        return jsonify({'message' : 'Cannot perform that function, you can only change your sell offer'}), 401
-
-    with connection:
-            with connection.cursor() as cursor:
-                try:
-                    data = request.get_json()
-                    quantity = data['quantity']
-
-                    cursor.execute(SELECT_ONE_SELL_OFFER, (sell_offer_id, ))
-                    cursor.execute(CHANGE_SELL_OFFER_QUANTITY, (quantity, sell_offer_id))
-
-                    return jsonify( {'message' : "Update Successful"} )
-                except:
-                    return jsonify( {'error' : "Error while updating record"}) 
+    return change_offer_field(current_company, SELL, sell_offer_id, 'quantity')
 
 
 @app.put('/change_sell_offer_price_per_ton/<sell_offer_id>')
 @token_required
 def change_sell_offer_price_per_ton(current_company, sell_offer_id): 
-    with connection:
-        with connection.cursor() as cursor:       
-            try:
-                cursor.execute(GET_SELLER_ID_OF_OFFER, (sell_offer_id, ))
-                seller_id = cursor.fetchone()[0]
-            except (Exception, psycopg2.Error):  
-                return jsonify( {'error' : "no sell offer with given id"})    
-
-    company_id = current_company[0]        
-    actual_public_id = current_company[1]
-
-    if company_id != seller_id and not is_admin(actual_public_id):
-        return jsonify({'message' : 'Cannot perform that function, you can only change your sell offer'}), 401
-
-    with connection:
-            with connection.cursor() as cursor:
-                try:
-                    data = request.get_json()
-                    price_per_ton = data['price_per_ton']
-
-                    cursor.execute(SELECT_ONE_SELL_OFFER, (sell_offer_id, ))
-                    cursor.execute(CHANGE_SELL_OFFER_PRICE_PER_TON, (price_per_ton, sell_offer_id))
-
-                    return jsonify( {'message' : "Update Successful"} )
-                except:
-                    return jsonify( {'error' : "Error while updating record"}) 
+    return change_offer_field(current_company, SELL, sell_offer_id, 'price_per_ton')
 
 
 @app.put('/change_sell_offer_end_date/<sell_offer_id>')
 @token_required
 def change_sell_offer_end_date(current_company, sell_offer_id): 
-    with connection:
-        with connection.cursor() as cursor:       
-            try:
-                cursor.execute(GET_SELLER_ID_OF_OFFER, (sell_offer_id, ))
-                seller_id = cursor.fetchone()[0]
-            except (Exception, psycopg2.Error):  
-                return jsonify( {'error' : "no sell offer with given id"})    
-
-    company_id = current_company[0]        
-    actual_public_id = current_company[1]
-
-    if company_id != seller_id and not is_admin(actual_public_id):
-        return jsonify({'message' : 'Cannot perform that function, you can only change your sell offer'}), 401
-
-    with connection:
-            with connection.cursor() as cursor:
-                try:
-                    data = request.get_json()
-                    end_date = data['offer_end_date']
-
-                    cursor.execute(SELECT_ONE_BUY_OFFER, (sell_offer_id, ))
-                    cursor.execute(CHANGE_BUY_OFFER_END_DATE, ("'"+end_date+"'", sell_offer_id))
-
-                    return jsonify( {'message' : "Update Successful"} )
-                except:
-                    return jsonify( {'error' : "Error while updating record"}) 
+    return change_offer_field(current_company, SELL, sell_offer_id, 'offer_end_date')
 
 
 @app.put('/change_sell_min_amount/<sell_offer_id>')
 @token_required
 def change_sell_min_amount(current_company, sell_offer_id): 
-    with connection:
-        with connection.cursor() as cursor:       
-            try:
-                cursor.execute(GET_SELLER_ID_OF_OFFER, (sell_offer_id, ))
-                seller_id = cursor.fetchone()[0]
-            except (Exception, psycopg2.Error):  
-                return jsonify( {'error' : "no sell offer with given id"})    
-
-    company_id = current_company[0]        
-    actual_public_id = current_company[1]
-
-    if company_id != seller_id and not is_admin(actual_public_id):
-        return jsonify({'message' : 'Cannot perform that function, you can only change your sell offer'}), 401 
-    
-    with connection:
-            with connection.cursor() as cursor:
-                try:
-                    data = request.get_json()
-                    min_amount = data['min_amount']
-
-                    cursor.execute(SELECT_ONE_SELL_OFFER, (sell_offer_id, ))
-                    cursor.execute(CHANGE_SELL_OFFER_MIN_AMOUNT, (min_amount, sell_offer_id))
-
-                    return jsonify( {'message' : "Update Successful"} )
-                except:
-                    return jsonify( {'error' : "Error while updating record"})   
+    return change_offer_field(current_company, SELL, sell_offer_id, 'min_amount')
 
 
 @app.get('/transactions')
@@ -1225,33 +1933,27 @@ def get_all_transactions(current_company):
     if not is_admin(public_id):
         return jsonify({'message' : 'Cannot perform that function, you have to be an admin'})   
 
-    with connection:
+    try:
+        after, limit, keys = read_page_args(TRANSACTION_FIELDS)
+    except ValueError:
+        return invalid_page_args()
+
+    mode = request.args.get('stream')
+    if mode:
+        if mode not in ('ndjson', 'json'):
+            return jsonify( {'error' : "stream has to be ndjson or json"}), 400
+        return stream_rows(SELECT_TRANSACTIONS_EXPORT, TRANSACTION_FIELDS, keys, after, mode, 'trasnactions')
+
+    with get_db() as connection:
         with connection.cursor() as cursor:
             try:
-                cursor.execute(SELECT_ALL_TRANSACTIONS)
-
-                output = []
-                transactions = cursor.fetchall()
-                for transaction in transactions:
-                    dt = datetime.now()
-                    ts = datetime.timestamp(dt)
-
-                    transaction_data = {}
-                    transaction_data['transaction_id'] = transaction[0]
-                    transaction_data['buyer_id'] = transaction[1]
-                    transaction_data['seller_id'] = transaction[2]
-                    transaction_data['resource_id'] = transaction[3]
-                    transaction_data['quantity'] = transaction[4]
-                    transaction_data['price_per_ton'] = transaction[5]
-                    transaction_data['transaction_date'] = transaction[6]
-                    transaction_data['date'] = dt
-                    transaction_data['timestamp'] = ts
-                    output.append(transaction_data)
+                output, next_after = fetch_page(cursor, SELECT_TRANSACTIONS_PAGE, TRANSACTION_FIELDS, keys, after, limit)
+                stamp_rows(output)
 
             except (Exception, psycopg2.Error):
                 return jsonify( {'error' : "Error occured while fetching data from database"})        
 
-    return jsonify( {'trasnactions' : output} )                 
+    return jsonify( {'trasnactions' : output, 'next_after' : next_after} )                 
 
 
 @app.get('/transactions/<transaction_id>')
@@ -1261,26 +1963,14 @@ def get_one_transaction(current_company, transaction_id):
     public_id = current_company[1]
     admin_check = is_admin(public_id)
 
-    with connection:
+    with get_db() as connection:
         with connection.cursor() as cursor: 
             try:    
                 cursor.execute(SELECT_ONE_TRANSACTION, (transaction_id, ))
 
                 transaction = cursor.fetchall()[0]
 
-                dt = datetime.now()
-                ts = datetime.timestamp(dt)
-
-                transaction_data = {}
-                transaction_data['transaction_id'] = transaction[0]
-                transaction_data['buyer_id'] = transaction[1]
-                transaction_data['seller_id'] = transaction[2]
-                transaction_data['resource_id'] = transaction[3]
-                transaction_data['quantity'] = transaction[4]
-                transaction_data['price_per_ton'] = transaction[5]
-                transaction_data['transaction_time'] = transaction[6]
-                transaction_data['date'] = dt
-                transaction_data['timestamp'] = ts
+                transaction_data = map_row(cursor, TRANSACTION_DETAIL_FIELDS, transaction)
 
                 if int(transaction_data['buyer_id']) != int(company_id) and int(transaction_data['seller_id']) != int(company_id) and not admin_check:
                     return jsonify({'message' : 'Cannot perform that function, you can only read transaction that you take part in'}), 401
@@ -1292,13 +1982,17 @@ def get_one_transaction(current_company, transaction_id):
 
 # returns average transaction price per ton of a specific resource
 @app.get('/transactions/avg_transaction_price/<resource_id>')
+@response_cache.cached('transactions')
 def get_avg_transaction_price(resource_id):
-    with connection:
+    if not resource_registry.exists(resource_id):
+        return unknown_resource(404)
+
+    with get_db() as connection:
         with connection.cursor() as cursor: 
             try:    
                 cursor.execute(GET_AVG_TRANSACTION_RESOURCE_PRICE_PER_TON, (resource_id, ))
 
-                avg_transaction_price = cursor.fetchall()[0]
+                avg_transaction_price = cursor.fetchone() or (None, )
 
                 return jsonify( {'avg_transaction_price' : avg_transaction_price} )
             except (Exception, psycopg2.Error):
@@ -1307,48 +2001,40 @@ def get_avg_transaction_price(resource_id):
 
 # returns sum quantity of transactions of a specific resource
 @app.get('/transactions/sum_transaction_quantity/<resource_id>')
+@response_cache.cached('transactions')
 def get_sum_transaction_quantity(resource_id):
-    with connection:
+    if not resource_registry.exists(resource_id):
+        return unknown_resource(404)
+
+    with get_db() as connection:
         with connection.cursor() as cursor: 
             try:    
                 cursor.execute(GET_SUM_QUANTITY_OF_RESOURCE_TRANSACTION, (resource_id, ))
 
-                sum_transaction_quantity = cursor.fetchall()[0]
+                sum_transaction_quantity = cursor.fetchone() or (None, )
 
                 return jsonify( {'sum_transaction_quantity' : sum_transaction_quantity} )
             except (Exception, psycopg2.Error):
                 return jsonify( {'error' : "No transaction with given ID"})  
 
 
-# returns 3 resources with most transactions
+# returns the n (default 3) resources with most transactions, optionally made within ?window=
 @app.get('/transactions/most_popular_resources')
+@response_cache.cached('transactions')
 def most_popular_transaction_resources():
-    with connection:
-        with connection.cursor() as cursor: 
-            try:    
-                cursor.execute(GET_3_MOST_POPULAR_TRANSACTION_PRODUCTS)
-
-                resource_ids = cursor.fetchall()
-                
-                resource_data = {}
-                resource_data['1'] = resource_ids[0]
-                resource_data['2'] = resource_ids[1]
-                resource_data['3'] = resource_ids[2]
-
-                return jsonify( {'most_popular_transaction_resources' : resource_data} )
-            except (Exception, psycopg2.Error):
-                return jsonify( {'error' : "error while fetching date from a database"})  
+    return popularity_response('transactions', 'most_popular_transaction_resources')
 
 
 # returns avg quantity of transactions of a specific resource
 @app.get('/transactions/avg_transaction_quantity/<transaction_id>')
+@response_cache.cached('transactions')
 def get_avg_transaction_quantity(transaction_id):
-    with connection:
+    with get_db() as connection:
         with connection.cursor() as cursor: 
             try:    
                 cursor.execute(GET_AVG_TRANSACTION_RESOURCE_QUANTITY, (transaction_id, ))
 
-                avg_transaction_quantity = cursor.fetchall()[0]
+                avg_transaction_quantity = cursor.fetchone() or (None, )
 
                 return jsonify( {'avg_transaction_price' : avg_transaction_quantity} )
             except (Exception, psycopg2.Error):
@@ -1364,6 +2050,8 @@ def create_transaction(current_company):
         buyer_id = data['buyer_id']
         seller_id = data['seller_id']
         resource_id = data['resource_id']
+        if not resource_registry.exists(resource_id):
+            return unknown_resource()
         quantity = data['quantity']
         price_per_ton = data['price_per_ton']
         transaction_time = data['transaction_time']
@@ -1373,10 +2061,12 @@ def create_transaction(current_company):
         if int(buyer_id) != int(company_id) and int(seller_id) != int(company_id) and not is_admin(public_id):
             return jsonify({'message' : 'Cannot perform that function, you can only create transaction that you take part in'}), 401
 
-        with connection:
+        with get_db() as connection:
             with connection.cursor() as cursor: 
                 cursor.execute(INSERT_INTO_TRANSACTIONS, (buyer_id, seller_id, resource_id, quantity, price_per_ton, "'"+transaction_time+"'"))
                 transaction_id = cursor.fetchone()[0]
+                event_bus.publish(cursor, transaction_event(transaction_id, int(resource_id), quantity, price_per_ton, transaction_time))
+                response_cache.mark_changed('transactions')
                 
                 return jsonify({'message' : 'transaction created', 'id' : transaction_id}), 201
     except (Exception, psycopg2.Error):   
@@ -1391,10 +2081,12 @@ def delete_transaction(current_company, transaction_id):
     if not is_admin(public_id):
         return jsonify({'message' : 'Cannot perform that function, you have to be an admin'})
 
-    with connection:
+    with get_db() as connection:
         with connection.cursor() as cursor: 
             try:          
                 cursor.execute(DELETE_TRANSACTION, (transaction_id,))
+                event_bus.publish(cursor, {'type' : 'transaction', 'action' : 'deleted', 'resource_id' : None, 'transaction_id' : int(transaction_id)})
+                response_cache.mark_changed('transactions')
                 return jsonify( {'message' : "Delete Successful"} )
                 
             except (Exception, psycopg2.Error):   
@@ -1409,30 +2101,21 @@ def get_all_company_resources(current_company):
     if not is_admin(public_id):
         return jsonify({'message' : 'Cannot perform that function, you have to be an admin'})  
                 
-    with connection:
+    try:
+        after, limit, keys = read_page_args(COMPANY_RESOURCE_FIELDS)
+    except ValueError:
+        return invalid_page_args()
+
+    with get_db() as connection:
         with connection.cursor() as cursor:
             try:
-                cursor.execute(SELECT_ALL_COMPANY_RESOURCES)
-
-                output = []
-                company_resources = cursor.fetchall()
-                for resource in company_resources:
-                    dt = datetime.now()
-                    ts = datetime.timestamp(dt)
-
-                    resource_data = {}
-                    resource_data['company_resource_id'] = resource[0]
-                    resource_data['company_id'] = resource[1]
-                    resource_data['resource_id'] = resource[2]
-                    resource_data['stock_amount'] = resource[3]
-                    resource_data['date'] = dt
-                    resource_data['timestamp'] = ts
-                    output.append(resource_data)
+                output, next_after = fetch_page(cursor, SELECT_COMPANY_RESOURCES_PAGE, COMPANY_RESOURCE_FIELDS, keys, after, limit)
+                stamp_rows(output)
 
             except (Exception, psycopg2.Error):
                 return jsonify( {'error' : "Error occured while fetching data from database"})        
 
-    return jsonify( {'company resources' : output} )                 
+    return jsonify( {'company resources' : output, 'next_after' : next_after} )                 
 
 
 @app.get('/company_resources/<company_resource_id>')
@@ -1442,23 +2125,14 @@ def get_one_company_resource(current_company, company_resource_id):
     actual_public_id = current_company[1]
     admin_check = is_admin(actual_public_id)
 
-    with connection:
+    with get_db() as connection:
         with connection.cursor() as cursor: 
             try:    
                 cursor.execute(SELECT_ONE_COMPANY_RESOURCE, (company_resource_id, ))
 
                 resource = cursor.fetchall()[0]
 
-                dt = datetime.now()
-                ts = datetime.timestamp(dt)
-
-                resource_data = {}
-                resource_data['company_resource_id'] = resource[0]
-                resource_data['company_id'] = resource[1]
-                resource_data['resource_id'] = resource[2]
-                resource_data['stock_amount'] = resource[3]
-                resource_data['date'] = dt
-                resource_data['timestamp'] = ts
+                resource_data = map_row(cursor, COMPANY_RESOURCE_FIELDS, resource)
 
                 company_id = resource[1]
                 if company_id != actual_company_id and not admin_check:
@@ -1480,12 +2154,14 @@ def create_company_resource(current_company):
 
         company_id = int(data['company_id'])
         resource_id = data['resource_id']
+        if not resource_registry.exists(resource_id):
+            return unknown_resource()
         stock_amount = data['stock_amount']
         
         if company_id != actual_company_id and not is_admin(actual_public_id):
             return jsonify({'message' : 'Cannot perform that function, you can only create your own company_resource'}), 401
 
-        with connection:
+        with get_db() as connection:
             with connection.cursor() as cursor: 
                 cursor.execute(INSERT_INTO_COMPANY_RESOURCES, (company_id, resource_id, stock_amount))
                 company_resource_id = cursor.fetchone()[0]
@@ -1498,30 +2174,23 @@ def create_company_resource(current_company):
 @app.put('/company_resource_change_stock/<company_resource_id>')
 @token_required
 def company_resource_change_stock(current_company, company_resource_id): 
-    with connection:
-        with connection.cursor() as cursor:       
-            try:
-                cursor.execute(GET_COMPANY_ID_OF_COMPANY_RESOURCE, (company_resource_id, ))
-                company_id = cursor.fetchone()[0]
-            except (Exception, psycopg2.Error):  
-                return jsonify( {'error' : "no company resource offer with given id"}), 404    
-
     actual_company_id = current_company[0]        
     actual_public_id = current_company[1]
 
-    if company_id != actual_company_id and not is_admin(actual_public_id):
-        return jsonify({'message' : 'Cannot perform that function, you can only change your own company_resource'}), 401
-
-    with connection:
+    with get_db() as connection:
             with connection.cursor() as cursor:
                 try:
                     data = request.get_json()
                     stock_amount = data['stock_amount']
 
-                    cursor.execute(SELECT_ONE_COMPANY_RESOURCE, (company_resource_id, ))
-                    cursor.execute(CHANGE_STOCK_AMOUNT, (stock_amount, company_resource_id))
+                    update_owned(cursor, COMPANY_RESOURCES, [('stock_amount', stock_amount)], company_resource_id,
+                                 actual_company_id, is_admin(actual_public_id))
 
                     return jsonify( {'message' : "Update Successful"} )
+                except NotFound:
+                    return jsonify( {'error' : "no company resource offer with given id"}), 404
+                except Forbidden:
+                    return jsonify({'message' : 'Cannot perform that function, you can only change your own company_resource'}), 401
                 except:
                     return jsonify( {'error' : "Error while updating record"})  
 
@@ -1529,94 +2198,212 @@ def company_resource_change_stock(current_company, company_resource_id):
 @app.delete('/company_resources/<company_resource_id>')
 @token_required
 def delete_company_resource(current_company, company_resource_id):
-    with connection:
-        with connection.cursor() as cursor:       
-            try:
-                cursor.execute(GET_COMPANY_ID_OF_COMPANY_RESOURCE, (company_resource_id, ))
-                company_id = cursor.fetchone()[0]
-            except (Exception, psycopg2.Error):  
-                return jsonify( {'error' : "no company resource offer with given id"}), 404    
-
     actual_company_id = current_company[0]        
     actual_public_id = current_company[1]
 
-    if company_id != actual_company_id and not is_admin(actual_public_id):
-        return jsonify({'message' : 'Cannot perform that function, you can only delete your own company_resource'}), 401
-    
-    with connection:
+    with get_db() as connection:
         with connection.cursor() as cursor: 
             try:          
-                cursor.execute(DELETE_COMPANY_RESOURCE, (company_resource_id,))
+                delete_owned(cursor, COMPANY_RESOURCES, company_resource_id, actual_company_id, is_admin(actual_public_id))
                 return jsonify( {'message' : "Delete Successful"} )
-                
+            except NotFound:
+                return jsonify( {'error' : "no company resource offer with given id"}), 404
+            except Forbidden:
+                return jsonify({'message' : 'Cannot perform that function, you can only delete your own company_resource'}), 401
             except (Exception, psycopg2.Error):   
                 return jsonify( {'error' : "Error while deleting company resource"})    
 
                      
+def gather_price_snapshot(cursor):
+    cursor.execute(GATHER_PRICE_DATA)
+    ticks = cursor.fetchall()
+    event_bus.publish(cursor, *[{'type' : 'price', 'action' : 'tick', 'resource_id' : resource_id, 'timestamp' : timestamp, 'price' : price}
+                                for resource_id, timestamp, price in ticks])
+    response_cache.mark_changed('statistics')
+    return len(ticks)
+
+
+def retention_cutoff(days):
+    return (datetime.now() - timedelta(days=days)).date().replace(day=1)
+
+
+# Creates the coming monthly partitions and applies retention. Dropping a
+# transactions partition, or old rows of the default one, does not touch
+# market_summary, its trade totals keep covering the whole history.
+def maintain_partitions(cursor):
+    cursor.execute(ENSURE_PARTITIONS, (PARTITION_MONTHS_AHEAD, ))
+    result = {'created' : cursor.fetchone()[0], 'dropped' : [], 'purged' : {}}
+
+    if PRICE_STATISTICS_RETENTION_DAYS > 0:
+        cutoff = retention_cutoff(PRICE_STATISTICS_RETENTION_DAYS)
+        cursor.execute(COMPACT_PRICE_STATISTICS, (cutoff, ))
+        cursor.execute(DELETE_MINUTE_CANDLES_BEFORE, (cutoff, ))
+        cursor.execute(DROP_PARTITIONS_BEFORE, ('price_statistics', cutoff))
+        result['dropped'].extend(row[0] for row in cursor.fetchall())
+        cursor.execute(DELETE_DEFAULT_PRICE_STATISTICS_BEFORE, (cutoff, ))
+        result['purged']['price_statistics_default'] = cursor.rowcount
+
+    if TRANSACTIONS_RETENTION_DAYS > 0:
+        cutoff = retention_cutoff(TRANSACTIONS_RETENTION_DAYS)
+        cursor.execute(DROP_PARTITIONS_BEFORE, ('transactions', cutoff))
+        result['dropped'].extend(row[0] for row in cursor.fetchall())
+        cursor.execute(DELETE_DEFAULT_TRANSACTIONS_BEFORE, (cutoff, ))
+        result['purged']['transactions_default'] = cursor.fetchone()[0]
+
+    cursor.execute(DELETE_RESOURCE_ACTIVITY_BEFORE, (datetime.now() - timedelta(days=ACTIVITY_RETENTION_DAYS), ))
+    if result['dropped'] or any(result['purged'].values()):
+        response_cache.mark_changed('statistics', 'transactions')
+    return result
+
+
+# Archives expired offers batch by batch, committing after each one so the
+# offer rows are never locked for long. The order books need no update: they
+# skip orders past their end date on their own.
+def archive_expired_offers(cursor):
+    result = {'sell_offers' : 0, 'buy_offers' : 0}
+
+    for key, query in (('sell_offers', ARCHIVE_EXPIRED_SELL_OFFERS), ('buy_offers', ARCHIVE_EXPIRED_BUY_OFFERS)):
+        for batch in range(OFFER_EXPIRY_MAX_BATCHES):
+            cursor.execute(query, (OFFER_EXPIRY_BATCH, ))
+            archived = cursor.fetchone()[0]
+            if archived:
+                event_bus.publish(cursor, {'type' : key[:-1], 'action' : 'expired', 'resource_id' : None, 'count' : archived})
+            cursor.connection.commit()
+
+            result[key] += archived
+            if archived < OFFER_EXPIRY_BATCH:
+                break
+
+        if result[key]:
+            response_cache.mark_changed(key)
+
+    return result
+
+
 @app.post('/gather_price_data')
 def gather_data():   
     try:
-        with connection:
+        with get_db() as connection:
             with connection.cursor() as cursor: 
-                cursor.execute(SELECT_ALL_RESOURCES)
-                resources = cursor.fetchall()  
+                gathered = gather_price_snapshot(cursor)
     except (Exception, psycopg2.Error):   
-        return jsonify( {'error' : "Error while fetching data from PostgreSQL table"})
-    
-    try:
-        with connection:
-            with connection.cursor() as cursor: 
-                for resource in resources:
-                    resource_id = resource[0]
-
-                    cursor.execute(GET_MIN_SELL_OFFER_RESOURCE_PRICE_PER_TON, (resource_id, ))
-                    actual_sell_price = cursor.fetchone()[0]
-
-                    cursor.execute(GET_MAX_BUY_OFFER_RESOURCE_PRICE_PER_TON, (resource_id, ))
-                    actual_buy_price = cursor.fetchone()[0]
-
-                    is_sell_valid = True
-                    is_buy_valid = True
-                    if type(actual_sell_price) != int and type(actual_sell_price) != float:
-                        is_sell_valid = False
-                    if type(actual_buy_price) != int and type(actual_buy_price) != float:
-                        is_buy_valid = False
-
-                    if not is_sell_valid and not is_buy_valid:
-                        continue
-                    if not is_buy_valid:
-                        actual_buy_price = actual_sell_price
-                    if not is_sell_valid:
-                        actual_sell_price = actual_buy_price         
-
-                    actual_resource_price = (actual_buy_price + actual_sell_price) / 2
-                    cursor.execute(INSERT_INTO_STATISTICS, (resource_id, actual_resource_price))
-    except (Exception, psycopg2.Error):   
-        return jsonify( {'error' : "Error while fetching data from PostgreSQL table", "price" : actual_resource_price, "id" : resource_id})                
+        return jsonify( {'error' : "Error while fetching data from PostgreSQL table"})                
 
-    return jsonify({'message' : 'Data successfully gathered'}), 201 
+    return jsonify({'message' : 'Data successfully gathered', 'resources' : gathered}), 201 
 
 
 @app.get('/statistics')  
+@response_cache.cached('statistics')
 def get_all_statistics(): 
-    with connection:
+    try:
+        after, limit, keys = read_page_args(STATISTICS_FIELDS)
+    except ValueError:
+        return invalid_page_args()
+
+    mode = request.args.get('stream')
+    if mode:
+        if mode not in ('ndjson', 'json'):
+            return jsonify( {'error' : "stream has to be ndjson or json"}), 400
+        return stream_rows(SELECT_STATISTICS_EXPORT, STATISTICS_FIELDS, keys, after, mode, 'ResourcePrices', resolve_resource_name)
+
+    with get_db() as connection:
         with connection.cursor() as cursor:
             try:
-                cursor.execute(SELECT_ALL_STATISTICS)
+                output, next_after = fetch_page(cursor, SELECT_STATISTICS_PAGE, STATISTICS_FIELDS, keys, after, limit, resolve_resource_name)
 
-                output = []
-                records = cursor.fetchall()
-                for record in records:
-                    data = {}
-                    data['resource'] = record[0]
-                    data['time'] = record[1]
-                    data['price'] = record[2]
-
-                    output.append(data)
             except (Exception, psycopg2.Error):
                 return jsonify( {'error' : "Error occured while fetching data from database"})        
 
-    return jsonify( {'ResourcePrices' : output} )
+    return jsonify( {'ResourcePrices' : output, 'next_after' : next_after} )
+
+
+# everything a market dashboard needs for all resources in one query; clients
+# poll with If-None-Match and get a 304 while nothing changed
+@app.get('/market/snapshot')
+@response_cache.cached('resources', 'buy_offers', 'sell_offers', 'transactions')
+def market_snapshot():
+    with get_db() as connection:
+        with connection.cursor() as cursor:
+            try:
+                cursor.execute(SELECT_MARKET_SNAPSHOT)
+
+                mapper = row_mapper(cursor, MARKET_SNAPSHOT_FIELDS)
+                popularity = row_mapper(cursor, MARKET_POPULARITY_FIELDS)
+                output = []
+                for row in cursor.fetchall():
+                    resource_data = mapper(row)
+                    resource_data['popularity'] = popularity(row)
+                    output.append(resource_data)
+
+            except (Exception, psycopg2.Error):
+                return jsonify( {'error' : "Error occured while fetching data from database"})
+
+    response = jsonify( {'market' : output} )
+    response.add_etag()
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
+
+
+# returns open/high/low/close/volume buckets of a resource, read from the
+# price_candles roll-up; ?from= and ?to= take ISO datetimes, to defaults to now
+# and from to 500 intervals earlier
+@app.get('/statistics/<resource_id>/candles')
+@response_cache.cached('statistics', 'transactions')
+def get_candles(resource_id):
+    if not resource_registry.exists(resource_id):
+        return unknown_resource(404)
+
+    interval = request.args.get('interval', '1h')
+    if interval not in CANDLE_INTERVALS:
+        return jsonify( {'error' : "interval has to be one of 1m, 1h, 1d"}), 400
+
+    try:
+        end = datetime.fromisoformat(request.args['to']) if 'to' in request.args else datetime.now()
+        start = datetime.fromisoformat(request.args['from']) if 'from' in request.args else end - DEFAULT_CANDLES * CANDLE_INTERVALS[interval]
+    except ValueError:
+        return jsonify( {'error' : "from and to have to be ISO 8601 datetimes"}), 400
+
+    with get_db() as connection:
+        with connection.cursor() as cursor:
+            try:
+                cursor.execute(SELECT_CANDLES, (resource_id, interval, start, end, MAX_CANDLES))
+
+                mapper = row_mapper(cursor, CANDLE_FIELDS)
+                output = [mapper(row) for row in cursor.fetchall()]
+
+            except (Exception, psycopg2.Error):
+                return jsonify( {'error' : "Error occured while fetching data from database"})
+
+    return jsonify( {'resource_id' : resource_id, 'interval' : interval, 'candles' : output} )
+
+
+# Server-sent events of committed market changes, filtered with resources=<ids>
+# and types=<sell_offer,buy_offer,transaction,price>. Offer events carry the
+# offer as written, before matching; the transaction events that follow take
+# their quantity off both offers, which are gone once empty. A reset event
+# means events were lost and the client has to reload its state over REST.
+@app.get('/events')
+def event_stream():
+    try:
+        resources, types = parse_filters(request.args.get('resources'), request.args.get('types'))
+    except ValueError:
+        return jsonify( {'error' : "Invalid filters, use resources=<comma separated ids> and types=<comma separated %s>" % ",".join(EVENT_TYPES)}), 400
+
+    subscriber = event_bus.subscribe(resources, types)
+    if subscriber is None:
+        return jsonify( {'error' : "Event feed is not available, poll the REST routes instead"}), 503
+
+    def generate():
+        yield SSE_RETRY
+        while True:
+            subscriber.wait(EVENT_KEEPALIVE)
+            yield format_events(*subscriber.drain()) or ': keepalive\n\n'
+
+    response = Response(generate(), mimetype='text/event-stream')
+    response.cache_control.no_cache = True
+    response.headers['X-Accel-Buffering'] = 'no'
+    response.call_on_close(lambda: event_bus.unsubscribe(subscriber))
+    return response
 
 
 @app.post('/buy')   
@@ -1624,9 +2411,9 @@ def get_all_statistics():
 def buy(current_company): 
     try:
         data = request.get_json()
-        sell_offer_id = data['sell_offer_id']
+        sell_offer_id = int(data['sell_offer_id'])
         buyer_public_id = data['buyer_public_id']
-        amount = data['amount']
+        amount = float(data['amount'])
 
         actual_company_id = current_company[0]        
         actual_public_id = current_company[1]
@@ -1636,17 +2423,45 @@ def buy(current_company):
     except:
         return jsonify( {'error' : "Wrong data, could not read json"})         
 
-    with connection:
-        with connection.cursor() as cursor:
-            try:
-                SELL_OFFER_URL = f"http://127.0.0.1:5000/sell_offers/{sell_offer_id}"
-                r = requests.get(url = SELL_OFFER_URL)
-                sell_offer = r.json()
-                
-
+    if amount <= 0:
+        return jsonify( {'error' : "amount has to be positive"}), 400
 
+    try:
+        buyer_id = actual_company_id if buyer_public_id == actual_public_id else get_company_id(buyer_public_id)
+    except (Exception, psycopg2.Error):
+        return jsonify( {'error' : "No company with given public_id"}), 404
 
-            except (Exception, psycopg2.Error):
-                return jsonify( {'error' : "Error occured while fetching data from database"})        
+    try:
+        with get_db() as connection:
+            transaction_id, quantity, price_per_ton = settle_purchase(connection, sell_offer_id, buyer_id, amount)
+    except LookupError as e:
+        return jsonify( {'error' : str(e)}), 404
+    except ValueError as e:
+        return jsonify( {'error' : str(e)}), 400
+    except (Exception, psycopg2.Error):
+        return jsonify( {'error' : "Error occured while processing the purchase"})
+
+    return jsonify( {'message' : "Purchase Successful", 'transaction_id' : transaction_id, 'quantity' : quantity,
+                     'price_per_ton' : price_per_ton, 'total_price' : quantity * price_per_ton} )
+
+
+price_snapshot_job = PeriodicJob('price-snapshot', gather_price_snapshot, pool, url,
+                                 PRICE_SNAPSHOT_LOCK_KEY, PRICE_SNAPSHOT_INTERVAL, PRICE_SNAPSHOT_JITTER,
+                                 scope=response_cache.deferred)
+if PRICE_SNAPSHOT_INTERVAL > 0 and not HELPER_PROCESS:
+    price_snapshot_job.start()
+
+partition_maintenance_job = PeriodicJob('partition-maintenance', maintain_partitions, pool, url,
+                                        PARTITION_MAINTENANCE_LOCK_KEY, PARTITION_MAINTENANCE_INTERVAL,
+                                        scope=response_cache.deferred)
+if PARTITION_MAINTENANCE_INTERVAL > 0 and not HELPER_PROCESS:
+    partition_maintenance_job.start()
+
+offer_expiry_job = PeriodicJob('offer-expiry', archive_expired_offers, pool, url,
+                               OFFER_EXPIRY_LOCK_KEY, OFFER_EXPIRY_INTERVAL,
+                               scope=response_cache.deferred)
+if OFFER_EXPIRY_INTERVAL > 0 and not HELPER_PROCESS:
+    offer_expiry_job.start()
 
-    return jsonify( {'ResourcePrices' : sell_offer} )
\ No newline at end of file
+if __name__ == '__main__':
+    app.run(debug=True)
@@ -0,0 +1,206 @@
+import asyncio
+import os
+import re
+from datetime import datetime
+from urllib.parse import parse_qs
+
+try:
+    import asyncpg
+    from a2wsgi import WSGIMiddleware
+except ImportError as e:
+    raise RuntimeError("asgi.py needs the packages in requirements-asgi.txt: pip install -r requirements-asgi.txt") from e
+
+from app import (app, url, resource_registry, event_bus, EVENT_KEEPALIVE,
+                 GET_AVG_BUY_OFFER_RESOURCE_PRICE_PER_TON, GET_AVG_SELL_OFFER_RESOURCE_PRICE_PER_TON,
+                 GET_AVG_TRANSACTION_RESOURCE_PRICE_PER_TON, GET_MAX_BUY_OFFER_RESOURCE_PRICE_PER_TON,
+                 GET_MIN_SELL_OFFER_RESOURCE_PRICE_PER_TON, GET_SUM_QUANTITY_OF_RESOURCE_TRANSACTION)
+from events import EVENT_TYPES, SSE_RETRY, format_events, parse_filters
+from resource_registry import SELECT_RESOURCES
+from statements import to_server_params
+
+# Async serving mode: uvicorn asgi:application, see requirements-asgi.txt
+#
+# The read-only routes that clients poll are served on the event loop with an
+# asyncpg pool, so thousands of idle pollers cost a coroutine each instead of
+# a worker thread. /events streams are served here too, so subscribers do not
+# hold a thread for as long as they stay connected. Every other route is
+# handed to the Flask app on a thread pool, so the API and its JSON contracts
+# are the same in both modes; tests/test_asgi_parity.py checks that.
+ASYNC_DB_POOL_MIN = int(os.getenv("ASYNC_DB_POOL_MIN", 2))
+ASYNC_DB_POOL_MAX = int(os.getenv("ASYNC_DB_POOL_MAX", 20))
+WSGI_WORKERS = int(os.getenv("WSGI_WORKERS", 10))
+
+DATABASE_ERROR = "error while fetching date from a database"
+
+# path, response key, query and error message of the per-resource aggregate
+# routes, mirroring the Flask views of the same paths
+AGGREGATE_ROUTES = [
+    (r'/buy_offers/max_buy_price/(\w+)', 'max_price', GET_MAX_BUY_OFFER_RESOURCE_PRICE_PER_TON, DATABASE_ERROR),
+    (r'/buy_offers/avg_price/(\w+)', 'avg_price', GET_AVG_BUY_OFFER_RESOURCE_PRICE_PER_TON, DATABASE_ERROR),
+    (r'/sell_offers/min_sell_price/(\w+)', 'min_price', GET_MIN_SELL_OFFER_RESOURCE_PRICE_PER_TON, DATABASE_ERROR),
+    (r'/sell_offers/avg_price/(\w+)', 'avg_price', GET_AVG_SELL_OFFER_RESOURCE_PRICE_PER_TON, DATABASE_ERROR),
+    (r'/transactions/avg_transaction_price/(\w+)', 'avg_transaction_price', GET_AVG_TRANSACTION_RESOURCE_PRICE_PER_TON, "No transaction with given ID"),
+    (r'/transactions/sum_transaction_quantity/(\w+)', 'sum_transaction_quantity', GET_SUM_QUANTITY_OF_RESOURCE_TRANSACTION, "No transaction with given ID"),
+]
+
+
+def json_response(payload, status=200):
+    body = (app.json.dumps(payload) + "\n").encode()
+    headers = [(b'content-type', b'application/json'), (b'content-length', str(len(body)).encode())]
+    return status, headers, body
+
+
+def stamped(output):
+    dt = datetime.now()
+    ts = datetime.timestamp(dt)
+    for data in output:
+        data['date'] = dt
+        data['timestamp'] = ts
+    return output
+
+
+class AsyncAPI:
+    def __init__(self, wsgi_app):
+        self.fallback = WSGIMiddleware(wsgi_app, workers=WSGI_WORKERS)
+        self.pool = None
+        self.routes = [(re.compile(r'^/resources$'), self.all_resources),
+                       (re.compile(r'^/resources/(\w+)$'), self.one_resource)]
+        for path, key, query, error in AGGREGATE_ROUTES:
+            self.routes.append((re.compile('^%s$' % path), self.aggregate(key, to_server_params(query), error)))
+
+    async def startup(self):
+        self.pool = await asyncpg.create_pool(url, min_size=ASYNC_DB_POOL_MIN, max_size=ASYNC_DB_POOL_MAX)
+
+    async def shutdown(self):
+        if self.pool is not None:
+            await self.pool.close()
+
+    # same answers as ResourceRegistry.name, but a reload goes through asyncpg
+    async def resource_name(self, resource_id):
+        try:
+            resource_id = int(resource_id)
+        except ValueError:
+            return None
+
+        name = resource_registry.cached_name(resource_id)
+        if name is None and resource_registry.reload_due():
+            rows = await self.pool.fetch(SELECT_RESOURCES)
+            name = resource_registry.replace([tuple(row) for row in rows]).get(resource_id)
+        return name
+
+    async def all_resources(self):
+        try:
+            if resource_registry.reload_due():
+                rows = await self.pool.fetch(SELECT_RESOURCES)
+                resource_registry.replace([tuple(row) for row in rows])
+            output = [{'resource_id' : resource_id, 'resource_name' : resource_name}
+                      for resource_id, resource_name in resource_registry.all()]
+        except (asyncpg.PostgresError, OSError):
+            return json_response({'error' : "Error occured while fetching data from database"})
+
+        return json_response({'resources' : stamped(output)})
+
+    async def one_resource(self, resource_id):
+        try:
+            resource_name = await self.resource_name(resource_id)
+        except (asyncpg.PostgresError, OSError):
+            return json_response({'error' : "Error occured while fetching data from database"})
+
+        if resource_name is None:
+            return json_response({'error' : "No resource with given ID"})
+        return json_response({'company' : stamped([{'resource_id' : int(resource_id), 'resource_name' : resource_name}])})
+
+    def aggregate(self, key, query, error):
+        async def handler(resource_id):
+            try:
+                if await self.resource_name(resource_id) is None:
+                    return json_response({'error' : "No resource with given ID"}, 404)
+                row = await self.pool.fetchrow(query, int(resource_id))
+            except (asyncpg.PostgresError, OSError):
+                return json_response({'error' : error})
+
+            return json_response({key : tuple(row) if row is not None else (None, )})
+        return handler
+
+    # same stream as the Flask /events view, woken from the listener thread
+    async def events(self, scope, receive, send):
+        query = parse_qs(scope['query_string'].decode())
+        try:
+            resources, types = parse_filters(query.get('resources', [None])[0], query.get('types', [None])[0])
+        except ValueError:
+            return await self.respond(send, *json_response({'error' : "Invalid filters, use resources=<comma separated ids> and types=<comma separated %s>" % ",".join(EVENT_TYPES)}, 400))
+
+        loop = asyncio.get_running_loop()
+        ready = asyncio.Event()
+
+        def wakeup():
+            try:
+                loop.call_soon_threadsafe(ready.set)
+            except RuntimeError:
+                pass
+
+        subscriber = event_bus.subscribe(resources, types, wakeup)
+        if subscriber is None:
+            return await self.respond(send, *json_response({'error' : "Event feed is not available, poll the REST routes instead"}, 503))
+
+        disconnected = asyncio.ensure_future(self.disconnect(receive))
+        try:
+            await send({'type' : 'http.response.start', 'status' : 200,
+                        'headers' : [(b'content-type', b'text/event-stream; charset=utf-8'), (b'cache-control', b'no-cache'),
+                                     (b'x-accel-buffering', b'no')]})
+            await send({'type' : 'http.response.body', 'body' : SSE_RETRY.encode(), 'more_body' : True})
+
+            while not disconnected.done():
+                woken = asyncio.ensure_future(ready.wait())
+                await asyncio.wait((woken, disconnected), timeout=EVENT_KEEPALIVE, return_when=asyncio.FIRST_COMPLETED)
+                woken.cancel()
+                if disconnected.done():
+                    break
+
+                ready.clear()
+                chunk = format_events(*subscriber.drain()) or ': keepalive\n\n'
+                await send({'type' : 'http.response.body', 'body' : chunk.encode(), 'more_body' : True})
+        finally:
+            event_bus.unsubscribe(subscriber)
+            disconnected.cancel()
+
+    async def disconnect(self, receive):
+        while (await receive())['type'] != 'http.disconnect':
+            pass
+
+    async def respond(self, send, status, headers, body, head=False):
+        await send({'type' : 'http.response.start', 'status' : status, 'headers' : headers})
+        await send({'type' : 'http.response.body', 'body' : b'' if head else body})
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                try:
+                    await self.startup()
+                except Exception as e:
+                    await send({'type' : 'lifespan.startup.failed', 'message' : str(e)})
+                    return
+                await send({'type' : 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await self.shutdown()
+                await send({'type' : 'lifespan.shutdown.complete'})
+                return
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            return await self.lifespan(receive, send)
+
+        if scope['type'] == 'http' and scope['method'] == 'GET' and scope['path'] == '/events':
+            return await self.events(scope, receive, send)
+
+        if scope['type'] == 'http' and scope['method'] in ('GET', 'HEAD') and self.pool is not None:
+            for pattern, handler in self.routes:
+                match = pattern.match(scope['path'])
+                if match is not None:
+                    return await self.respond(send, *await handler(*match.groups()), head=scope['method'] == 'HEAD')
+
+        await self.fallback(scope, receive, send)
+
+
+application = AsyncAPI(app)
@@ -0,0 +1,137 @@
+import threading
+import time
+from contextlib import contextmanager
+
+import psycopg2
+import psycopg2.extensions
+from psycopg2.pool import PoolError
+
+
+# Thread-safe connection pool. Connections are checked out per request and
+# returned afterwards; broken sessions are dropped and replaced on the next
+# checkout, and connections that sat idle for a while are pinged first.
+class ConnectionPool:
+    def __init__(self, dsn, minconn=1, maxconn=10, timeout=30, health_check_interval=30, connection_factory=None):
+        if minconn < 0 or maxconn < 1 or minconn > maxconn:
+            raise PoolError("invalid pool size: min %s, max %s" % (minconn, maxconn))
+
+        self.dsn = dsn
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.timeout = timeout
+        self.health_check_interval = health_check_interval
+        self.connection_factory = connection_factory
+
+        self._idle = []
+        self._size = 0
+        self._closed = False
+        self._cond = threading.Condition()
+
+        for i in range(minconn):
+            self._idle.append((self._connect(), time.monotonic()))
+            self._size += 1
+
+    def _connect(self):
+        if self.connection_factory is None:
+            return psycopg2.connect(self.dsn)
+        return psycopg2.connect(self.dsn, connection_factory=self.connection_factory)
+
+    def _is_healthy(self, connection, last_used):
+        if connection.closed:
+            return False
+        if connection.get_transaction_status() == psycopg2.extensions.TRANSACTION_STATUS_UNKNOWN:
+            return False
+        if time.monotonic() - last_used < self.health_check_interval:
+            return True
+
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute("select 1;")
+            connection.rollback()
+        except psycopg2.Error:
+            return False
+        return True
+
+    def _close_quietly(self, connection):
+        try:
+            connection.close()
+        except psycopg2.Error:
+            pass
+
+    def getconn(self):
+        deadline = time.monotonic() + self.timeout
+
+        with self._cond:
+            while True:
+                if self._closed:
+                    raise PoolError("connection pool is closed")
+                if self._idle:
+                    connection, last_used = self._idle.pop()
+                    break
+                if self._size < self.maxconn:
+                    self._size += 1
+                    connection, last_used = None, None
+                    break
+
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise PoolError("timed out waiting for a database connection")
+                self._cond.wait(remaining)
+
+        try:
+            if connection is not None and not self._is_healthy(connection, last_used):
+                self._close_quietly(connection)
+                connection = None
+            if connection is None:
+                connection = self._connect()
+        except Exception:
+            with self._cond:
+                self._size -= 1
+                self._cond.notify()
+            raise
+
+        return connection
+
+    def putconn(self, connection, close=False):
+        if not close and not connection.closed:
+            status = connection.get_transaction_status()
+            if status == psycopg2.extensions.TRANSACTION_STATUS_UNKNOWN:
+                close = True
+            elif status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                try:
+                    connection.rollback()
+                except psycopg2.Error:
+                    close = True
+
+        with self._cond:
+            if close or connection.closed or self._closed:
+                self._close_quietly(connection)
+                self._size -= 1
+            else:
+                self._idle.append((connection, time.monotonic()))
+            self._cond.notify()
+
+    @contextmanager
+    def connection(self):
+        connection = self.getconn()
+        broken = False
+        try:
+            yield connection
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            broken = True
+            raise
+        finally:
+            self.putconn(connection, close=broken)
+
+    def closeall(self):
+        with self._cond:
+            self._closed = True
+            for connection, last_used in self._idle:
+                self._close_quietly(connection)
+                self._size -= 1
+            self._idle = []
+            self._cond.notify_all()
+
+    def stats(self):
+        with self._cond:
+            return {'size' : self._size, 'idle' : len(self._idle), 'min' : self.minconn, 'max' : self.maxconn}
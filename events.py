@@ -0,0 +1,254 @@
+import itertools
+import json
+import logging
+import select
+import threading
+from collections import deque, namedtuple
+
+import psycopg2
+
+logger = logging.getLogger(__name__)
+
+CHANNEL = 'market_events'
+
+EVENT_TYPES = ('sell_offer', 'buy_offer', 'transaction', 'price')
+
+# one round trip for all events of a write; they are only delivered once the
+# transaction commits, and dropped with it on rollback
+NOTIFY_EVENTS = ("select pg_notify(%s, payload) from unnest(%s::text[]) as payload;")
+
+# sent first on every stream, clients reconnect 3s after losing it
+SSE_RETRY = 'retry: 3000\n\n'
+
+# data is the JSON text as it was published, it is passed on to clients as is
+Event = namedtuple('Event', ['id', 'type', 'resource_id', 'data'])
+
+
+# parses the resources=1,2 and types=price,transaction filters of a
+# subscription, None means no filter. Raises ValueError for bad values
+def parse_filters(resources=None, types=None):
+    if resources:
+        resources = frozenset(int(resource_id) for resource_id in resources.split(','))
+    else:
+        resources = None
+
+    if types:
+        types = frozenset(types.split(','))
+        if not types <= set(EVENT_TYPES):
+            raise ValueError("unknown event type: " + ", ".join(sorted(types - set(EVENT_TYPES))))
+    else:
+        types = None
+
+    return resources, types
+
+
+# text/event-stream chunk for what a subscriber drained; a reset tells the
+# client that events were lost and it has to reload its state over REST
+def format_events(lost, events):
+    chunk = 'event: reset\ndata: {}\n\n' if lost else ''
+    return chunk + ''.join('id: %d\nevent: %s\ndata: %s\n\n' % (event.id, event.type, event.data) for event in events)
+
+
+# One client of the feed. Events wait in a bounded queue until the stream
+# writes them out; a client that falls maxsize events behind loses its queue
+# and gets a single reset instead, so a slow reader never holds up the bus or
+# grows without bound. wakeup is called after every change of the queue, the
+# default one backs wait() for thread-based streams.
+class Subscriber:
+    def __init__(self, resources, types, maxsize, wakeup=None):
+        self.resources = resources
+        self.types = types
+        self.maxsize = maxsize
+        self.lost = False
+        self._events = deque()
+        self._lock = threading.Lock()
+        self._ready = threading.Event()
+        self.wakeup = wakeup or self._ready.set
+
+    def wants(self, event):
+        if self.types is not None and event.type not in self.types:
+            return False
+        return self.resources is None or event.resource_id is None or event.resource_id in self.resources
+
+    def offer(self, event):
+        with self._lock:
+            if len(self._events) < self.maxsize:
+                self._events.append(event)
+            else:
+                self._events.clear()
+                self.lost = True
+        self.wakeup()
+
+    def reset(self):
+        with self._lock:
+            self._events.clear()
+            self.lost = True
+        self.wakeup()
+
+    def wait(self, timeout):
+        self._ready.wait(timeout)
+        self._ready.clear()
+
+    def drain(self):
+        with self._lock:
+            events = list(self._events)
+            self._events.clear()
+            lost, self.lost = self.lost, False
+        return lost, events
+
+
+# Fans committed market events out to the subscribers of this worker. Writes
+# publish through Postgres NOTIFY, so every worker's listener sees the events
+# of all workers, in commit order. The listener starts with the first
+# subscriber; a worker nobody subscribes to never opens its connection.
+class EventBus:
+    def __init__(self, dsn, queue_size=256, max_subscribers=1000, enabled=True):
+        self.dsn = dsn
+        self.queue_size = queue_size
+        self.max_subscribers = max_subscribers
+        self.enabled = enabled
+        self._subscribers = set()
+        self._watchers = []
+        self._sequence = itertools.count(1)
+        self._lock = threading.Lock()
+        self._listener = None
+
+    def publish(self, cursor, *events):
+        if self.enabled and events:
+            payloads = [json.dumps(event, default=str, separators=(',', ':')) for event in events]
+            cursor.execute(NOTIFY_EVENTS, (CHANNEL, payloads))
+
+    # returns None when the feed is off or this worker is full
+    def subscribe(self, resources=None, types=None, wakeup=None):
+        if not self.enabled:
+            return None
+
+        with self._lock:
+            if len(self._subscribers) >= self.max_subscribers:
+                return None
+            subscriber = Subscriber(resources, types, self.queue_size, wakeup)
+            self._subscribers.add(subscriber)
+            self._start_listener()
+        return subscriber
+
+    # on_event sees every event of the feed as (backend pid of the publishing
+    # session, decoded event); on_reset is called whenever the listener has
+    # (re)connected, events published before that never reach on_event.
+    # Returns False when the feed is off
+    def watch(self, on_event, on_reset):
+        if not self.enabled:
+            return False
+
+        with self._lock:
+            self._watchers.append((on_event, on_reset))
+            self._start_listener()
+        return True
+
+    # called with self._lock held
+    def _start_listener(self):
+        if self._listener is None or not self._listener.is_alive():
+            self._listener = EventListener(self)
+            self._listener.start()
+
+    # True while the listener holds its session, watchers are up to date then
+    def listening(self):
+        listener = self._listener
+        return listener is not None and listener.connected
+
+    def unsubscribe(self, subscriber):
+        with self._lock:
+            self._subscribers.discard(subscriber)
+
+    def subscribers(self):
+        with self._lock:
+            return list(self._subscribers)
+
+    def watchers(self):
+        with self._lock:
+            return list(self._watchers)
+
+    def deliver(self, payload, pid=None):
+        try:
+            data = json.loads(payload)
+            event = Event(next(self._sequence), data['type'], data.get('resource_id'), payload)
+        except (ValueError, KeyError, TypeError):
+            logger.warning("ignoring malformed event %r", payload)
+            return
+
+        for on_event, on_reset in self.watchers():
+            on_event(pid, data)
+        for subscriber in self.subscribers():
+            if subscriber.wants(event):
+                subscriber.offer(event)
+
+    def reset(self):
+        for subscriber in self.subscribers():
+            subscriber.reset()
+
+    # watchers resync on every connect, subscribers only when events were lost
+    def listener_connected(self, reconnected):
+        for on_event, on_reset in self.watchers():
+            on_reset()
+        if reconnected:
+            self.reset()
+
+    def stats(self):
+        return {'enabled' : self.enabled, 'subscribers' : len(self.subscribers()), 'max_subscribers' : self.max_subscribers}
+
+
+# LISTENs on a dedicated session and hands notifications to the bus. After a
+# lost connection every subscriber is reset, whatever was published in
+# between never reaches this worker.
+class EventListener(threading.Thread):
+    def __init__(self, bus, idle_check=30, retry_interval=5):
+        super().__init__(name='event-listener', daemon=True)
+        self.bus = bus
+        self.idle_check = idle_check
+        self.retry_interval = retry_interval
+        self.connected = False
+        self._connection = None
+        self._stopped = threading.Event()
+
+    def stop(self):
+        self._stopped.set()
+
+    def _listen(self):
+        self._connection = psycopg2.connect(self.bus.dsn)
+        self._connection.autocommit = True
+        with self._connection.cursor() as cursor:
+            cursor.execute('listen %s;' % CHANNEL)
+
+    def _close(self):
+        self.connected = False
+        if self._connection is not None:
+            try:
+                self._connection.close()
+            except psycopg2.Error:
+                pass
+        self._connection = None
+
+    def run(self):
+        connected_before = False
+
+        while not self._stopped.is_set():
+            try:
+                if self._connection is None:
+                    self._listen()
+                    self.bus.listener_connected(connected_before)
+                    self.connected = connected_before = True
+
+                if select.select([self._connection], [], [], self.idle_check) == ([], [], []):
+                    with self._connection.cursor() as cursor:
+                        cursor.execute("select 1;")
+                else:
+                    self._connection.poll()
+
+                while self._connection.notifies:
+                    notify = self._connection.notifies.pop(0)
+                    self.bus.deliver(notify.payload, notify.pid)
+            except (psycopg2.Error, OSError):
+                logger.exception("event listener lost its connection")
+                self._close()
+                self._stopped.wait(self.retry_interval)
+
+        self._close()
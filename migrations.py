@@ -0,0 +1,428 @@
+MIGRATION_LOCK_KEY = 7301001
+
+CREATE_SCHEMA_MIGRATIONS_TABLE = ("""
+        create table if not exists schema_migrations (
+            version int4 primary key,
+            description text not null,
+            applied_at timestamp default now()
+        );
+    """)
+
+SELECT_APPLIED_MIGRATIONS = ("select version from schema_migrations;")
+
+INSERT_INTO_SCHEMA_MIGRATIONS = ("insert into schema_migrations (version, description) values (%s, %s);")
+
+LOCK_MIGRATIONS = ("select pg_advisory_xact_lock(%s);")
+
+# set-based roll-ups of the existing rows, run by the migrations that add the
+# trigger-maintained tables and again after bulk loads that bypass the triggers
+BACKFILL_MARKET_SUMMARY = ("""
+        insert into market_summary (resource_id, sell_count, sell_price_sum, sell_min_price,
+                                    buy_count, buy_price_sum, buy_max_price,
+                                    trade_count, trade_price_sum, trade_quantity_sum)
+        select r.resource_id,
+               coalesce(s.offers, 0), coalesce(s.price_sum, 0), s.min_price,
+               coalesce(b.offers, 0), coalesce(b.price_sum, 0), b.max_price,
+               coalesce(t.trades, 0), coalesce(t.price_sum, 0), coalesce(t.quantity_sum, 0)
+        from resources r
+        left join (select resource_id, count(*) as offers, sum(price_per_ton) as price_sum, min(price_per_ton) as min_price
+                   from sell_offers group by resource_id) s on s.resource_id = r.resource_id
+        left join (select resource_id, count(*) as offers, sum(price_per_ton) as price_sum, max(price_per_ton) as max_price
+                   from buy_offers group by resource_id) b on b.resource_id = r.resource_id
+        left join (select resource_id, count(*) as trades, sum(price_per_ton) as price_sum, sum(quantity) as quantity_sum
+                   from transactions group by resource_id) t on t.resource_id = r.resource_id
+        on conflict (resource_id) do nothing;
+        """)
+
+BACKFILL_RESOURCE_ACTIVITY = ("""
+        insert into resource_activity (kind, bucket_start, resource_id, count)
+        select 'sell_offers', date_trunc('hour', offer_start_date), resource_id, count(*)
+        from sell_offers where offer_start_date is not null and resource_id is not null group by 2, 3
+        union all
+        select 'buy_offers', date_trunc('hour', offer_start_date), resource_id, count(*)
+        from buy_offers where offer_start_date is not null and resource_id is not null group by 2, 3
+        union all
+        select 'transactions', date_trunc('hour', transaction_time), resource_id, count(*)
+        from transactions where transaction_time is not null and resource_id is not null group by 2, 3
+        on conflict (kind, bucket_start, resource_id) do nothing;
+        """)
+
+BACKFILL_CANDLE_VOLUME = ("""
+        insert into price_candles (resource_id, resolution, bucket_start, volume)
+        select t.resource_id, r.resolution, date_trunc(r.unit, t.transaction_time), sum(t.quantity)
+        from transactions t
+        cross join (values ('1m', 'minute'), ('1h', 'hour'), ('1d', 'day')) as r(resolution, unit)
+        where t.resource_id is not null and t.transaction_time is not null
+        group by 1, 2, 3
+        on conflict (resource_id, resolution, bucket_start) do update set volume = excluded.volume;
+        """)
+
+# (version, description, statements), applied in order and never edited once released
+MIGRATIONS = [
+    (1, "indexes for per-resource aggregates and owner lookups", [
+        "create index if not exists sell_offers_resource_price_idx on sell_offers (resource_id, price_per_ton);",
+        "create index if not exists buy_offers_resource_price_idx on buy_offers (resource_id, price_per_ton);",
+        "create index if not exists sell_offers_seller_idx on sell_offers (seller_id);",
+        "create index if not exists buy_offers_buyer_idx on buy_offers (buyer_id);",
+        "create index if not exists transactions_resource_idx on transactions (resource_id, price_per_ton, quantity);",
+        "create index if not exists transactions_buyer_idx on transactions (buyer_id);",
+        "create index if not exists transactions_seller_idx on transactions (seller_id);",
+        "create index if not exists price_statistics_resource_timestamp_idx on price_statistics (resource_id, timestamp);",
+        "create index if not exists price_statistics_timestamp_idx on price_statistics (timestamp);",
+        "create index if not exists company_resources_company_resource_idx on company_resources (company_id, resource_id);",
+    ]),
+    (2, "market_summary maintained by triggers on offers and transactions", [
+        """
+        create table if not exists market_summary (
+            resource_id int4 primary key references resources(resource_id) on delete cascade,
+            sell_count int8 not null default 0,
+            sell_price_sum float not null default 0,
+            sell_min_price float,
+            buy_count int8 not null default 0,
+            buy_price_sum float not null default 0,
+            buy_max_price float,
+            trade_count int8 not null default 0,
+            trade_price_sum float not null default 0,
+            trade_quantity_sum float not null default 0
+        );
+        """,
+        # the extreme price is only rescanned when the removed offer held it,
+        # which is an index lookup on (resource_id, price_per_ton)
+        """
+        create or replace function market_summary_sell_offers() returns trigger as $$
+        begin
+            if tg_op in ('DELETE', 'UPDATE') then
+                update market_summary set
+                    sell_count = sell_count - 1,
+                    sell_price_sum = case when sell_count = 1 then 0 else sell_price_sum - old.price_per_ton end,
+                    sell_min_price = case when old.price_per_ton <= sell_min_price
+                        then (select min(price_per_ton) from sell_offers where resource_id = old.resource_id)
+                        else sell_min_price end
+                where resource_id = old.resource_id;
+            end if;
+            if tg_op in ('INSERT', 'UPDATE') then
+                insert into market_summary (resource_id, sell_count, sell_price_sum, sell_min_price)
+                values (new.resource_id, 1, new.price_per_ton, new.price_per_ton)
+                on conflict (resource_id) do update set
+                    sell_count = market_summary.sell_count + 1,
+                    sell_price_sum = market_summary.sell_price_sum + excluded.sell_price_sum,
+                    sell_min_price = least(market_summary.sell_min_price, excluded.sell_min_price);
+            end if;
+            return null;
+        end;
+        $$ language plpgsql;
+        """,
+        """
+        create or replace function market_summary_buy_offers() returns trigger as $$
+        begin
+            if tg_op in ('DELETE', 'UPDATE') then
+                update market_summary set
+                    buy_count = buy_count - 1,
+                    buy_price_sum = case when buy_count = 1 then 0 else buy_price_sum - old.price_per_ton end,
+                    buy_max_price = case when old.price_per_ton >= buy_max_price
+                        then (select max(price_per_ton) from buy_offers where resource_id = old.resource_id)
+                        else buy_max_price end
+                where resource_id = old.resource_id;
+            end if;
+            if tg_op in ('INSERT', 'UPDATE') then
+                insert into market_summary (resource_id, buy_count, buy_price_sum, buy_max_price)
+                values (new.resource_id, 1, new.price_per_ton, new.price_per_ton)
+                on conflict (resource_id) do update set
+                    buy_count = market_summary.buy_count + 1,
+                    buy_price_sum = market_summary.buy_price_sum + excluded.buy_price_sum,
+                    buy_max_price = greatest(market_summary.buy_max_price, excluded.buy_max_price);
+            end if;
+            return null;
+        end;
+        $$ language plpgsql;
+        """,
+        """
+        create or replace function market_summary_transactions() returns trigger as $$
+        begin
+            if tg_op in ('DELETE', 'UPDATE') then
+                update market_summary set
+                    trade_count = trade_count - 1,
+                    trade_price_sum = case when trade_count = 1 then 0 else trade_price_sum - old.price_per_ton end,
+                    trade_quantity_sum = case when trade_count = 1 then 0 else trade_quantity_sum - old.quantity end
+                where resource_id = old.resource_id;
+            end if;
+            if tg_op in ('INSERT', 'UPDATE') then
+                insert into market_summary (resource_id, trade_count, trade_price_sum, trade_quantity_sum)
+                values (new.resource_id, 1, new.price_per_ton, new.quantity)
+                on conflict (resource_id) do update set
+                    trade_count = market_summary.trade_count + 1,
+                    trade_price_sum = market_summary.trade_price_sum + excluded.trade_price_sum,
+                    trade_quantity_sum = market_summary.trade_quantity_sum + excluded.trade_quantity_sum;
+            end if;
+            return null;
+        end;
+        $$ language plpgsql;
+        """,
+        "drop trigger if exists sell_offers_market_summary on sell_offers;",
+        """
+        create trigger sell_offers_market_summary
+        after insert or delete or update of resource_id, price_per_ton on sell_offers
+        for each row execute procedure market_summary_sell_offers();
+        """,
+        "drop trigger if exists buy_offers_market_summary on buy_offers;",
+        """
+        create trigger buy_offers_market_summary
+        after insert or delete or update of resource_id, price_per_ton on buy_offers
+        for each row execute procedure market_summary_buy_offers();
+        """,
+        "drop trigger if exists transactions_market_summary on transactions;",
+        """
+        create trigger transactions_market_summary
+        after insert or delete or update of resource_id, price_per_ton, quantity on transactions
+        for each row execute procedure market_summary_transactions();
+        """,
+        BACKFILL_MARKET_SUMMARY,
+    ]),
+    (3, "hourly per-resource activity counters for popularity rankings", [
+        """
+        create table if not exists resource_activity (
+            kind text not null,
+            bucket_start timestamp not null,
+            resource_id int4 references resources(resource_id) on delete cascade,
+            count int8 not null default 0,
+            primary key (kind, bucket_start, resource_id)
+        );
+        """,
+        """
+        create or replace function count_resource_activity() returns trigger as $$
+        begin
+            insert into resource_activity (kind, bucket_start, resource_id, count)
+            values (tg_argv[0], date_trunc('hour', now()), new.resource_id, 1)
+            on conflict (kind, bucket_start, resource_id) do update set count = resource_activity.count + 1;
+            return null;
+        end;
+        $$ language plpgsql;
+        """,
+        "drop trigger if exists sell_offers_activity on sell_offers;",
+        """
+        create trigger sell_offers_activity after insert on sell_offers
+        for each row execute procedure count_resource_activity('sell_offers');
+        """,
+        "drop trigger if exists buy_offers_activity on buy_offers;",
+        """
+        create trigger buy_offers_activity after insert on buy_offers
+        for each row execute procedure count_resource_activity('buy_offers');
+        """,
+        "drop trigger if exists transactions_activity on transactions;",
+        """
+        create trigger transactions_activity after insert on transactions
+        for each row execute procedure count_resource_activity('transactions');
+        """,
+        BACKFILL_RESOURCE_ACTIVITY,
+    ]),
+    (4, "price_candles rolled up from price ticks and transaction volume", [
+        """
+        create table if not exists price_candles (
+            resource_id int4 references resources(resource_id) on delete cascade,
+            resolution text not null,
+            bucket_start timestamp not null,
+            open float,
+            high float,
+            low float,
+            close float,
+            volume float not null default 0,
+            primary key (resource_id, resolution, bucket_start)
+        );
+        """,
+        """
+        create or replace function roll_up_transaction_volume() returns trigger as $$
+        begin
+            if new.resource_id is null then
+                return null;
+            end if;
+            insert into price_candles (resource_id, resolution, bucket_start, volume)
+            select new.resource_id, r.resolution, date_trunc(r.unit, coalesce(new.transaction_time, now())), new.quantity
+            from (values ('1m', 'minute'), ('1h', 'hour'), ('1d', 'day')) as r(resolution, unit)
+            on conflict (resource_id, resolution, bucket_start) do update set volume = price_candles.volume + excluded.volume;
+            return null;
+        end;
+        $$ language plpgsql;
+        """,
+        "drop trigger if exists transactions_candle_volume on transactions;",
+        """
+        create trigger transactions_candle_volume after insert on transactions
+        for each row execute procedure roll_up_transaction_volume();
+        """,
+        """
+        insert into price_candles (resource_id, resolution, bucket_start, open, high, low, close)
+        select p.resource_id, r.resolution, date_trunc(r.unit, p.timestamp),
+               (array_agg(p.price order by p.timestamp, p.data_id))[1], max(p.price), min(p.price),
+               (array_agg(p.price order by p.timestamp desc, p.data_id desc))[1]
+        from price_statistics p
+        cross join (values ('1m', 'minute'), ('1h', 'hour'), ('1d', 'day')) as r(resolution, unit)
+        where p.resource_id is not null and p.timestamp is not null
+        group by 1, 2, 3
+        on conflict (resource_id, resolution, bucket_start) do nothing;
+        """,
+        BACKFILL_CANDLE_VOLUME,
+    ]),
+    (5, "monthly range partitions for transactions and price_statistics", [
+        # a month whose rows already landed in the default partition cannot get
+        # its own partition any more, it stays in the default one
+        """
+        create or replace function ensure_monthly_partition(parent text, key_column text, month date) returns boolean as $$
+        declare
+            start_date date := date_trunc('month', month)::date;
+            end_date date := (date_trunc('month', month) + interval '1 month')::date;
+            partition_name text := parent || '_' || to_char(date_trunc('month', month), 'YYYY_MM');
+            misplaced boolean;
+        begin
+            if to_regclass(partition_name) is not null then
+                return false;
+            end if;
+            execute format('select exists (select 1 from %I where %I >= %L and %I < %L)',
+                           parent || '_default', key_column, start_date, key_column, end_date) into misplaced;
+            if misplaced then
+                return false;
+            end if;
+            execute format('create table %I partition of %I for values from (%L) to (%L)',
+                           partition_name, parent, start_date, end_date);
+            return true;
+        end;
+        $$ language plpgsql;
+        """,
+        """
+        create or replace function drop_monthly_partitions_before(parent text, cutoff date) returns setof text as $$
+        declare
+            partition_name text;
+        begin
+            for partition_name in
+                select c.relname from pg_inherits i
+                join pg_class c on c.oid = i.inhrelid
+                join pg_class p on p.oid = i.inhparent
+                where p.relname = parent and c.relname ~ ('^' || parent || '_[0-9]{4}_[0-9]{2}$')
+            loop
+                if to_date(right(partition_name, 7), 'YYYY_MM') + interval '1 month' <= cutoff then
+                    execute format('drop table %I', partition_name);
+                    return next partition_name;
+                end if;
+            end loop;
+        end;
+        $$ language plpgsql;
+        """,
+        "alter table transactions rename to transactions_unpartitioned;",
+        "alter sequence transactions_transaction_id_seq owned by none;",
+        """
+        create table transactions (
+            transaction_id int4 not null default nextval('transactions_transaction_id_seq'),
+            buyer_id int4 references companies(company_id) on delete cascade,
+            seller_id int4 references companies(company_id) on delete cascade,
+            resource_id int4 references resources(resource_id) on delete cascade,
+            quantity float not null,
+            price_per_ton float not null,
+            transaction_time timestamp not null default now(),
+            primary key (transaction_id, transaction_time)
+        ) partition by range (transaction_time);
+        """,
+        "create table transactions_default partition of transactions default;",
+        """
+        do $$
+        declare
+            first_month date;
+        begin
+            select date_trunc('month', coalesce(min(transaction_time), now()))::date into first_month from transactions_unpartitioned;
+            perform ensure_monthly_partition('transactions', 'transaction_time', m::date)
+            from generate_series(first_month, date_trunc('month', now()) + interval '3 months', interval '1 month') m;
+        end $$;
+        """,
+        """
+        insert into transactions (transaction_id, buyer_id, seller_id, resource_id, quantity, price_per_ton, transaction_time)
+        select transaction_id, buyer_id, seller_id, resource_id, quantity, price_per_ton, coalesce(transaction_time, now())
+        from transactions_unpartitioned;
+        """,
+        "drop table transactions_unpartitioned;",
+        "alter sequence transactions_transaction_id_seq owned by transactions.transaction_id;",
+        "create index if not exists transactions_resource_idx on transactions (resource_id, price_per_ton, quantity);",
+        "create index if not exists transactions_buyer_idx on transactions (buyer_id);",
+        "create index if not exists transactions_seller_idx on transactions (seller_id);",
+        """
+        create trigger transactions_market_summary
+        after insert or delete or update of resource_id, price_per_ton, quantity on transactions
+        for each row execute procedure market_summary_transactions();
+        """,
+        """
+        create trigger transactions_activity after insert on transactions
+        for each row execute procedure count_resource_activity('transactions');
+        """,
+        """
+        create trigger transactions_candle_volume after insert on transactions
+        for each row execute procedure roll_up_transaction_volume();
+        """,
+        "alter table price_statistics rename to price_statistics_unpartitioned;",
+        "alter sequence price_statistics_data_id_seq owned by none;",
+        """
+        create table price_statistics (
+            data_id int4 not null default nextval('price_statistics_data_id_seq'),
+            resource_id int4 references resources(resource_id),
+            timestamp timestamp not null default now(),
+            price float,
+            primary key (data_id, timestamp)
+        ) partition by range (timestamp);
+        """,
+        "create table price_statistics_default partition of price_statistics default;",
+        """
+        do $$
+        declare
+            first_month date;
+        begin
+            select date_trunc('month', coalesce(min(timestamp), now()))::date into first_month from price_statistics_unpartitioned;
+            perform ensure_monthly_partition('price_statistics', 'timestamp', m::date)
+            from generate_series(first_month, date_trunc('month', now()) + interval '3 months', interval '1 month') m;
+        end $$;
+        """,
+        """
+        insert into price_statistics (data_id, resource_id, timestamp, price)
+        select data_id, resource_id, coalesce(timestamp, now()), price from price_statistics_unpartitioned;
+        """,
+        "drop table price_statistics_unpartitioned;",
+        "alter sequence price_statistics_data_id_seq owned by price_statistics.data_id;",
+        "create index if not exists price_statistics_resource_timestamp_idx on price_statistics (resource_id, timestamp);",
+        "create index if not exists price_statistics_timestamp_idx on price_statistics (timestamp);",
+    ]),
+    (6, "offer expiry indexes and archive tables", [
+        # partial, offers without an end date never expire and stay out of the index
+        "create index if not exists sell_offers_end_date_idx on sell_offers (offer_end_date) where offer_end_date is not null;",
+        "create index if not exists buy_offers_end_date_idx on buy_offers (offer_end_date) where offer_end_date is not null;",
+        """
+        create table if not exists sell_offers_archive (
+            like sell_offers,
+            archived_at timestamp not null default now()
+        );
+        """,
+        """
+        create table if not exists buy_offers_archive (
+            like buy_offers,
+            archived_at timestamp not null default now()
+        );
+        """,
+        "create index if not exists sell_offers_archive_seller_idx on sell_offers_archive (seller_id);",
+        "create index if not exists buy_offers_archive_buyer_idx on buy_offers_archive (buyer_id);",
+    ]),
+]
+
+
+# Applies every migration that is not recorded in schema_migrations yet and
+# returns their versions. Everything runs in the caller's transaction under an
+# advisory lock, so concurrent workers cannot apply the same version twice.
+def apply_migrations(cursor):
+    cursor.execute(LOCK_MIGRATIONS, (MIGRATION_LOCK_KEY, ))
+    cursor.execute(CREATE_SCHEMA_MIGRATIONS_TABLE)
+    cursor.execute(SELECT_APPLIED_MIGRATIONS)
+    applied = set(row[0] for row in cursor.fetchall())
+
+    versions = []
+    for version, description, statements in MIGRATIONS:
+        if version in applied:
+            continue
+
+        for statement in statements:
+            cursor.execute(statement)
+        cursor.execute(INSERT_INTO_SCHEMA_MIGRATIONS, (version, description))
+        versions.append(version)
+
+    return versions
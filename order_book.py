@@ -0,0 +1,260 @@
+import heapq
+import itertools
+import threading
+from collections import namedtuple
+from datetime import datetime
+
+BUY = 'buy'
+SELL = 'sell'
+
+# quantities are stored as floats, anything below this is treated as filled
+EPSILON = 0.000001
+
+Fill = namedtuple('Fill', ['buy_offer_id', 'sell_offer_id', 'buyer_id', 'seller_id', 'resource_id', 'quantity', 'price_per_ton'])
+
+_sequence = itertools.count()
+
+
+# a fill the tables no longer agree with, the rows were changed behind the book
+class StaleBook(RuntimeError):
+    pass
+
+
+# raised by a settle callback for a fill that cannot be honoured, side names
+# the order whose owner cannot pay or deliver
+class Unsettled(Exception):
+    def __init__(self, side, message=None):
+        super().__init__(message or side)
+        self.side = side
+
+
+class Order:
+    __slots__ = ('side', 'offer_id', 'company_id', 'resource_id', 'quantity', 'price_per_ton',
+                 'offer_start_date', 'offer_end_date', 'min_amount', 'seq')
+
+    def __init__(self, side, offer_id, company_id, resource_id, quantity, price_per_ton,
+                 offer_start_date=None, offer_end_date=None, min_amount=None):
+        self.side = side
+        self.offer_id = offer_id
+        self.company_id = company_id
+        self.resource_id = resource_id
+        self.quantity = quantity
+        self.price_per_ton = price_per_ton
+        self.offer_start_date = offer_start_date
+        self.offer_end_date = offer_end_date
+        self.min_amount = min_amount or 0
+        self.seq = next(_sequence)
+
+    # rows of sell_offers / buy_offers share the same column layout
+    @classmethod
+    def from_row(cls, side, row):
+        return cls(side, row[0], row[1], row[2], row[3], row[4], row[5], row[6], row[7])
+
+    def is_expired(self, now):
+        return self.offer_end_date is not None and self.offer_end_date <= now
+
+    def min_fill(self):
+        return min(self.min_amount, self.quantity)
+
+    def crosses(self, other):
+        if self.side == BUY:
+            return self.price_per_ton >= other.price_per_ton
+        return self.price_per_ton <= other.price_per_ton
+
+
+# Price-time priority book for one resource. Both sides are heaps with lazy
+# deletion: removed or amended orders stay in the heap until they reach the
+# top, where they are recognised as stale through their sequence number.
+class OrderBook:
+    def __init__(self, resource_id, forget=None):
+        self.resource_id = resource_id
+        self.forget = forget
+        self.lock = threading.RLock()
+        self.stale = True
+        self._heaps = {BUY: [], SELL: []}
+        self._orders = {BUY: {}, SELL: {}}
+
+    def __len__(self):
+        return len(self._orders[BUY]) + len(self._orders[SELL])
+
+    def _key(self, order):
+        if order.side == BUY:
+            return (-order.price_per_ton, order.seq, order.offer_id)
+        return (order.price_per_ton, order.seq, order.offer_id)
+
+    def clear(self):
+        self._heaps = {BUY: [], SELL: []}
+        self._orders = {BUY: {}, SELL: {}}
+
+    def get(self, side, offer_id):
+        return self._orders[side].get(offer_id)
+
+    def add(self, order):
+        self._orders[order.side][order.offer_id] = order
+        heapq.heappush(self._heaps[order.side], self._key(order))
+
+    def remove(self, side, offer_id):
+        return self._orders[side].pop(offer_id, None)
+
+    # drops an order that ran out while matching, forget lets the engine
+    # drop its location as well
+    def _expire(self, side, offer_id):
+        self.remove(side, offer_id)
+        if self.forget is not None:
+            self.forget(side, offer_id)
+
+    def _live(self, side, entry):
+        order = self._orders[side].get(entry[2])
+        if order is None or order.seq != entry[1]:
+            return None
+        return order
+
+    def best(self, side, now):
+        heap = self._heaps[side]
+        while heap:
+            order = self._live(side, heap[0])
+            if order is not None and not order.is_expired(now):
+                return order
+            heapq.heappop(heap)
+            if order is not None:
+                self._expire(side, order.offer_id)
+        return None
+
+    # Matches an incoming order against the opposite side and books whatever
+    # is left of it. Resting orders are walked best-first; the ones that
+    # cannot take part (own orders, min_amount not met) are put back untouched.
+    # settle is called with every fill before it is applied to the book; when
+    # it raises Unsettled for the resting order that order is passed over, for
+    # the incoming one matching stops and the rest of it is booked.
+    def submit(self, order, now, settle=None):
+        fills = []
+        if order.is_expired(now):
+            return fills
+
+        opposite = SELL if order.side == BUY else BUY
+        heap = self._heaps[opposite]
+        skipped = []
+
+        while order.quantity > EPSILON and heap:
+            entry = heapq.heappop(heap)
+            resting = self._live(opposite, entry)
+            if resting is None:
+                continue
+            if resting.is_expired(now):
+                self._expire(opposite, resting.offer_id)
+                continue
+            if not order.crosses(resting):
+                skipped.append(entry)
+                break
+
+            quantity = min(order.quantity, resting.quantity)
+            if resting.company_id == order.company_id or quantity < order.min_fill() or quantity < resting.min_fill():
+                skipped.append(entry)
+                continue
+
+            if order.side == BUY:
+                buy, sell = order, resting
+            else:
+                buy, sell = resting, order
+            fill = Fill(buy.offer_id, sell.offer_id, buy.company_id, sell.company_id,
+                        self.resource_id, quantity, resting.price_per_ton)
+            try:
+                if settle is not None:
+                    settle(fill)
+            except Unsettled as e:
+                skipped.append(entry)
+                if e.side == order.side:
+                    break
+                continue
+            fills.append(fill)
+
+            order.quantity -= quantity
+            resting.quantity -= quantity
+            if resting.quantity > EPSILON:
+                skipped.append(entry)
+            else:
+                self.remove(opposite, resting.offer_id)
+
+        for entry in skipped:
+            heapq.heappush(heap, entry)
+
+        if order.quantity > EPSILON:
+            self.add(order)
+        else:
+            self.remove(order.side, order.offer_id)
+        return fills
+
+
+class MatchingEngine:
+    def __init__(self):
+        self._books = {}
+        self._locations = {}
+        self._lock = threading.Lock()
+
+    def book(self, resource_id):
+        with self._lock:
+            book = self._books.get(resource_id)
+            if book is None:
+                book = self._books[resource_id] = OrderBook(resource_id, self._forget)
+            return book
+
+    # resource of an offer this process has booked, None when it is not known
+    def locate(self, side, offer_id):
+        return self._locations.get((side, int(offer_id)))
+
+    def _forget(self, side, offer_id):
+        self._locations.pop((side, offer_id), None)
+
+    # Rebuilds a book from the offer rows of its resource. The rows are
+    # replayed through submit oldest first, so offers that were written
+    # without being matched are matched now instead of leaving the book
+    # crossed; the fills go through settle and are returned. Callers clear
+    # book.stale before they read the rows, an invalidate() that comes in
+    # while they do is kept.
+    def load(self, book, sell_rows, buy_rows, now, settle=None):
+        for key, resource_id in list(self._locations.items()):
+            if resource_id == book.resource_id:
+                self._locations.pop(key, None)
+        book.clear()
+
+        rows = [(side, row) for side, side_rows in ((SELL, sell_rows), (BUY, buy_rows)) for row in side_rows]
+        rows.sort(key=lambda item: (item[1][5] or datetime.min, item[1][0]))
+        fills = []
+        for side, row in rows:
+            fills.extend(self.submit(book, Order.from_row(side, row), now, settle))
+        return fills
+
+    def submit(self, book, order, now, settle=None):
+        self._locations[(order.side, order.offer_id)] = book.resource_id
+        fills = book.submit(order, now, settle)
+        for fill in fills:
+            for side, offer_id in ((BUY, fill.buy_offer_id), (SELL, fill.sell_offer_id)):
+                if book.get(side, offer_id) is None:
+                    self._locations.pop((side, offer_id), None)
+        return fills
+
+    def remove(self, side, offer_id):
+        resource_id = self._locations.pop((side, int(offer_id)), None)
+        if resource_id is None:
+            return None
+        book = self.book(resource_id)
+        with book.lock:
+            return book.remove(side, int(offer_id))
+
+    # takes quantity off a resting order that was traded outside the book;
+    # the caller holds book.lock
+    def fill(self, book, side, offer_id, quantity):
+        order = book.get(side, offer_id)
+        if order is None:
+            return
+        order.quantity -= quantity
+        if order.quantity <= EPSILON:
+            book.remove(side, offer_id)
+            self._locations.pop((side, offer_id), None)
+
+    def invalidate(self, resource_id=None):
+        with self._lock:
+            books = list(self._books.values()) if resource_id is None else [self._books.get(resource_id)]
+        for book in books:
+            if book is not None:
+                book.stale = True
@@ -0,0 +1,68 @@
+from collections import namedtuple
+from functools import lru_cache
+
+from statements import registry
+
+# a table whose rows belong to one company: key is the id in the URL, owner
+# the column compared with the caller
+OwnedTable = namedtuple('OwnedTable', ['table', 'key', 'owner'])
+
+COMPANIES = OwnedTable('companies', 'public_id', 'public_id')
+SELL_OFFERS = OwnedTable('sell_offers', 'sell_offer_id', 'seller_id')
+BUY_OFFERS = OwnedTable('buy_offers', 'buy_offer_id', 'buyer_id')
+COMPANY_RESOURCES = OwnedTable('company_resources', 'company_resource_id', 'company_id')
+
+# the last parameter is the caller's admin flag, admins may change any row
+UPDATE_OWNED = ("update {table} set {assignments} where {key} = %s and ({owner} = %s or %s) returning *;")
+
+DELETE_OWNED = ("delete from {table} where {key} = %s and ({owner} = %s or %s) returning *;")
+
+SELECT_OWNED_EXISTS = ("select 1 from {table} where {key} = %s;")
+
+
+class NotFound(LookupError):
+    pass
+
+
+class Forbidden(PermissionError):
+    pass
+
+
+# Statements are built from the whitelisted tables and columns only, so there
+# is a bounded number of them and each one is prepared like the app constants.
+@lru_cache(maxsize=None)
+def _statement(template, owned, columns=()):
+    assignments = ', '.join('%s = %%s' % column for column in columns)
+    query = template.format(table=owned.table, key=owned.key, owner=owned.owner, assignments=assignments)
+    registry.register(query)
+    return query
+
+
+# Called once the mutation matched no row, which is the uncommon path: tells
+# a missing row from one that belongs to somebody else.
+def _raise_missing(cursor, owned, row_id):
+    cursor.execute(_statement(SELECT_OWNED_EXISTS, owned), (row_id, ))
+    if cursor.fetchone() is None:
+        raise NotFound("no %s row with %s %s" % (owned.table, owned.key, row_id))
+    raise Forbidden("%s row %s belongs to another company" % (owned.table, row_id))
+
+
+# Sets the (column, value) pairs in changes on one row in a single statement
+# that also checks the owner, and returns the updated row.
+def update_owned(cursor, owned, changes, row_id, owner_id, admin):
+    columns = tuple(column for column, value in changes)
+    values = [value for column, value in changes]
+
+    cursor.execute(_statement(UPDATE_OWNED, owned, columns), values + [row_id, owner_id, bool(admin)])
+    row = cursor.fetchone()
+    if row is None:
+        _raise_missing(cursor, owned, row_id)
+    return row
+
+
+def delete_owned(cursor, owned, row_id, owner_id, admin):
+    cursor.execute(_statement(DELETE_OWNED, owned), (row_id, owner_id, bool(admin)))
+    row = cursor.fetchone()
+    if row is None:
+        _raise_missing(cursor, owned, row_id)
+    return row
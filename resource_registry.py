@@ -0,0 +1,91 @@
+import logging
+import threading
+import time
+
+import psycopg2
+
+logger = logging.getLogger(__name__)
+
+SELECT_RESOURCES = ("select resource_id, resource_name from resources order by resource_id;")
+
+
+# In-memory copy of the resources table, which is small and close to static.
+# It is loaded on first use, extended by the worker that creates a resource
+# and reloaded when an unknown id turns up, at most once per miss_refresh
+# seconds, so resources created through another worker are picked up too.
+class ResourceRegistry:
+    def __init__(self, pool, miss_refresh=5):
+        self.pool = pool
+        self.miss_refresh = miss_refresh
+        self._names = None
+        self._loaded_at = 0
+        self._lock = threading.Lock()
+
+    def refresh(self):
+        with self.pool.connection() as connection:
+            with connection:
+                with connection.cursor() as cursor:
+                    cursor.execute(SELECT_RESOURCES)
+                    rows = cursor.fetchall()
+
+        return self.replace(rows)
+
+    # installs (resource_id, resource_name) rows loaded elsewhere, e.g. by the async app
+    def replace(self, rows):
+        names = dict(rows)
+        with self._lock:
+            self._names = names
+            self._loaded_at = time.monotonic()
+        return names
+
+    def preload(self):
+        try:
+            self.refresh()
+        except psycopg2.Error:
+            logger.warning("resources are not loaded yet, they will be on first use")
+
+    def invalidate(self):
+        with self._lock:
+            self._names = None
+
+    def add(self, resource_id, resource_name):
+        with self._lock:
+            if self._names is not None:
+                self._names[resource_id] = resource_name
+
+    def _lookup(self, resource_id):
+        names = self._names
+        if names is None:
+            return self.refresh().get(resource_id)
+
+        name = names.get(resource_id)
+        if name is None and time.monotonic() - self._loaded_at > self.miss_refresh:
+            name = self.refresh().get(resource_id)
+        return name
+
+    # lookup without any I/O, None for unknown ids; reload_due tells whether
+    # the caller should reload the table before trusting a miss
+    def cached_name(self, resource_id):
+        names = self._names
+        if names is None:
+            return None
+        return names.get(resource_id)
+
+    def reload_due(self):
+        return self._names is None or time.monotonic() - self._loaded_at > self.miss_refresh
+
+    def name(self, resource_id):
+        try:
+            resource_id = int(resource_id)
+        except (TypeError, ValueError):
+            return None
+        return self._lookup(resource_id)
+
+    def exists(self, resource_id):
+        return self.name(resource_id) is not None
+
+    def all(self):
+        names = self._names
+        if names is None:
+            names = self.refresh()
+        return sorted(names.items())
@@ -0,0 +1,158 @@
+import threading
+from contextlib import contextmanager
+from functools import wraps
+
+from flask import g, has_app_context, make_response, request
+
+from cache import TTLCache
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+
+# per-process store and version counters. Other workers only see a bump once
+# their own entries expire, so ttl bounds how stale they can be
+class LocalBackend:
+    def __init__(self, maxsize, ttl):
+        self.entries = TTLCache(maxsize, ttl)
+        self._versions = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        return self.entries.get(key)
+
+    def set(self, key, entry):
+        self.entries.set(key, entry)
+
+    def versions(self, namespaces):
+        with self._lock:
+            return tuple(self._versions.get(namespace, 0) for namespace in namespaces)
+
+    def bump(self, namespaces):
+        with self._lock:
+            for namespace in namespaces:
+                self._versions[namespace] = self._versions.get(namespace, 0) + 1
+
+
+# entries and version counters shared by all workers through Redis
+class RedisBackend:
+    def __init__(self, url, ttl, prefix='response_cache:'):
+        self.client = redis.Redis.from_url(url)
+        self.ttl = ttl
+        self.prefix = prefix
+
+    def get(self, key):
+        value = self.client.get(self.prefix + key)
+        if value is None:
+            return None
+        etag, mimetype, body = value.split(b'\n', 2)
+        return etag.decode(), mimetype.decode(), body
+
+    def set(self, key, entry):
+        etag, mimetype, body = entry
+        self.client.set(self.prefix + key, etag.encode() + b'\n' + mimetype.encode() + b'\n' + body, ex=max(1, int(self.ttl)))
+
+    def versions(self, namespaces):
+        values = self.client.mget([self.prefix + 'version:' + namespace for namespace in namespaces])
+        return tuple(int(value or 0) for value in values)
+
+    def bump(self, namespaces):
+        with self.client.pipeline() as pipeline:
+            for namespace in namespaces:
+                pipeline.incr(self.prefix + 'version:' + namespace)
+            pipeline.execute()
+
+
+# Caches successful responses of read-only views, keyed by path, query string
+# and the version of every namespace the view reads. Writes call
+# mark_changed(namespace); the versions are bumped when the request ends, after
+# its transaction committed, so no later request can cache the old data under
+# the new version. Cached and fresh responses carry an ETag and answer a
+# matching If-None-Match with 304.
+class ResponseCache:
+    def __init__(self, backend=None):
+        self.backend = backend
+        self._local = threading.local()
+
+    def init_app(self, app):
+        app.teardown_appcontext(self._bump_changed)
+
+    def mark_changed(self, *namespaces):
+        if self.backend is None:
+            return
+        if has_app_context():
+            g.setdefault('changed_namespaces', set()).update(namespaces)
+        elif getattr(self._local, 'changed', None) is not None:
+            self._local.changed.update(namespaces)
+        else:
+            self.backend.bump(namespaces)
+
+    # the app-context-free counterpart of the teardown: marks made inside the
+    # block are bumped when it exits, which has to be after the commit
+    @contextmanager
+    def deferred(self):
+        self._local.changed = set()
+        try:
+            yield
+        finally:
+            namespaces, self._local.changed = self._local.changed, None
+            if namespaces and self.backend is not None:
+                self.backend.bump(sorted(namespaces))
+
+    def _bump_changed(self, exception):
+        namespaces = g.pop('changed_namespaces', None)
+        if namespaces and self.backend is not None:
+            self.backend.bump(sorted(namespaces))
+
+    def _key(self, namespaces):
+        versions = self.backend.versions(namespaces)
+        args = '&'.join('%s=%s' % item for item in sorted(request.args.items(multi=True)))
+        return '%s?%s#%s' % (request.path, args, '.'.join(str(version) for version in versions))
+
+    def _conditional(self, response):
+        response.cache_control.no_cache = True
+        return response.make_conditional(request)
+
+    def cached(self, *namespaces):
+        def decorator(f):
+            @wraps(f)
+            def decorated(*args, **kwargs):
+                if self.backend is None:
+                    return f(*args, **kwargs)
+
+                key = self._key(namespaces)
+                entry = self.backend.get(key)
+                if entry is not None:
+                    etag, mimetype, body = entry
+                    response = make_response(body)
+                    response.mimetype = mimetype
+                    response.set_etag(etag)
+                    return self._conditional(response)
+
+                response = make_response(f(*args, **kwargs))
+                if response.status_code != 200 or response.is_streamed:
+                    return response
+                # handlers report failures as a 200 with an error key, those are not kept
+                if response.is_json and 'error' in (response.get_json(silent=True) or {}):
+                    return response
+
+                etag = response.get_etag()[0]
+                if etag is None:
+                    response.add_etag()
+                    etag = response.get_etag()[0]
+                self.backend.set(key, (etag, response.mimetype, response.get_data()))
+                return self._conditional(response)
+            return decorated
+        return decorator
+
+
+def create_response_cache(maxsize, ttl, url=None):
+    if url:
+        if redis is None:
+            raise RuntimeError("RESPONSE_CACHE_URL is set but the redis package is not installed")
+        return ResponseCache(RedisBackend(url, ttl))
+    if maxsize > 0:
+        return ResponseCache(LocalBackend(maxsize, ttl))
+    return ResponseCache()
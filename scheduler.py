@@ -0,0 +1,81 @@
+import logging
+import random
+import threading
+from contextlib import nullcontext
+
+import psycopg2
+
+logger = logging.getLogger(__name__)
+
+TRY_LEADER_LOCK = ("select pg_try_advisory_lock(%s);")
+
+
+# Runs job(cursor) every interval seconds (plus up to jitter seconds) on a
+# daemon thread. Every app worker may start one, but only the worker holding
+# the Postgres advisory lock lock_key does the work. The lock lives on a
+# dedicated session that is not shared with the pool, so leadership passes
+# to another worker as soon as the leader's process or connection goes away.
+# scope, if given, returns a context manager that is entered around each run
+# including its commit.
+class PeriodicJob(threading.Thread):
+    def __init__(self, name, job, pool, dsn, lock_key, interval, jitter=0, scope=None):
+        super().__init__(name=name, daemon=True)
+        self.job = job
+        self.pool = pool
+        self.dsn = dsn
+        self.lock_key = lock_key
+        self.interval = interval
+        self.jitter = jitter
+        self.scope = scope
+        self.runs = 0
+        self.leader = False
+        self._leader_connection = None
+        self._stopped = threading.Event()
+
+    def stop(self):
+        self._stopped.set()
+
+    def is_leader(self):
+        try:
+            if self._leader_connection is None or self._leader_connection.closed:
+                self.leader = False
+                self._leader_connection = psycopg2.connect(self.dsn)
+                self._leader_connection.autocommit = True
+
+            with self._leader_connection.cursor() as cursor:
+                if self.leader:
+                    cursor.execute("select 1;")
+                else:
+                    cursor.execute(TRY_LEADER_LOCK, (self.lock_key, ))
+                    self.leader = bool(cursor.fetchone()[0])
+        except psycopg2.Error:
+            self._drop_leadership()
+
+        return self.leader
+
+    def _drop_leadership(self):
+        self.leader = False
+        if self._leader_connection is not None:
+            try:
+                self._leader_connection.close()
+            except psycopg2.Error:
+                pass
+        self._leader_connection = None
+
+    def run_once(self):
+        with self.scope() if self.scope is not None else nullcontext():
+            with self.pool.connection() as connection:
+                with connection:
+                    with connection.cursor() as cursor:
+                        result = self.job(cursor)
+        self.runs += 1
+        return result
+
+    def run(self):
+        while not self._stopped.wait(self.interval + random.uniform(0, self.jitter)):
+            try:
+                if self.is_leader():
+                    self.run_once()
+            except Exception:
+                logger.exception("%s failed", self.name)
+        self._drop_leadership()
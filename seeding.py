@@ -0,0 +1,181 @@
+import io
+import multiprocessing
+import random
+import string
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta
+
+from psycopg2.extras import execute_values
+from werkzeug.security import generate_password_hash
+
+from migrations import BACKFILL_CANDLE_VOLUME, BACKFILL_MARKET_SUMMARY, BACKFILL_RESOURCE_ACTIVITY
+
+# rows generated per unit of scale, scale=100 gives 100k companies and 1M offers per side
+COMPANIES_PER_SCALE = 1000
+OFFERS_PER_SCALE = 10000
+TRANSACTIONS_PER_SCALE = 10000
+COMPANY_RESOURCES_PER_SCALE = 2000
+
+# price ranges of the seeded offers, bids stay below asks so the books load
+# uncrossed and nothing is matched on first use
+BUY_PRICES = (20, 60)
+SELL_PRICES = (60, 100)
+
+# rows buffered per COPY round
+COPY_BATCH_SIZE = 100000
+
+SELECT_RESOURCE_IDS = ("select resource_id from resources;")
+
+INSERT_INTO_RESOURCES_BULK = ("insert into resources (resource_name) values %s returning resource_id;")
+
+INSERT_INTO_COMPANIES_BULK = ("""
+        insert into companies (public_id, company_name, account_balance, company_mail, password_hash, is_admin)
+        values %s returning company_id;
+    """)
+
+COPY_TRANSACTIONS = ("copy transactions (buyer_id, seller_id, resource_id, quantity, price_per_ton, transaction_time) from stdin;")
+
+COPY_BUY_OFFERS = ("copy buy_offers (buyer_id, resource_id, quantity, price_per_ton, offer_start_date, offer_end_date, min_amount) from stdin;")
+
+COPY_SELL_OFFERS = ("copy sell_offers (seller_id, resource_id, quantity, price_per_ton, offer_start_date, offer_end_date, min_amount) from stdin;")
+
+COPY_COMPANY_RESOURCES = ("copy company_resources (company_id, resource_id, stock_amount) from stdin;")
+
+# the COPY targets whose per-row triggers maintain the roll-up tables
+ROLLUP_SOURCE_TABLES = ('transactions', 'buy_offers', 'sell_offers')
+
+SELECT_TABLE_EXISTS = ("select to_regclass(%s) is not null;")
+
+# roll-up table and the statements that rebuild it from scratch, only run
+# where the migration that adds the table has been applied
+ROLLUP_REBUILDS = [
+    ('market_summary', ["delete from market_summary;", BACKFILL_MARKET_SUMMARY]),
+    ('resource_activity', ["delete from resource_activity;", BACKFILL_RESOURCE_ACTIVITY]),
+    ('price_candles', [BACKFILL_CANDLE_VOLUME]),
+]
+
+
+def hash_password(password):
+    return generate_password_hash(password, method='sha256')
+
+
+# salted hashing dominates seeding time, so it is spread over all cores. The
+# pool is spawned rather than forked because the web process runs threads.
+def hash_passwords(passwords, workers=None):
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context) as executor:
+        return list(executor.map(hash_password, passwords, chunksize=500))
+
+
+def copy_value(value):
+    if value is None:
+        return '\\N'
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return str(value).replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n')
+
+
+def copy_rows(cursor, statement, rows):
+    buffer = io.StringIO()
+    count = 0
+
+    for row in rows:
+        buffer.write('\t'.join(copy_value(value) for value in row))
+        buffer.write('\n')
+        count += 1
+
+        if count % COPY_BATCH_SIZE == 0:
+            buffer.seek(0)
+            cursor.copy_expert(statement, buffer)
+            buffer = io.StringIO()
+
+    if buffer.tell():
+        buffer.seek(0)
+        cursor.copy_expert(statement, buffer)
+
+    return count
+
+
+def load_resource_ids(cursor, resources_path):
+    cursor.execute(SELECT_RESOURCE_IDS)
+    resource_ids = [row[0] for row in cursor.fetchall()]
+    if resource_ids:
+        return resource_ids
+
+    with open(resources_path, "r") as resources_f:
+        names = [name for name in resources_f.read().split('\n') if name]
+
+    rows = execute_values(cursor, INSERT_INTO_RESOURCES_BULK, [(name, ) for name in names], fetch=True)
+    return [row[0] for row in rows]
+
+
+def seed_companies(cursor, count, workers=None):
+    run = uuid.uuid4().hex[:8]
+    passwords = [''.join(random.choice(string.ascii_letters) for i in range(10)) for n in range(count)]
+    hashes = hash_passwords(passwords, workers)
+
+    records = []
+    for n, password_hash in enumerate(hashes):
+        records.append((str(uuid.uuid4()), "Company %s-%s" % (run, n), random.random() * 1000000,
+                        "company%s%s@gmail.com" % (run, n), password_hash, False))
+
+    rows = execute_values(cursor, INSERT_INTO_COMPANIES_BULK, records, page_size=1000, fetch=True)
+    return [row[0] for row in rows]
+
+
+def offer_rows(company_ids, resource_ids, count, now, prices):
+    for i in range(count):
+        yield (random.choice(company_ids), random.choice(resource_ids), round(random.uniform(5, 1000), 2),
+               round(random.uniform(*prices), 2), now, now + timedelta(days=random.randint(1, 30)), 1)
+
+
+def transaction_rows(company_ids, resource_ids, count, now):
+    for i in range(count):
+        buyer_id, seller_id = random.sample(company_ids, 2)
+        yield (buyer_id, seller_id, random.choice(resource_ids), round(random.uniform(5, 1000), 2),
+               round(random.uniform(20, 100), 2), now - timedelta(seconds=random.randint(0, 30 * 24 * 3600)))
+
+
+def company_resource_rows(company_ids, resource_ids, count):
+    for i in range(count):
+        yield (random.choice(company_ids), random.choice(resource_ids), round(random.uniform(5, 1000), 2))
+
+
+def set_rollup_triggers(cursor, enabled):
+    for table in ROLLUP_SOURCE_TABLES:
+        cursor.execute("alter table %s %s trigger user;" % (table, 'enable' if enabled else 'disable'))
+
+
+def rebuild_rollups(cursor):
+    for table, statements in ROLLUP_REBUILDS:
+        cursor.execute(SELECT_TABLE_EXISTS, (table, ))
+        if cursor.fetchone()[0]:
+            for statement in statements:
+                cursor.execute(statement)
+
+
+# Loads a synthetic data set of the given scale into an initialized database
+# and returns the number of rows written per table. Companies go through
+# execute_values to get their ids back, everything else is streamed with COPY.
+#
+# The roll-up triggers would fire once per copied row, so they are disabled
+# for the load and the roll-ups rebuilt afterwards with the set-based backfills
+# of the migrations. ALTER TABLE is transactional, so a failed load leaves the
+# triggers enabled, and concurrent writers wait on the table locks until the
+# seed commits.
+def seed_bulk(cursor, scale, resources_path="./text_documents/resources.txt", workers=None):
+    now = datetime.now()
+    resource_ids = load_resource_ids(cursor, resources_path)
+    company_ids = seed_companies(cursor, COMPANIES_PER_SCALE * scale, workers)
+
+    set_rollup_triggers(cursor, False)
+    counts = {'companies' : len(company_ids)}
+    counts['transactions'] = copy_rows(cursor, COPY_TRANSACTIONS, transaction_rows(company_ids, resource_ids, TRANSACTIONS_PER_SCALE * scale, now))
+    counts['buy_offers'] = copy_rows(cursor, COPY_BUY_OFFERS, offer_rows(company_ids, resource_ids, OFFERS_PER_SCALE * scale, now, BUY_PRICES))
+    counts['sell_offers'] = copy_rows(cursor, COPY_SELL_OFFERS, offer_rows(company_ids, resource_ids, OFFERS_PER_SCALE * scale, now, SELL_PRICES))
+    counts['company_resources'] = copy_rows(cursor, COPY_COMPANY_RESOURCES, company_resource_rows(company_ids, resource_ids, COMPANY_RESOURCES_PER_SCALE * scale))
+    set_rollup_triggers(cursor, True)
+    rebuild_rollups(cursor)
+
+    return counts
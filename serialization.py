@@ -0,0 +1,91 @@
+from datetime import datetime
+from functools import lru_cache
+from operator import itemgetter
+
+from flask import g
+from flask.json.provider import DefaultJSONProvider
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+# Builds the function turning a row into a response dict. fields maps response
+# keys to column names (a "table." prefix is ignored) and the column positions
+# are looked up once per distinct query shape, not once per row.
+@lru_cache(maxsize=256)
+def _mapper(columns, fields):
+    position = dict((column, index) for index, column in enumerate(columns))
+    keys = tuple(key for key, column in fields)
+    indexes = [position[column.rsplit('.', 1)[-1]] for key, column in fields]
+
+    if len(indexes) == 1:
+        index = indexes[0]
+        return lambda row: {keys[0] : row[index]}
+
+    getter = itemgetter(*indexes)
+    return lambda row: dict(zip(keys, getter(row)))
+
+
+def row_mapper(cursor, fields):
+    columns = tuple(column[0] for column in cursor.description)
+    return _mapper(columns, tuple(fields.items()))
+
+
+# the date / timestamp pair stamped on response rows, taken once per request
+def request_timestamp():
+    if 'request_date' not in g:
+        g.request_date = datetime.now()
+        g.request_timestamp = datetime.timestamp(g.request_date)
+    return g.request_date, g.request_timestamp
+
+
+def stamp_rows(output):
+    dt, ts = request_timestamp()
+    for data in output:
+        data['date'] = dt
+        data['timestamp'] = ts
+    return output
+
+
+def map_rows(cursor, fields, rows, stamped=True):
+    mapper = row_mapper(cursor, fields)
+    output = [mapper(row) for row in rows]
+    if stamped:
+        stamp_rows(output)
+    return output
+
+
+def map_row(cursor, fields, row, stamped=True):
+    return map_rows(cursor, fields, [row], stamped)[0]
+
+
+# Flask JSON provider encoding with orjson. Datetimes, decimals and the other
+# types orjson would format differently are handed back to Flask's default
+# hook, so responses stay byte-compatible apart from whitespace.
+class OrjsonProvider(DefaultJSONProvider):
+    def _option(self):
+        option = orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_PASSTHROUGH_DATACLASS | orjson.OPT_NON_STR_KEYS
+        if self.sort_keys:
+            option |= orjson.OPT_SORT_KEYS
+        return option
+
+    def dumps(self, obj, **kwargs):
+        if kwargs:
+            return super().dumps(obj, **kwargs)
+        return orjson.dumps(obj, default=self.default, option=self._option()).decode()
+
+    def response(self, *args, **kwargs):
+        if self.compact is False or (self.compact is None and self._app.debug):
+            return super().response(*args, **kwargs)
+
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(orjson.dumps(obj, default=self.default, option=self._option()),
+                                        mimetype=self.mimetype)
+
+
+def install_json_provider(app):
+    if orjson is not None:
+        app.json_provider_class = OrjsonProvider
+        app.json = OrjsonProvider(app)
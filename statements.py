@@ -0,0 +1,114 @@
+import itertools
+import re
+import threading
+from collections import namedtuple
+
+import psycopg2
+import psycopg2.errors
+import psycopg2.extensions
+
+Statement = namedtuple('Statement', ['name', 'prepare', 'execute'])
+
+_PLACEHOLDER = re.compile(r'%[s%]')
+
+
+# rewrites psycopg2's %s placeholders as the $1, $2... the server expects
+def to_server_params(query):
+    counter = itertools.count(1)
+
+    def replace(match):
+        if match.group(0) == '%%':
+            return '%'
+        return '$%d' % next(counter)
+
+    return _PLACEHOLDER.sub(replace, query.strip().rstrip(';'))
+
+
+# Hot query constants that are PREPAREd once per pooled connection and then
+# run through EXECUTE, so Postgres skips parsing and planning on every call.
+# Lookups are keyed by the query text, handlers keep passing the constants.
+class StatementRegistry:
+    def __init__(self):
+        self._statements = {}
+        self._lock = threading.Lock()
+        self._counts = {'hits' : 0, 'prepares' : 0, 'reprepares' : 0}
+
+    def register(self, *queries):
+        with self._lock:
+            for query in queries:
+                if query in self._statements:
+                    continue
+                name = 'stmt_%d' % (len(self._statements) + 1)
+                params = len(_PLACEHOLDER.findall(query.replace('%%', '')))
+                arguments = '(%s)' % ', '.join(['%s'] * params) if params else ''
+                self._statements[query] = Statement(name, 'prepare %s as %s;' % (name, to_server_params(query)),
+                                                    'execute %s%s;' % (name, arguments))
+
+    def get(self, query):
+        return self._statements.get(query)
+
+    def count(self, key):
+        with self._lock:
+            self._counts[key] += 1
+
+    def stats(self):
+        with self._lock:
+            counts = dict(self._counts)
+        executes = counts['hits'] + counts['prepares'] + counts['reprepares']
+        counts['statements'] = len(self._statements)
+        counts['hit_ratio'] = counts['hits'] / executes if executes else None
+        return counts
+
+
+registry = StatementRegistry()
+
+
+class PreparingCursor(psycopg2.extensions.cursor):
+    def execute(self, query, vars=None):
+        statement = registry.get(query) if self.name is None else None
+        if statement is None:
+            return super().execute(query, vars)
+
+        connection = self.connection
+        starts_transaction = connection.autocommit or \
+            connection.get_transaction_status() == psycopg2.extensions.TRANSACTION_STATUS_IDLE
+
+        if connection.prepared is None:
+            super().execute("deallocate all;")
+            connection.prepared = set()
+
+        if statement.name in connection.prepared:
+            try:
+                super().execute(statement.execute, vars)
+                registry.count('hits')
+                return
+            except (psycopg2.errors.InvalidSqlStatementName, psycopg2.errors.FeatureNotSupported):
+                # the session lost its prepared statements (DISCARD ALL, a
+                # pooler handing out another backend) or a migration changed
+                # the result type of one. Only a statement that opened the
+                # transaction can be retried transparently, otherwise the
+                # statements are dropped before the connection is used again.
+                connection.prepared = None
+                if not starts_transaction:
+                    raise
+                if not connection.autocommit:
+                    connection.rollback()
+                super().execute("deallocate all;")
+                connection.prepared = set()
+                registry.count('reprepares')
+        else:
+            registry.count('prepares')
+
+        super().execute(statement.prepare)
+        connection.prepared.add(statement.name)
+        super().execute(statement.execute, vars)
+
+
+# Connection class for the pool: remembers which registry statements the
+# session has prepared. A replacement connection starts with an empty set,
+# so statements are prepared again after a connection has been recycled.
+class PreparingConnection(psycopg2.extensions.connection):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prepared = set()
+        self.cursor_factory = PreparingCursor
@@ -0,0 +1,92 @@
+import asyncio
+import json
+import os
+
+import pytest
+
+if not os.getenv("DATABASE_URL"):
+    pytest.skip("DATABASE_URL is not set", allow_module_level=True)
+
+pytest.importorskip("asyncpg")
+pytest.importorskip("a2wsgi")
+
+from app import app, resource_registry  # noqa: E402
+from asgi import AGGREGATE_ROUTES, application  # noqa: E402
+
+# stamped on every response at the time it is built
+VOLATILE_KEYS = ('date', 'timestamp')
+
+UNKNOWN_RESOURCE_IDS = ['999999999', 'abc']
+
+
+@pytest.fixture(scope='module')
+def loop():
+    loop = asyncio.new_event_loop()
+    loop.run_until_complete(application.startup())
+    yield loop
+    loop.run_until_complete(application.shutdown())
+    loop.close()
+
+
+def asgi_get(loop, path):
+    messages = []
+
+    async def receive():
+        return {'type' : 'http.request', 'body' : b'', 'more_body' : False}
+
+    async def send(message):
+        messages.append(message)
+
+    scope = {'type' : 'http', 'asgi' : {'version' : '3.0'}, 'http_version' : '1.1', 'method' : 'GET',
+             'scheme' : 'http', 'path' : path, 'raw_path' : path.encode(), 'root_path' : '',
+             'query_string' : b'', 'headers' : [], 'client' : ('127.0.0.1', 1), 'server' : ('testserver', 80)}
+    loop.run_until_complete(application(scope, receive, send))
+
+    start = messages[0]
+    headers = dict((key.decode().lower(), value.decode()) for key, value in start['headers'])
+    body = b''.join(message.get('body', b'') for message in messages[1:])
+    return start['status'], headers['content-type'], body
+
+
+def normalise(value):
+    if isinstance(value, dict):
+        return dict((key, normalise(item)) for key, item in value.items() if key not in VOLATILE_KEYS)
+    if isinstance(value, list):
+        return [normalise(item) for item in value]
+    return value
+
+
+def resource_ids():
+    return [str(resource_id) for resource_id, resource_name in resource_registry.all()] + UNKNOWN_RESOURCE_IDS
+
+
+def assert_same_response(loop, path):
+    flask_response = app.test_client().get(path)
+    status, content_type, body = asgi_get(loop, path)
+
+    assert status == flask_response.status_code
+    assert content_type.split(';')[0] == flask_response.mimetype
+    assert normalise(json.loads(body)) == normalise(flask_response.get_json())
+
+
+def test_all_resources(loop):
+    assert_same_response(loop, '/resources')
+
+
+@pytest.mark.parametrize('resource_id', resource_ids())
+def test_one_resource(loop, resource_id):
+    assert_same_response(loop, '/resources/' + resource_id)
+
+
+@pytest.mark.parametrize('route', [path for path, key, query, error in AGGREGATE_ROUTES])
+@pytest.mark.parametrize('resource_id', resource_ids())
+def test_aggregates(loop, route, resource_id):
+    assert_same_response(loop, route.replace(r'(\w+)', resource_id))
+
+
+def test_other_routes_fall_through_to_flask(loop):
+    status, content_type, body = asgi_get(loop, '/statistics')
+    flask_response = app.test_client().get('/statistics')
+
+    assert status == flask_response.status_code
+    assert normalise(json.loads(body)) == normalise(flask_response.get_json())
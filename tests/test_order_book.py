@@ -0,0 +1,257 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+from order_book import BUY, SELL, MatchingEngine, Order, OrderBook, StaleBook, Unsettled
+
+NOW = datetime(2026, 1, 1, 12)
+
+RESOURCE_ID = 1
+
+
+def order(side, offer_id, company_id, quantity, price_per_ton, offer_end_date=None, min_amount=None):
+    return Order(side, offer_id, company_id, RESOURCE_ID, quantity, price_per_ton,
+                 NOW - timedelta(days=1), offer_end_date, min_amount)
+
+
+def row(offer_id, company_id, quantity, price_per_ton, offer_start_date, offer_end_date=None, min_amount=0):
+    return (offer_id, company_id, RESOURCE_ID, quantity, price_per_ton, offer_start_date, offer_end_date, min_amount)
+
+
+def book_with(*orders):
+    book = OrderBook(RESOURCE_ID)
+    for resting in orders:
+        book.add(resting)
+    return book
+
+
+def traded(fills):
+    return [(fill.buy_offer_id, fill.sell_offer_id, fill.quantity, fill.price_per_ton) for fill in fills]
+
+
+def test_best_price_fills_first_at_the_resting_price():
+    book = book_with(order(SELL, 1, 10, 5, 52), order(SELL, 2, 11, 5, 50), order(SELL, 3, 12, 5, 51))
+
+    fills = book.submit(order(BUY, 4, 20, 12, 55), NOW)
+
+    assert traded(fills) == [(4, 2, 5, 50), (4, 3, 5, 51), (4, 1, 2, 52)]
+
+
+def test_earlier_order_fills_first_at_the_same_price():
+    book = book_with(order(BUY, 1, 10, 5, 50), order(BUY, 2, 11, 5, 50))
+
+    fills = book.submit(order(SELL, 3, 20, 5, 45), NOW)
+
+    assert traded(fills) == [(1, 3, 5, 50)]
+    assert book.get(BUY, 1) is None
+    assert book.get(BUY, 2).quantity == 5
+
+
+def test_orders_that_do_not_cross_rest_in_the_book():
+    book = book_with(order(SELL, 1, 10, 5, 60))
+
+    assert book.submit(order(BUY, 2, 20, 5, 55), NOW) == []
+    assert book.get(BUY, 2).quantity == 5
+    assert book.best(BUY, NOW).offer_id == 2
+    assert book.best(SELL, NOW).offer_id == 1
+
+
+def test_partial_fill_keeps_the_rest_of_the_resting_order():
+    book = book_with(order(SELL, 1, 10, 10, 50))
+
+    fills = book.submit(order(BUY, 2, 20, 4, 50), NOW)
+
+    assert traded(fills) == [(2, 1, 4, 50)]
+    assert book.get(SELL, 1).quantity == 6
+    assert book.get(BUY, 2) is None
+
+
+def test_partial_fill_books_the_rest_of_the_incoming_order():
+    book = book_with(order(SELL, 1, 10, 4, 50))
+
+    fills = book.submit(order(BUY, 2, 20, 10, 50), NOW)
+
+    assert traded(fills) == [(2, 1, 4, 50)]
+    assert book.get(SELL, 1) is None
+    assert book.get(BUY, 2).quantity == 6
+
+
+def test_resting_min_amount_skips_small_incoming_orders():
+    book = book_with(order(SELL, 1, 10, 10, 50, min_amount=5), order(SELL, 2, 11, 10, 51))
+
+    fills = book.submit(order(BUY, 3, 20, 3, 55), NOW)
+
+    assert traded(fills) == [(3, 2, 3, 51)]
+    assert book.get(SELL, 1).quantity == 10
+
+
+def test_incoming_min_amount_skips_small_resting_orders():
+    book = book_with(order(SELL, 1, 10, 2, 50), order(SELL, 2, 11, 10, 51))
+
+    fills = book.submit(order(BUY, 3, 20, 8, 55, min_amount=5), NOW)
+
+    assert traded(fills) == [(3, 2, 8, 51)]
+    assert book.get(SELL, 1).quantity == 2
+
+
+def test_own_orders_are_skipped():
+    book = book_with(order(SELL, 1, 20, 5, 50), order(SELL, 2, 11, 5, 51))
+
+    fills = book.submit(order(BUY, 3, 20, 5, 55), NOW)
+
+    assert traded(fills) == [(3, 2, 5, 51)]
+    assert book.get(SELL, 1).quantity == 5
+    assert book.best(SELL, NOW).offer_id == 1
+
+
+def test_expired_orders_are_dropped_lazily_and_forgotten():
+    forgotten = []
+    book = OrderBook(RESOURCE_ID, lambda side, offer_id: forgotten.append((side, offer_id)))
+    book.add(order(SELL, 1, 10, 5, 50, offer_end_date=NOW - timedelta(minutes=1)))
+    book.add(order(SELL, 2, 11, 5, 51))
+
+    assert book.get(SELL, 1) is not None
+    fills = book.submit(order(BUY, 3, 20, 5, 55), NOW)
+
+    assert traded(fills) == [(3, 2, 5, 51)]
+    assert book.get(SELL, 1) is None
+    assert forgotten == [(SELL, 1)]
+
+
+def test_best_drops_expired_orders():
+    forgotten = []
+    book = OrderBook(RESOURCE_ID, lambda side, offer_id: forgotten.append((side, offer_id)))
+    book.add(order(BUY, 1, 10, 5, 60, offer_end_date=NOW))
+    book.add(order(BUY, 2, 11, 5, 50))
+
+    assert book.best(BUY, NOW).offer_id == 2
+    assert forgotten == [(BUY, 1)]
+
+
+def test_expired_incoming_order_is_not_booked():
+    book = book_with(order(SELL, 1, 10, 5, 50))
+
+    assert book.submit(order(BUY, 2, 20, 5, 55, offer_end_date=NOW), NOW) == []
+    assert book.get(BUY, 2) is None
+    assert book.get(SELL, 1).quantity == 5
+
+
+def test_resting_order_that_cannot_settle_is_passed_over():
+    book = book_with(order(SELL, 1, 10, 5, 50), order(SELL, 2, 11, 5, 51))
+
+    def settle(fill):
+        if fill.sell_offer_id == 1:
+            raise Unsettled(SELL)
+
+    fills = book.submit(order(BUY, 3, 20, 5, 55), NOW, settle)
+
+    assert traded(fills) == [(3, 2, 5, 51)]
+    assert book.get(SELL, 1).quantity == 5
+
+
+def test_incoming_order_that_cannot_settle_stops_matching():
+    book = book_with(order(SELL, 1, 10, 5, 50), order(SELL, 2, 11, 5, 51))
+    settled = []
+
+    def settle(fill):
+        if settled:
+            raise Unsettled(BUY)
+        settled.append(fill)
+
+    fills = book.submit(order(BUY, 3, 20, 10, 55), NOW, settle)
+
+    assert traded(fills) == [(3, 1, 5, 50)]
+    assert book.get(SELL, 2).quantity == 5
+    assert book.get(BUY, 3).quantity == 5
+
+
+def test_engine_fill_takes_quantity_off_a_resting_order():
+    engine = MatchingEngine()
+    book = engine.book(RESOURCE_ID)
+    engine.submit(book, order(SELL, 1, 10, 10, 50), NOW)
+
+    engine.fill(book, SELL, 1, 4)
+    assert book.get(SELL, 1).quantity == 6
+    assert engine.locate(SELL, 1) == RESOURCE_ID
+
+    engine.fill(book, SELL, 1, 6)
+    assert book.get(SELL, 1) is None
+    assert engine.locate(SELL, 1) is None
+
+
+def test_engine_remove_takes_the_order_out_of_its_book():
+    engine = MatchingEngine()
+    book = engine.book(RESOURCE_ID)
+    engine.submit(book, order(BUY, 1, 10, 5, 50), NOW)
+
+    assert engine.locate(BUY, '1') == RESOURCE_ID
+    assert engine.remove(BUY, '1').offer_id == 1
+    assert book.get(BUY, 1) is None
+    assert engine.locate(BUY, 1) is None
+    assert engine.remove(BUY, 1) is None
+    assert book.submit(order(SELL, 2, 20, 5, 45), NOW) == []
+
+
+def test_engine_forgets_filled_and_expired_orders():
+    engine = MatchingEngine()
+    book = engine.book(RESOURCE_ID)
+    engine.submit(book, order(SELL, 1, 10, 5, 50), NOW)
+    engine.submit(book, order(SELL, 2, 11, 5, 51, offer_end_date=NOW + timedelta(hours=1)), NOW)
+
+    engine.submit(book, order(BUY, 3, 20, 5, 55), NOW)
+    assert engine.locate(SELL, 1) is None
+    assert engine.locate(BUY, 3) is None
+
+    later = NOW + timedelta(hours=2)
+    assert book.best(SELL, later) is None
+    assert engine.locate(SELL, 2) is None
+
+
+def test_load_matches_a_crossed_book_oldest_first():
+    engine = MatchingEngine()
+    book = engine.book(RESOURCE_ID)
+    sell_rows = [row(1, 10, 5, 50, NOW - timedelta(hours=2)), row(2, 11, 5, 49, NOW - timedelta(minutes=5))]
+    buy_rows = [row(3, 20, 8, 55, NOW - timedelta(hours=1))]
+
+    fills = engine.load(book, sell_rows, buy_rows, NOW)
+
+    assert traded(fills) == [(3, 1, 5, 50), (3, 2, 3, 55)]
+    assert book.get(BUY, 3) is None
+    assert book.get(SELL, 2).quantity == 2
+    assert engine.locate(SELL, 2) == RESOURCE_ID
+
+
+def test_load_replaces_the_book_and_its_locations():
+    engine = MatchingEngine()
+    book = engine.book(RESOURCE_ID)
+    engine.submit(book, order(SELL, 1, 10, 5, 50), NOW)
+
+    assert engine.load(book, [row(2, 11, 5, 60, NOW)], [row(3, 20, 5, 40, NOW)], NOW) == []
+    assert book.get(SELL, 1) is None
+    assert engine.locate(SELL, 1) is None
+    assert engine.locate(SELL, 2) == RESOURCE_ID
+    assert engine.locate(BUY, 3) == RESOURCE_ID
+
+
+def test_stale_book_raised_while_settling_reaches_the_caller():
+    engine = MatchingEngine()
+    book = engine.book(RESOURCE_ID)
+    engine.submit(book, order(SELL, 1, 10, 5, 50), NOW)
+
+    def settle(fill):
+        raise StaleBook("offer changed")
+
+    with pytest.raises(StaleBook):
+        engine.submit(book, order(BUY, 2, 20, 5, 55), NOW, settle)
+
+
+def test_invalidate_marks_books_stale():
+    engine = MatchingEngine()
+    first, second = engine.book(1), engine.book(2)
+    first.stale = second.stale = False
+
+    engine.invalidate(1)
+    assert first.stale and not second.stale
+
+    engine.invalidate()
+    assert second.stale